@@ -0,0 +1,387 @@
+"""End-to-end throughput benchmark for the download engine.
+
+Starts the local VK/CDN/TempShare/S3 stand-ins from ``fake_services``, points
+``server`` at them and runs listing + ``download_tracks_batch`` for a
+scenario, then reports tracks/s, MB/s, peak RSS, peak disk usage of
+DOWNLOAD_DIR and per-stage timings.
+
+Usage (from the backend directory):
+
+    python -m bench.bench_engine --scenario playlist
+    python -m bench.bench_engine --scenario playlist --save-baseline
+    python -m bench.bench_engine --all --compare
+    python -m bench.bench_engine --scenario chunked --storage s3
+    python -m bench.bench_engine --scenario single --memory-budget 0
+
+Without ``--mongo-url`` task status updates go to a small in-memory
+stand-in for the Motor collections, so no database is needed.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pymongo.errors import DuplicateKeyError
+
+from .fake_services import FakeConfig, FakeServices
+
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+
+SCENARIOS = {
+    "single": {"fake": {"track_count": 1, "min_duration": 200, "max_duration": 240, "bitrate_kbps": 320,
+                        "latency_ms": 20}},
+    "smoke": {"fake": {"track_count": 20, "min_duration": 30, "max_duration": 60, "bitrate_kbps": 128}},
+    "playlist": {"fake": {"track_count": 300, "min_duration": 30, "max_duration": 90, "bitrate_kbps": 128,
+                          "latency_ms": 50, "bandwidth_bps": 4 * 1024 * 1024}},
+    "chunked": {"fake": {"track_count": 400, "min_duration": 60, "max_duration": 120, "bitrate_kbps": 128},
+                "chunk_limit": 100 * 1024 * 1024},
+    "flaky": {"fake": {"track_count": 250, "min_duration": 30, "max_duration": 60, "bitrate_kbps": 128,
+                       "failure_rate": 0.05, "url_ttl": 8, "latency_ms": 30}},
+    "tagged": {"fake": {"track_count": 100, "min_duration": 30, "max_duration": 60, "bitrate_kbps": 128},
+               "add_tags": True, "add_lyrics": True},
+    "transcode": {"fake": {"track_count": 40, "min_duration": 120, "max_duration": 240, "bitrate_kbps": 320},
+                  "quality": "low"},
+}
+
+# Metrics where lower is worse / higher is worse when comparing baselines.
+HIGHER_IS_BETTER = ("tracks_per_s", "mb_per_s")
+LOWER_IS_BETTER = ("peak_rss_mb", "peak_disk_mb", "elapsed_s")
+
+
+class MemoryCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        self.docs.sort(key=lambda d: d.get(key) or "", reverse=direction < 0)
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs[:length] if length else self.docs
+
+
+class MemoryCollection:
+    def __init__(self):
+        self.docs = []
+
+    @classmethod
+    def _matches(cls, doc, flt):
+        for key, expected in (flt or {}).items():
+            if key == "$or":
+                if not any(cls._matches(doc, sub) for sub in expected):
+                    return False
+            elif isinstance(expected, dict) and "$in" in expected:
+                if doc.get(key) not in expected["$in"]:
+                    return False
+            elif isinstance(expected, dict) and "$lt" in expected:
+                if doc.get(key) is None or not doc[key] < expected["$lt"]:
+                    return False
+            elif isinstance(expected, dict) and "$gt" in expected:
+                if doc.get(key) is None or not doc[key] > expected["$gt"]:
+                    return False
+            elif doc.get(key) != expected:
+                return False
+        return True
+
+    def find(self, flt=None, projection=None):
+        return MemoryCursor([dict(d) for d in self.docs if self._matches(d, flt)])
+
+    async def delete_one(self, flt):
+        for idx, doc in enumerate(self.docs):
+            if self._matches(doc, flt):
+                del self.docs[idx]
+                return
+
+    async def delete_many(self, flt):
+        self.docs = [d for d in self.docs if not self._matches(d, flt)]
+
+    async def insert_one(self, doc):
+        self.docs.append(dict(doc))
+
+    async def find_one(self, flt=None, projection=None):
+        for doc in self.docs:
+            if self._matches(doc, flt):
+                return dict(doc)
+        return None
+
+    async def update_one(self, flt, update, upsert=False):
+        doc = next((d for d in self.docs if self._matches(d, flt)), None)
+        if doc is None:
+            if not upsert:
+                return
+            doc = {k: v for k, v in flt.items() if not k.startswith("$") and not isinstance(v, dict)}
+            if "_id" in doc and any(d.get("_id") == doc["_id"] for d in self.docs):
+                raise DuplicateKeyError(f"duplicate _id {doc['_id']}")
+            self.docs.append(doc)
+        doc.update(update.get("$set", {}))
+        for key, value in update.get("$addToSet", {}).items():
+            values = value["$each"] if isinstance(value, dict) else [value]
+            existing = doc.setdefault(key, [])
+            existing.extend(v for v in values if v not in existing)
+
+    async def update_many(self, flt, update):
+        for doc in self.docs:
+            if self._matches(doc, flt):
+                doc.update(update.get("$set", {}))
+
+    async def find_one_and_update(self, flt, update, projection=None, upsert=False, return_document=False):
+        doc = next((d for d in self.docs if self._matches(d, flt)), None)
+        before = dict(doc) if doc is not None else None
+        await self.update_one(flt, update, upsert=upsert)
+        if return_document:
+            doc = next((d for d in self.docs if self._matches(d, {**flt, **update.get("$set", {})})), None)
+            return dict(doc) if doc is not None else None
+        return before
+
+    async def create_index(self, *args, **kwargs):
+        return None
+
+
+class MemoryDB:
+    def __init__(self):
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._collections.setdefault(name, MemoryCollection())
+
+
+class ResourceSampler(threading.Thread):
+    def __init__(self, download_dir, interval=0.1):
+        super().__init__(daemon=True)
+        self.download_dir = Path(download_dir)
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def current_rss():
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def disk_usage(self):
+        total = 0
+        for root, _, files in os.walk(self.download_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_rss = max(self.peak_rss, self.current_rss())
+            self.peak_disk = max(self.peak_disk, self.disk_usage())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+_ORIGINALS = {}
+
+
+def instrument(server, timings):
+    def wrap(name):
+        original = _ORIGINALS.setdefault(name, getattr(server, name))
+
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                timings[name]["count"] += 1
+                timings[name]["total_s"] += time.perf_counter() - started
+
+        setattr(server, name, timed)
+
+    for name in ("download_track_file", "fetch_cover", "get_lyrics", "apply_id3_tags",
+                 "store_archive", "resolve_track_urls"):
+        wrap(name)
+
+    status_log = []
+    original_update = _ORIGINALS.setdefault("update_task_status", server.update_task_status)
+
+    async def update_task_status(task_id, status, **kwargs):
+        if not status_log or status_log[-1][0] != status:
+            status_log.append((status, time.perf_counter()))
+        return await original_update(task_id, status, **kwargs)
+
+    server.update_task_status = update_task_status
+    return status_log
+
+
+async def run_scenario(name, mongo_url=None, storage="tempshare", memory_budget_mb=None):
+    scenario = SCENARIOS[name]
+    fake = FakeServices(FakeConfig(**scenario["fake"]))
+    base_url = await fake.start()
+
+    os.environ["VK_API_BASE"] = f"{base_url}/method"
+    os.environ["TEMPSHARE_UPLOAD_URL"] = f"{base_url}/upload"
+    os.environ.setdefault("MONGO_URL", mongo_url or "mongodb://127.0.0.1:27017")
+    os.environ.setdefault("DB_NAME", "vk_music_saver_bench")
+    os.environ["PROXY_HEALTH_INTERVAL"] = "0"
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import server
+
+    server.VK_API_BASE = f"{base_url}/method"
+    server.TEMPSHARE_UPLOAD_URL = f"{base_url}/upload"
+    if not mongo_url:
+        server.db = MemoryDB()
+    if "chunk_limit" in scenario:
+        server.CHUNK_SIZE_LIMIT = scenario["chunk_limit"]
+    if storage == "s3":
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+        server.archive_storage = server.S3Storage(bucket="bench", endpoint_url=f"{base_url}/s3")
+    elif storage == "local":
+        server.archive_storage = server.LocalStorage(root=server.DOWNLOAD_DIR.parent / "bench_archives")
+    else:
+        server.archive_storage = server.TempShareStorage()
+
+    if memory_budget_mb is not None:
+        server.memory_budget.capacity = memory_budget_mb * 1024 * 1024
+
+    timings = defaultdict(lambda: {"count": 0, "total_s": 0.0})
+    status_log = instrument(server, timings)
+    server.HTTP_CONNECTIONS.values.clear()
+    server.MEMORY_JOBS.values.clear()
+    server.TRANSCODES.values.clear()
+
+    task_id = str(uuid.uuid4())
+    await server.db.download_history.insert_one(
+        server.DownloadHistoryItem(id=task_id, session_id="bench", download_type="playlist").model_dump()
+    )
+
+    sampler = ResourceSampler(server.DOWNLOAD_DIR)
+    sampler.start()
+    started = time.perf_counter()
+    tracks = await server.get_all_audio("bench-token", owner_id=fake.config.owner_id, album_id=fake.config.playlist_id)
+    listed = time.perf_counter()
+    await server.download_tracks_batch(task_id, "bench-token", tracks, f"bench_{name}",
+                                       add_tags=scenario.get("add_tags", False),
+                                       add_lyrics=scenario.get("add_lyrics", False),
+                                       quality=scenario.get("quality", "high"))
+    finished = time.perf_counter()
+    sampler.stop()
+    await server.close_http_pools()
+    await fake.stop()
+    connections = {kind: count for (_, kind), count in server.HTTP_CONNECTIONS.values.items()}
+
+    task = await server.db.download_history.find_one({"id": task_id})
+    elapsed = finished - started
+    mb = fake.stats.cdn_bytes / 1024 / 1024
+
+    stages = {"listing": round(listed - started, 3)}
+    for idx, (status, at) in enumerate(status_log):
+        end = status_log[idx + 1][1] if idx + 1 < len(status_log) else finished
+        stages[status] = round(stages.get(status, 0) + end - max(at, listed), 3)
+
+    return {
+        "scenario": name,
+        "storage": storage,
+        "in_memory": bool(server.MEMORY_JOBS.values.get(("memory",))),
+        "status": task.get("status"),
+        "error": task.get("error_message", ""),
+        "tracks": task.get("downloaded_count", 0),
+        "track_count": len(tracks),
+        "elapsed_s": round(elapsed, 3),
+        "tracks_per_s": round(task.get("downloaded_count", 0) / elapsed, 2) if elapsed else 0,
+        "mb_per_s": round(mb / elapsed, 2) if elapsed else 0,
+        "downloaded_mb": round(mb, 1),
+        "uploaded_mb": round(fake.stats.upload_bytes / 1024 / 1024, 1),
+        "uploads": fake.stats.uploads,
+        "peak_rss_mb": round(sampler.peak_rss / 1024 / 1024, 1),
+        "peak_disk_mb": round(sampler.peak_disk / 1024 / 1024, 1),
+        "stages_s": stages,
+        "calls": {k: {"count": v["count"], "total_s": round(v["total_s"], 3)} for k, v in timings.items()},
+        "vk_api_calls": fake.stats.api_calls,
+        "cdn": {"requests": fake.stats.cdn_requests, "failures": fake.stats.cdn_failures,
+                "expired": fake.stats.cdn_expired},
+        "connections": {"new": connections.get("new", 0), "reused": connections.get("reused", 0)},
+        "transcodes": {result: count for (result,), count in server.TRANSCODES.values.items()},
+    }
+
+
+def scenario_result(*args):
+    return asyncio.run(run_scenario(*args))
+
+
+# Peak RSS never drops within a process and the server's metrics are module
+# globals, so every scenario gets a fresh interpreter; otherwise --all
+# results depend on which scenarios ran before.
+def run_isolated(*args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(scenario_result, *args).result()
+
+
+def load_baselines():
+    if BASELINES_PATH.exists():
+        return json.loads(BASELINES_PATH.read_text())
+    return {}
+
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for key in HIGHER_IS_BETTER:
+        if baseline.get(key) and result[key] < baseline[key] * (1 - tolerance):
+            regressions.append(f"{key}: {result[key]} < {baseline[key]}")
+    for key in LOWER_IS_BETTER:
+        if baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key}: {result[key]} > {baseline[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="smoke")
+    parser.add_argument("--all", action="store_true", help="run every scenario")
+    parser.add_argument("--mongo-url", help="use a real MongoDB instead of the in-memory stand-in")
+    parser.add_argument("--storage", choices=("tempshare", "local", "s3"), default="tempshare",
+                        help="archive storage backend to upload to")
+    parser.add_argument("--memory-budget", type=int, metavar="MB",
+                        help="override MEMORY_BUDGET_MB (0 forces the on-disk path)")
+    parser.add_argument("--save-baseline", action="store_true", help="store results in baselines.json")
+    parser.add_argument("--compare", action="store_true", help="fail on regressions against baselines.json")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    names = sorted(SCENARIOS) if args.all else [args.scenario]
+    baselines = load_baselines()
+    failed = False
+    for name in names:
+        result = run_isolated(name, args.mongo_url, args.storage, args.memory_budget)
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        if args.compare and name in baselines:
+            regressions = compare(result, baselines[name], args.tolerance)
+            for line in regressions:
+                print(f"REGRESSION [{name}] {line}")
+            failed = failed or bool(regressions)
+        if args.save_baseline:
+            baselines[name] = {k: result[k] for k in HIGHER_IS_BETTER + LOWER_IS_BETTER}
+    if args.save_baseline:
+        BASELINES_PATH.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
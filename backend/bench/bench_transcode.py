@@ -0,0 +1,100 @@
+"""Throughput of the transcoding stage per worker count.
+
+Feeds synthetic 320 kbps tracks (silent MPEG frames from ``fake_services``)
+through ``server.transcode_track`` with ``TRANSCODE_WORKERS`` set to each
+value of ``--workers`` and reports tracks/s, MB/s of source audio and the
+speed relative to real time. Needs ffmpeg or lame (found on PATH or set
+with ``TRANSCODER_BIN``).
+
+Usage (from the backend directory):
+
+    python -m bench.bench_transcode
+    python -m bench.bench_transcode --workers 1,2,4,8 --tracks 32 --quality medium
+    python -m bench.bench_transcode --on-disk
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from .fake_services import mp3_frame
+
+
+def make_track(seconds, kbps=320):
+    frame = mp3_frame(kbps)
+    return frame * (seconds * kbps * 1000 // 8 // len(frame))
+
+
+async def run_round(server, tracks, duration, quality, workers, on_disk):
+    server.TRANSCODE_WORKERS = workers
+    server.transcode_slots.clear()
+    server.TRANSCODES.values.clear()
+    workdir = Path(tempfile.mkdtemp(prefix="bench_transcode_"))
+    try:
+        sources = []
+        for idx, data in enumerate(tracks):
+            if on_disk:
+                path = workdir / f"{idx:03d}.mp3"
+                path.write_bytes(data)
+                sources.append(str(path))
+            else:
+                sources.append(data)
+        started = time.perf_counter()
+        results = await asyncio.gather(*(server.transcode_track(src, len(data), duration, quality)
+                                         for src, data in zip(sources, tracks)))
+        elapsed = time.perf_counter() - started
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    source_mb = sum(len(t) for t in tracks) / 1024 / 1024
+    return {
+        "workers": workers,
+        "elapsed_s": round(elapsed, 3),
+        "tracks_per_s": round(len(tracks) / elapsed, 2),
+        "source_mb_per_s": round(source_mb / elapsed, 2),
+        "x_realtime": round(len(tracks) * duration / elapsed, 1),
+        "output_mb": round(sum(size for _, size in results) / 1024 / 1024, 1),
+        "transcodes": {result: count for (result,), count in server.TRANSCODES.values.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    default_workers = sorted({1, 2, 4, os.cpu_count() or 1})
+    parser.add_argument("--workers", default=",".join(map(str, default_workers)),
+                        help="comma-separated TRANSCODE_WORKERS values")
+    parser.add_argument("--tracks", type=int, default=16)
+    parser.add_argument("--duration", type=int, default=180, help="seconds of audio per track")
+    parser.add_argument("--quality", choices=("low", "medium"), default="low")
+    parser.add_argument("--on-disk", action="store_true", help="re-encode files in place instead of piping bytes")
+    args = parser.parse_args()
+
+    os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+    os.environ.setdefault("DB_NAME", "vk_music_saver_bench")
+    os.environ["PROXY_HEALTH_INTERVAL"] = "0"
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import server
+
+    if not server.TRANSCODER_BIN:
+        sys.exit("No encoder found: install ffmpeg or lame, or set TRANSCODER_BIN")
+
+    tracks = [make_track(args.duration) for _ in range(args.tracks)]
+    rounds = [asyncio.run(run_round(server, tracks, args.duration, args.quality, int(w), args.on_disk))
+              for w in args.workers.split(",")]
+    print(json.dumps({
+        "encoder": server.TRANSCODER_BIN,
+        "cpu_count": os.cpu_count(),
+        "quality": args.quality,
+        "mode": "disk" if args.on_disk else "memory",
+        "tracks": args.tracks,
+        "source_mb": round(sum(len(t) for t in tracks) / 1024 / 1024, 1),
+        "rounds": rounds,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""Local stand-ins for the VK API, the VK audio CDN, TempShare and S3.
+
+All of them live on one aiohttp app so a benchmark (or a developer running
+the backend against them) needs a single port:
+
+    /method/<name>   VK API (audio.get, audio.getById, audio.getLyrics,
+                     audio.getPlaylistById, users.get, execute, ...)
+    /cdn/<id>.mp3    audio CDN with bandwidth/latency/failure injection
+    /upload          TempShare upload endpoint
+    /s3/<bucket>     minimal S3 API (PutObject, multipart upload, GetObject,
+                     ListObjectsV2, DeleteObjects) for ARCHIVE_STORAGE=s3
+
+Run standalone with ``python -m bench.fake_services --port 8099`` from the
+backend directory and point the server at it with
+``VK_API_BASE=http://127.0.0.1:8099/method`` and
+``TEMPSHARE_UPLOAD_URL=http://127.0.0.1:8099/upload`` (or
+``S3_ENDPOINT_URL=http://127.0.0.1:8099/s3`` with any credentials).
+"""
+import argparse
+import asyncio
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from aiohttp import web
+from email.utils import formatdate
+
+# MPEG-1 Layer III bitrate indices (kbps -> header nibble).
+MP3_BITRATE_INDEX = {32: 1, 40: 2, 48: 3, 56: 4, 64: 5, 80: 6, 96: 7, 112: 8, 128: 9, 160: 10, 192: 11,
+                     224: 12, 256: 13, 320: 14}
+
+
+# One silent MPEG-1 Layer III frame (44.1 kHz, no padding) at `kbps`.
+def mp3_frame(kbps):
+    header = bytes((0xFF, 0xFB, MP3_BITRATE_INDEX[kbps] << 4, 0x64))
+    return header + b"\x00" * (144000 * kbps // 44100 - len(header))
+
+
+@dataclass
+class FakeConfig:
+    track_count: int = 300
+    owner_id: int = 100
+    playlist_id: int = 1
+    min_duration: int = 120
+    max_duration: int = 300
+    bitrate_kbps: int = 320
+    # CDN behaviour
+    bandwidth_bps: int = 0          # per stream, 0 = unlimited
+    latency_ms: int = 0             # time to first byte
+    failure_rate: float = 0.0       # fraction of CDN requests answered with 500
+    url_ttl: float = 0.0            # seconds until a signed URL returns 403, 0 = never
+    # VK API behaviour
+    api_latency_ms: int = 0
+    rate_limit_rps: float = 0.0     # error 6 above this many calls per second, 0 = off
+    seed: int = 1
+
+
+@dataclass
+class FakeStats:
+    api_calls: dict = field(default_factory=dict)
+    throttled: int = 0
+    cdn_requests: int = 0
+    cdn_failures: int = 0
+    cdn_expired: int = 0
+    cdn_bytes: int = 0
+    uploads: int = 0
+    upload_bytes: int = 0
+
+
+class FakeServices:
+    def __init__(self, config: FakeConfig = None):
+        self.config = config or FakeConfig()
+        self.stats = FakeStats()
+        self.base_url = ""
+        self._rng = random.Random(self.config.seed)
+        self._frame = mp3_frame(self.config.bitrate_kbps)
+        self._durations = [self._rng.randint(self.config.min_duration, self.config.max_duration)
+                           for _ in range(self.config.track_count)]
+        self._api_window = []
+        self._runner = None
+        self.objects = {}   # (bucket, key) -> (bytes, mtime)
+        self._multipart = {}  # upload id -> {part number: bytes}
+
+    # ---------- catalogue ----------
+
+    def track_size(self, audio_id: int) -> int:
+        duration = self._durations[audio_id - 1]
+        frames = duration * self.config.bitrate_kbps * 1000 // 8 // len(self._frame)
+        return max(frames, 1) * len(self._frame)
+
+    def audio_item(self, audio_id: int) -> dict:
+        owner_id = self.config.owner_id
+        return {
+            "id": audio_id, "owner_id": owner_id,
+            "artist": f"Artist {audio_id % 37}", "title": f"Track {audio_id}",
+            "duration": self._durations[audio_id - 1],
+            "url": f"{self.base_url}/cdn/{owner_id}_{audio_id}.mp3?ts={time.time():.0f}",
+            "lyrics_id": audio_id if audio_id % 5 == 0 else None,
+            "album": {"id": 1, "title": "Fake Album",
+                      "thumb": {"photo_300": f"{self.base_url}/cdn/cover.jpg"}},
+            "ads": {"content_id": f"{owner_id}_{audio_id}", "duration": "0"},
+        }
+
+    # ---------- VK API ----------
+
+    def _throttled(self) -> bool:
+        if not self.config.rate_limit_rps:
+            return False
+        now = time.monotonic()
+        self._api_window = [t for t in self._api_window if now - t < 1.0]
+        self._api_window.append(now)
+        return len(self._api_window) > self.config.rate_limit_rps
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.method == "POST":
+            params.update(await request.post())
+        self.stats.api_calls[method] = self.stats.api_calls.get(method, 0) + 1
+        if self.config.api_latency_ms:
+            await asyncio.sleep(self.config.api_latency_ms / 1000)
+        if self._throttled():
+            self.stats.throttled += 1
+            return web.json_response({"error": {"error_code": 6, "error_msg": "Too many requests per second"}})
+
+        if method == "audio.get":
+            offset = int(params.get("offset", 0))
+            count = int(params.get("count", 200))
+            ids = range(offset + 1, min(offset + count, self.config.track_count) + 1)
+            return web.json_response({"response": {"count": self.config.track_count,
+                                                   "items": [self.audio_item(i) for i in ids]}})
+        if method == "audio.getById":
+            items = []
+            for ident in params.get("audios", "").split(","):
+                parts = ident.split("_")
+                if len(parts) >= 2 and parts[1].isdigit() and 1 <= int(parts[1]) <= self.config.track_count:
+                    items.append(self.audio_item(int(parts[1])))
+            return web.json_response({"response": items})
+        if method == "audio.getLyrics":
+            return web.json_response({"response": {"text": "la la la\n" * 20}})
+        if method == "audio.getPlaylistById":
+            return web.json_response({"response": {"id": self.config.playlist_id, "title": "Fake Playlist",
+                                                   "count": self.config.track_count}})
+        if method == "users.get":
+            return web.json_response({"response": [{"id": 1, "first_name": "Bench", "last_name": "User",
+                                                    "photo_100": ""}]})
+        if method == "execute":
+            return web.json_response({"response": []})
+        if method == "utils.getServerTime":
+            return web.json_response({"response": int(time.time())})
+        return web.json_response({"error": {"error_code": 3, "error_msg": f"Unknown method {method}"}})
+
+    # ---------- CDN ----------
+
+    async def handle_cdn(self, request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+        self.stats.cdn_requests += 1
+        if name == "cover":
+            return web.Response(body=b"\xff\xd8\xff\xe0" + b"\x00" * 20000, content_type="image/jpeg")
+        if self.config.latency_ms:
+            await asyncio.sleep(self.config.latency_ms / 1000)
+        if self.config.url_ttl:
+            issued = float(request.query.get("ts", 0))
+            if time.time() - issued > self.config.url_ttl:
+                self.stats.cdn_expired += 1
+                return web.Response(status=403)
+        if self.config.failure_rate and self._rng.random() < self.config.failure_rate:
+            self.stats.cdn_failures += 1
+            return web.Response(status=500)
+
+        audio_id = int(name.split("_")[1])
+        size = self.track_size(audio_id)
+        if request.method == "HEAD":
+            return web.Response(headers={"Content-Type": "audio/mpeg", "Content-Length": str(size)})
+        response = web.StreamResponse(headers={"Content-Type": "audio/mpeg", "Content-Length": str(size)})
+        await response.prepare(request)
+        block = self._frame * 64
+        sent = 0
+        started = time.monotonic()
+        try:
+            while sent < size:
+                chunk = block[:size - sent]
+                await response.write(chunk)
+                sent += len(chunk)
+                if self.config.bandwidth_bps:
+                    ahead = sent / self.config.bandwidth_bps - (time.monotonic() - started)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+            await response.write_eof()
+        except ConnectionResetError:
+            pass  # client went away (cancelled task)
+        finally:
+            self.stats.cdn_bytes += sent
+        return response
+
+    # ---------- TempShare ----------
+
+    async def handle_upload(self, request: web.Request) -> web.Response:
+        reader = await request.multipart()
+        total = 0
+        async for part in reader:
+            while True:
+                chunk = await part.read_chunk(1024 * 1024)
+                if not chunk:
+                    break
+                total += len(chunk)
+        self.stats.uploads += 1
+        self.stats.upload_bytes += total
+        return web.json_response({"success": True, "url": f"{self.base_url}/f/{self.stats.uploads}",
+                                  "raw_url": f"{self.base_url}/raw/{self.stats.uploads}"})
+
+    # ---------- S3 ----------
+
+    def _object_response(self, bucket, key):
+        if (bucket, key) not in self.objects:
+            return web.Response(status=404, content_type="application/xml",
+                                text="<Error><Code>NoSuchKey</Code></Error>")
+        body, mtime = self.objects[bucket, key]
+        return web.Response(body=body, headers={"ETag": f'"{len(body):x}"',
+                                                "Last-Modified": formatdate(mtime, usegmt=True)})
+
+    async def handle_s3_object(self, request: web.Request) -> web.Response:
+        bucket, key = request.match_info["bucket"], request.match_info["key"]
+        query = request.query
+        if request.method == "GET":
+            return self._object_response(bucket, key)
+        if request.method == "PUT":
+            body = await request.read()
+            if "uploadId" in query:
+                self._multipart[query["uploadId"]][int(query["partNumber"])] = body
+            else:
+                self.objects[bucket, key] = (body, time.time())
+                self.stats.uploads += 1
+                self.stats.upload_bytes += len(body)
+            return web.Response(headers={"ETag": f'"{uuid.uuid4().hex}"'})
+        if request.method == "POST" and "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self._multipart[upload_id] = {}
+            return web.Response(content_type="application/xml", text=(
+                f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"))
+        if request.method == "POST" and "uploadId" in query:
+            await request.read()
+            parts = self._multipart.pop(query["uploadId"])
+            body = b"".join(parts[n] for n in sorted(parts))
+            self.objects[bucket, key] = (body, time.time())
+            self.stats.uploads += 1
+            self.stats.upload_bytes += len(body)
+            return web.Response(content_type="application/xml", text=(
+                f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f'<ETag>"{len(body):x}"</ETag></CompleteMultipartUploadResult>'))
+        if request.method == "DELETE":
+            self._multipart.pop(query.get("uploadId"), None)
+            self.objects.pop((bucket, key), None)
+            return web.Response(status=204)
+        return web.Response(status=405)
+
+    async def handle_s3_bucket(self, request: web.Request) -> web.Response:
+        bucket = request.match_info["bucket"]
+        if request.method == "POST" and "delete" in request.query:
+            body = (await request.read()).decode()
+            for key in re.findall(r"<Key>(.*?)</Key>", body):
+                self.objects.pop((bucket, key), None)
+            return web.Response(content_type="application/xml", text="<DeleteResult></DeleteResult>")
+        prefix = request.query.get("prefix", "")
+        contents = "".join(
+            f"<Contents><Key>{key}</Key><Size>{len(body)}</Size>"
+            f"<LastModified>{time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(mtime))}</LastModified></Contents>"
+            for (b, key), (body, mtime) in sorted(self.objects.items()) if b == bucket and key.startswith(prefix)
+        )
+        return web.Response(content_type="application/xml", text=(
+            f"<ListBucketResult><Name>{bucket}</Name><Prefix>{prefix}</Prefix><IsTruncated>false</IsTruncated>"
+            f"{contents}</ListBucketResult>"))
+
+    # ---------- lifecycle ----------
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=0)
+        app.router.add_route("*", "/method/{method}", self.handle_method)
+        app.router.add_get("/cdn/{name}.mp3", self.handle_cdn)
+        app.router.add_get("/cdn/{name}.jpg", self.handle_cdn)
+        app.router.add_post("/upload", self.handle_upload)
+        app.router.add_route("*", "/s3/{bucket}/{key:.+}", self.handle_s3_object)
+        app.router.add_route("*", "/s3/{bucket}", self.handle_s3_bucket)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{bound_port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+async def _serve(args):
+    services = FakeServices(FakeConfig(track_count=args.tracks, bandwidth_bps=args.bandwidth,
+                                       latency_ms=args.latency, failure_rate=args.failure_rate))
+    url = await services.start(port=args.port)
+    print(f"Fake VK/CDN/TempShare/S3 on {url}")
+    print(f"  VK_API_BASE={url}/method TEMPSHARE_UPLOAD_URL={url}/upload")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--tracks", type=int, default=300)
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/s per CDN stream")
+    parser.add_argument("--latency", type=int, default=0, help="CDN time to first byte, ms")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
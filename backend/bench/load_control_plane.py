@@ -0,0 +1,221 @@
+"""Control-plane load test for the FastAPI endpoints.
+
+Runs the app with uvicorn in a background thread and simulates many
+dashboards against it. Like the React frontend, each dashboard polls
+``/api/download/active`` and ``/api/download/history`` every
+``--poll-interval`` seconds, occasionally creates a task and occasionally
+cancels one. Reports p50/p99 latency and throughput per endpoint plus
+event-loop lag of the server loop.
+
+Usage (from the backend directory, with MongoDB running):
+
+    python -m bench.load_control_plane --dashboards 2000 --duration 60
+    python -m bench.load_control_plane --memory-db --dashboards 500
+
+The download engine is replaced by a lightweight simulated task that only
+updates its status, so the numbers reflect the API tier and the database,
+not VK or the CDN.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+import aiohttp
+
+from .bench_engine import MemoryDB
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+class ServerThread(threading.Thread):
+    def __init__(self, app, port, lag_interval=0.05):
+        super().__init__(daemon=True)
+        import uvicorn
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                                                    lifespan="off"))
+        self.lag_interval = lag_interval
+        self.lags_ms = []
+        self.ready = threading.Event()
+        self.loop = None
+
+    async def _probe_lag(self):
+        while True:
+            expected = time.perf_counter() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            self.lags_ms.append(max(0.0, (time.perf_counter() - expected) * 1000))
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        probe = asyncio.create_task(self._probe_lag())
+        serve = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.05)
+        self.ready.set()
+        await serve
+        probe.cancel()
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    def stop(self):
+        self.server.should_exit = True
+        self.join()
+
+
+def install_simulated_engine(server, task_seconds):
+    async def simulated_download(task_id, *args, **kwargs):
+        steps = max(1, int(task_seconds))
+        for step in range(steps):
+            if server.active_cancel_flags.get(task_id):
+                server.active_cancel_flags.pop(task_id, None)
+                await server.update_task_status(task_id, "cancelled", error_message="Cancelled by user")
+                return
+            await server.update_task_status(task_id, "downloading", progress=step * 100 / steps,
+                                            current_track=f"Track {step}")
+            await asyncio.sleep(1)
+        await server.update_task_status(task_id, "completed", progress=100.0, current_track="")
+
+    # start_download looks this name up in module globals at call time.
+    server.process_playlist_download = simulated_download
+
+
+class Dashboard:
+    def __init__(self, base_url, session_id, stats, args):
+        self.base_url = base_url
+        self.session_id = session_id
+        self.stats = stats
+        self.args = args
+
+    async def request(self, http, method, name, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            async with http.request(method, f"{self.base_url}{path}", **kwargs) as resp:
+                body = await resp.json(content_type=None)
+                ok = resp.status < 400
+        except Exception:
+            body, ok = None, False
+        self.stats[name]["latencies"].append((time.perf_counter() - started) * 1000)
+        if not ok:
+            self.stats[name]["errors"] += 1
+        return body
+
+    async def run(self, http, deadline):
+        await asyncio.sleep(random.uniform(0, self.args.poll_interval))
+        while time.perf_counter() < deadline:
+            cycle_start = time.perf_counter()
+            active, _ = await asyncio.gather(
+                self.request(http, "GET", "active", f"/api/download/active/{self.session_id}"),
+                self.request(http, "GET", "history", f"/api/download/history/{self.session_id}"),
+            )
+            if random.random() < self.args.create_rate:
+                await self.request(http, "POST", "create", "/api/download/start", json={
+                    "session_id": self.session_id,
+                    "playlist_url": f"https://vk.com/music?z=audio_playlist-1_{random.randint(1, 10**6)}",
+                })
+            if isinstance(active, list) and active and random.random() < self.args.cancel_rate:
+                task_id = random.choice(active).get("id")
+                await self.request(http, "POST", "cancel", f"/api/download/cancel/{task_id}")
+            elapsed = time.perf_counter() - cycle_start
+            await asyncio.sleep(max(0.0, self.args.poll_interval - elapsed))
+
+
+async def run_load(args, base_url, session_ids):
+    stats = defaultdict(lambda: {"latencies": [], "errors": 0})
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    started = time.perf_counter()
+    deadline = started + args.duration
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as http:
+        dashboards = [Dashboard(base_url, sid, stats, args) for sid in session_ids]
+        await asyncio.gather(*(d.run(http, deadline) for d in dashboards))
+    return stats, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dashboards", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--create-rate", type=float, default=0.01, help="chance per poll cycle to create a task")
+    parser.add_argument("--cancel-rate", type=float, default=0.05, help="chance per poll cycle to cancel a task")
+    parser.add_argument("--task-seconds", type=float, default=20, help="lifetime of a simulated task")
+    parser.add_argument("--seed-history", type=int, default=20, help="finished tasks per session before start")
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--port", type=int, default=18001)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://127.0.0.1:27017"))
+    parser.add_argument("--db-name", default="vk_music_saver_load")
+    parser.add_argument("--memory-db", action="store_true", help="use the in-memory stand-in instead of MongoDB")
+    args = parser.parse_args()
+
+    os.environ["MONGO_URL"] = args.mongo_url
+    os.environ["DB_NAME"] = args.db_name
+    os.environ["PROXY_HEALTH_INTERVAL"] = "0"
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import server
+
+    if args.memory_db:
+        server.db = MemoryDB()
+    install_simulated_engine(server, args.task_seconds)
+
+    session_ids = [str(uuid.uuid4()) for _ in range(args.dashboards)]
+
+    srv = ServerThread(server.app, args.port)
+    srv.start()
+    srv.ready.wait(30)
+
+    async def seed():
+        if not args.memory_db:
+            await server.db.download_history.delete_many({"session_id": {"$in": session_ids}})
+        for sid in session_ids:
+            await server.session_store.put(sid, {"token": "load-test", "user_id": None})
+            for _ in range(args.seed_history):
+                item = server.DownloadHistoryItem(session_id=sid, status="completed", progress=100.0)
+                await server.db.download_history.insert_one(item.model_dump())
+
+    # Seed through the server loop: Motor binds to the loop it first runs on.
+    asyncio.run_coroutine_threadsafe(seed(), srv.loop).result()
+
+    stats, elapsed = asyncio.run(run_load(args, f"http://127.0.0.1:{args.port}", session_ids))
+    srv.stop()
+
+    total = sum(len(v["latencies"]) for v in stats.values())
+    report = {
+        "dashboards": args.dashboards,
+        "duration_s": round(elapsed, 2),
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0,
+        "endpoints": {
+            name: {
+                "count": len(v["latencies"]),
+                "errors": v["errors"],
+                "p50_ms": round(percentile(v["latencies"], 50), 2),
+                "p99_ms": round(percentile(v["latencies"], 99), 2),
+                "mean_ms": round(statistics.fmean(v["latencies"]), 2) if v["latencies"] else 0,
+            }
+            for name, v in sorted(stats.items())
+        },
+        "loop_lag_ms": {
+            "p50": round(percentile(srv.lags_ms, 50), 2),
+            "p99": round(percentile(srv.lags_ms, 99), 2),
+            "max": round(max(srv.lags_ms), 2) if srv.lags_ms else 0,
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
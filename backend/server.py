@@ -1,31 +1,55 @@
-from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException
+from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse, FileResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 import re
 import json
+import io
+import struct
+import zlib
 import zipfile
 import shutil
+import tempfile
 import asyncio
+import anyio
 import aiohttp
 import aiofiles
 import uuid
 import time
+import hashlib
+import base64
+import socket
 import signal
-import subprocess
+import sys
+import threading
+import traceback
+import functools
+import heapq
+import abc
+from collections import deque, defaultdict
 from pathlib import Path
-from urllib.parse import urlparse, parse_qs, unquote
+from urllib.parse import urlparse, parse_qs, unquote, quote
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional, Dict
-from datetime import datetime, timezone
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone, timedelta
 
 try:
     from aiohttp_socks import ProxyConnector
 except ImportError:
     ProxyConnector = None
 
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
 try:
     from mutagen.mp3 import MP3
     from mutagen.id3 import ID3, TIT2, TPE1, TALB, APIC, USLT, ID3NoHeaderError
@@ -46,11 +70,35 @@ api_router = APIRouter(prefix="/api")
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+VK_API_BASE = os.environ.get('VK_API_BASE', 'https://api.vk.com/method')
+TEMPSHARE_UPLOAD_URL = os.environ.get('TEMPSHARE_UPLOAD_URL', 'https://api.tempshare.su/upload')
 KATE_USER_AGENT = "KateMobileAndroid/56 lite-460 (Android 4.4.2; SDK 19; x86; unknown Android SDK built for x86; en)"
 
-vk_sessions: Dict[str, dict] = {}
-xray_processes: Dict[str, dict] = {}
-active_cancel_flags: Dict[str, bool] = {}
+xray_processes: Dict[str, dict] = {}  # proxy_id -> SOCKS inbound on the shared Xray instance (mirrors db.xray_state)
+xray_instance: dict = {}
+xray_state_loaded_at = 0.0
+background_workers: List[asyncio.Task] = []
+playlist_cache: Dict[tuple, tuple] = {}  # key -> (expires_at, title, tracks)
+playlist_inflight: Dict[tuple, asyncio.Future] = {}
+concurrency_limiters: Dict[str, "ConcurrencyLimiter"] = {}  # egress -> AIMD limiter
+http_pools: Dict[str, "HttpPool"] = {}  # proxy url ("" = direct) -> shared client session
+engine_tasks: set = set()  # task ids currently inside download_tracks_batch
+task_runners: Dict[str, asyncio.Task] = {}  # task id -> asyncio task running its process_* coroutine
+cancel_events: Dict[str, threading.Event] = {}  # checked by executor work between archive entries
+active_cancel_flags: Dict[str, bool] = {}  # this worker's view; requests arrive via download_history.cancel_requested
+
+HOST_ID = socket.gethostname()
+WORKER_ID = f"{HOST_ID}:{os.getpid()}"
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')  # empty = key file shared by the workers of one host
+SESSION_KEY_PATH = ROOT_DIR / ".session_key"
+SESSION_TTL = int(os.environ.get('SESSION_TTL', str(30 * 24 * 3600)))
+SESSION_CACHE_TTL = 30
+SESSION_CACHE_MAX = 10000
+CANCEL_POLL_INTERVAL = 1.0
+LOCK_TTL = 30  # seconds a lock outlives a crashed holder
+WORKER_HEARTBEAT_INTERVAL = 10
+WORKER_TTL = 3 * WORKER_HEARTBEAT_INTERVAL  # a worker silent for this long is treated as dead
+XRAY_STATE_TTL = 2.0
 
 DOWNLOAD_DIR = Path("/tmp/vk_downloads")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
@@ -58,8 +106,78 @@ XRAY_CONFIG_DIR = Path("/tmp/xray_configs")
 XRAY_CONFIG_DIR.mkdir(exist_ok=True)
 XRAY_BIN = "/usr/local/bin/xray"
 TEMPSHARE_MAX_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
-CHUNK_SIZE_LIMIT = 1 * 1024 * 1024 * 1024  # 1GB - FIX BUG #2: chunk threshold
-CONCURRENT_DOWNLOADS = 8
+ARCHIVE_STORAGE = os.environ.get('ARCHIVE_STORAGE', 'tempshare')  # tempshare | local | s3
+ARCHIVE_TTL = int(os.environ.get('ARCHIVE_TTL', str(7 * 24 * 3600)))
+LOCAL_STORAGE_DIR = Path(os.environ.get('LOCAL_STORAGE_DIR', '/tmp/vk_archives'))
+LOCAL_STORAGE_ACCEL_PREFIX = os.environ.get('LOCAL_STORAGE_ACCEL_PREFIX', '')  # nginx internal location
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', '')
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_REGION = os.environ.get('S3_REGION', 'us-east-1')
+S3_PREFIX = os.environ.get('S3_PREFIX', 'archives/')
+CHUNK_SIZE_LIMIT = 1 * 1024 * 1024 * 1024  # 1GB - FIX BUG #2: chunk threshold (upper bound, see DiskBudget)
+CHUNK_MIN_SIZE = 64 * 1024 * 1024
+DISK_BUDGET = int(os.environ.get('DISK_BUDGET_MB', '0')) * 1024 * 1024  # 0 = derive from free space
+DISK_HEADROOM = int(os.environ.get('DISK_HEADROOM_MB', '512')) * 1024 * 1024
+DISK_WAIT_INTERVAL = 2.0
+MEMORY_BUDGET = int(os.environ.get('MEMORY_BUDGET_MB', '256')) * 1024 * 1024  # 0 = always download to disk
+MEMORY_JOB_MAX = int(os.environ.get('MEMORY_JOB_MAX_MB', '64')) * 1024 * 1024  # largest job kept in memory
+DISK_JANITOR_INTERVAL = int(os.environ.get('DISK_JANITOR_INTERVAL', '600'))
+ORPHAN_MIN_AGE = int(os.environ.get('ORPHAN_MIN_AGE', '1800'))
+CONCURRENT_DOWNLOADS = 8  # initial per-egress limit, adapted at runtime
+CONCURRENCY_MIN = 2
+CONCURRENCY_MAX = int(os.environ.get('CONCURRENCY_MAX', '32'))
+CONCURRENCY_WINDOW = 1.0  # seconds between limit adjustments
+CONCURRENCY_ERROR_RATE = 0.1
+CONCURRENCY_HISTORY_SIZE = 50
+HTTP_POOL_LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', '200'))  # connections per egress
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', str(CONCURRENCY_MAX + 8)))
+HTTP_DNS_TTL = 300
+HTTP_KEEPALIVE = 30
+HTTP_POOL_IDLE = 300  # close proxy pools unused for this long
+READ_CHUNK_SIZE = 256 * 1024
+PART_PIPELINES = int(os.environ.get('PART_PIPELINES', str(max(2, min(4, os.cpu_count() or 2)))))
+QUALITY_BITRATES = {"high": 320, "medium": 256, "low": 128}  # kbps
+TAG_OVERHEAD = 64 * 1024  # cover + lyrics + frames per tagged track
+PLAN_FILL_RATIO = 0.9  # headroom for estimate error when filling a part
+PLAN_HEAD_SAMPLE = int(os.environ.get('PLAN_HEAD_SAMPLE', '32'))  # tracks HEAD-probed to calibrate estimates
+PLAN_HEAD_CONCURRENCY = 8
+TRANSCODER_BIN = os.environ.get('TRANSCODER_BIN') or shutil.which('ffmpeg') or shutil.which('lame') or ''
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', str(os.cpu_count() or 1)))
+TRANSCODE_TOLERANCE = 1.1  # sources up to 10% above the target bitrate are kept as is
+XRAY_READY_TIMEOUT = 5.0
+PROXY_CHECK_CONCURRENCY = 8
+PROXY_HEALTH_INTERVAL = int(os.environ.get('PROXY_HEALTH_INTERVAL', '300'))
+PROXY_HISTORY_SIZE = 20
+PROXY_FAILOVER = os.environ.get('PROXY_FAILOVER', '1') != '0'  # switch off a proxy that fails its health check
+URL_RESOLVE_BATCH = 100  # audio.getById limit
+URL_RESOLVE_COALESCE = 0.1  # seconds expired links wait to share one audio.getById call
+VK_THROTTLE_CODES = (6, 9, 29)  # too many requests / flood control / rate limit
+VK_THROTTLE_RETRIES = 4
+VK_THROTTLE_BACKOFF = 0.5  # doubled per retry
+FAILED_TRACKS_MAX = 50  # failed track names kept per task
+PLAYLIST_CACHE_TTL = 120
+PLAYLIST_CACHE_MAX = 64
+ACTIVE_STATUSES = ["pending", "downloading", "zipping", "uploading", "cancelling"]
+TRACE_MAX_EVENTS = 20000  # per task
+TRACE_MAX_LIVE = 256
+TRACE_RETENTION = 7 * 24 * 3600
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_WINDOW = 3000  # samples kept for percentiles (~5 min)
+LOOP_STALL_THRESHOLD = float(os.environ.get('LOOP_STALL_THRESHOLD_MS', '250')) / 1000
+LOOP_STALL_HISTORY = 50
+STREAM_WINDOW = 4  # tracks fetched ahead of the one being streamed
+STREAM_OPEN_TTL = 15 * 60  # seconds a created stream task waits for its GET
+
+# Destination categories for split routing: only categories listed in
+# PROXIED_ROUTES go through the active proxy, everything else goes direct.
+ROUTE_HOSTS = [
+    ("vk_api", ("api.vk.com", "api.vk.ru")),
+    ("audio_cdn", ("vkuseraudio.net", "vkuseraudio.com", "vk-cdn.net")),
+    ("cover", ("userapi.com", "vkuserphoto.ru")),
+    ("upload", ("tempshare.su",)),
+]
+PROXIED_ROUTES = {r.strip() for r in os.environ.get('PROXIED_ROUTES', 'vk_api,audio_cdn').split(',') if r.strip()}
 
 
 # ==================== MODELS ====================
@@ -73,6 +191,7 @@ class PlaylistDownloadRequest(BaseModel):
     add_tags: bool = False
     add_lyrics: bool = False
     quality: str = "high"
+    sync: bool = False
 
 class MultiPlaylistDownloadRequest(BaseModel):
     session_id: str
@@ -80,6 +199,8 @@ class MultiPlaylistDownloadRequest(BaseModel):
     add_tags: bool = False
     add_lyrics: bool = False
     quality: str = "high"
+    merged: bool = False
+    merged_layout: str = "combined"  # combined (one archive, folder per playlist) / per_playlist
 
 class TrackDownloadRequest(BaseModel):
     session_id: str
@@ -88,11 +209,26 @@ class TrackDownloadRequest(BaseModel):
     add_lyrics: bool = False
     quality: str = "high"
 
+class StreamDownloadRequest(BaseModel):
+    session_id: str
+    playlist_url: str = ""  # empty = "My music"
+    add_tags: bool = False
+    add_lyrics: bool = False
+    quality: str = "high"
+
+class EstimateRequest(BaseModel):
+    session_id: str
+    playlist_url: str = ""  # empty = "My music"
+    quality: str = "high"
+    add_tags: bool = False
+    refine: bool = False  # HEAD a sample of tracks for real sizes
+
 class MyMusicDownloadRequest(BaseModel):
     session_id: str
     add_tags: bool = False
     add_lyrics: bool = False
     quality: str = "high"
+    sync: bool = False
 
 class DownloadHistoryItem(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -112,6 +248,15 @@ class DownloadHistoryItem(BaseModel):
     completed_at: str = ""
     file_size: str = ""
     download_type: str = "playlist"
+    sync: bool = False
+    concurrency: int = 0
+    concurrency_history: List[dict] = []
+    skipped_count: int = 0
+    cancel_requested: bool = False
+    planned_parts: int = 0
+    estimated_size: str = ""
+    failed_count: int = 0
+    failed_tracks: List[str] = []
 
 class ProxyAddRequest(BaseModel):
     proxy_type: str = Field(..., description="http, socks5, vless")
@@ -123,6 +268,457 @@ class ProxyUpdateRequest(BaseModel):
     name: Optional[str] = None
 
 
+# ==================== METRICS ====================
+
+# Minimal in-process registry rendered in the Prometheus text format.
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        metrics_registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labels, key)) + list(extra or [])
+        if not pairs:
+            return ""
+        escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def clear(self):
+        self.values.clear()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                state["counts"][idx] += 1
+        state["sum"] += value
+        state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, state in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, state["counts"]):
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', str(bound))])} {count}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', '+Inf')])} {state['count']}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {state['sum']}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {state['count']}")
+        return lines
+
+
+metrics_registry: List[Metric] = []
+
+VK_API_CALLS = Counter("vk_api_calls_total", "VK API calls by method and result", ("method", "result"))
+VK_API_LATENCY = Histogram("vk_api_latency_seconds", "VK API call latency", ("method",))
+TRACK_DOWNLOADS = Counter("track_downloads_total", "Track downloads by result and egress", ("result", "proxy"))
+TRACK_DOWNLOAD_BYTES = Counter("track_download_bytes_total", "Bytes downloaded from the audio CDN", ("proxy",))
+TRACK_DOWNLOAD_SECONDS = Histogram("track_download_seconds", "Single track download duration", ("proxy",))
+TRANSCODE_SECONDS = Histogram("transcode_seconds", "Track re-encode duration",
+                              buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+TRANSCODES = Counter("transcodes_total", "Tracks by transcoding outcome", ("result",))
+TRANSCODE_SAVED_BYTES = Counter("transcode_saved_bytes_total", "Bytes removed from archives by re-encoding")
+TAG_SECONDS = Histogram("tag_write_seconds", "ID3 tag write duration", buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+ZIP_SECONDS = Histogram("zip_create_seconds", "Archive part creation duration")
+SPLIT_SECONDS = Histogram("zip_split_seconds", "split_zip_files duration")
+UPLOAD_SECONDS = Histogram("upload_seconds", "Archive upload duration", ("backend", "result"),
+                           buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+UPLOAD_BYTES = Counter("upload_bytes_total", "Archive bytes uploaded", ("backend",))
+SEMAPHORE_WAIT_SECONDS = Histogram("download_semaphore_wait_seconds", "Time spent waiting for a download slot")
+CONCURRENCY_LIMIT = Gauge("download_concurrency_limit", "Adaptive download concurrency limit", ("proxy",))
+CONCURRENCY_IN_FLIGHT = Gauge("download_in_flight", "Track downloads in flight", ("proxy",))
+CONCURRENCY_ADJUSTMENTS = Counter("download_concurrency_adjustments_total", "Concurrency limit changes",
+                                  ("proxy", "reason"))
+ACTIVE_TASKS = Gauge("active_tasks", "Download tasks by status", ("status",))
+DOWNLOAD_DIR_BYTES = Gauge("download_dir_bytes", "Disk usage of DOWNLOAD_DIR")
+DISK_BUDGET_BYTES = Gauge("disk_budget_bytes", "Disk budget for DOWNLOAD_DIR")
+DISK_RESERVED_BYTES = Gauge("disk_reserved_bytes", "Disk space reserved by running chunks")
+DISK_WAITING_TASKS = Gauge("disk_waiting_tasks", "Tasks paused until disk budget frees up")
+MEMORY_RESERVED_BYTES = Gauge("memory_budget_reserved_bytes", "Memory reserved by in-memory jobs")
+MEMORY_JOBS = Counter("memory_path_jobs_total", "Small jobs by buffering: memory or disk (budget taken)", ("mode",))
+MEMORY_SPILLED_TRACKS = Counter("memory_spilled_tracks_total", "Tracks of in-memory jobs written to disk")
+JANITOR_RECLAIMED_BYTES = Counter("janitor_reclaimed_bytes_total", "Bytes reclaimed from orphaned task files")
+LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "Event loop scheduling delay",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+LOOP_LAG_QUANTILES = Gauge("event_loop_lag_quantile_seconds", "Event loop lag over the recent window", ("quantile",))
+LOOP_STALLS = Counter("event_loop_stalls_total", "Event loop stalls longer than LOOP_STALL_THRESHOLD_MS")
+HTTP_CONNECTIONS = Counter("http_connections_total", "Pooled HTTP requests by connection: new or reused keep-alive",
+                           ("egress", "kind"))
+HTTP_REUSE_RATIO = Gauge("http_connection_reuse_ratio", "Share of pooled HTTP requests on a reused connection",
+                         ("egress",))
+HTTP_POOL_OPEN = Gauge("http_pool_connections", "Open connections in the shared HTTP pool", ("egress",))
+
+
+async def collect_metrics():
+    ACTIVE_TASKS.clear()
+    try:
+        counts = await db.download_history.aggregate([
+            {"$match": {"status": {"$in": ACTIVE_STATUSES}}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+        ]).to_list(None)
+        for status in ACTIVE_STATUSES:
+            ACTIVE_TASKS.set(0, status=status)
+        for row in counts:
+            ACTIVE_TASKS.set(row["count"], status=row["_id"])
+    except Exception as e:
+        logger.error(f"Metrics: failed to count tasks: {e}")
+    for quantile, value in loop_monitor.percentiles().items():
+        LOOP_LAG_QUANTILES.set(value, quantile=quantile)
+    DISK_BUDGET_BYTES.set(disk_budget.capacity)
+    DISK_RESERVED_BYTES.set(disk_budget.reserved())
+    DISK_WAITING_TASKS.set(len(disk_budget.waiting))
+    MEMORY_RESERVED_BYTES.set(memory_budget.reserved())
+    connections = defaultdict(dict)
+    for (egress, kind), count in HTTP_CONNECTIONS.values.items():
+        connections[egress][kind] = count
+    for egress, kinds in connections.items():
+        total = kinds.get("new", 0) + kinds.get("reused", 0)
+        HTTP_REUSE_RATIO.set(round(kinds.get("reused", 0) / total, 4) if total else 0, egress=egress)
+    HTTP_POOL_OPEN.clear()
+    for pool in http_pools.values():
+        HTTP_POOL_OPEN.set(pool.open_connections(), egress=pool.label)
+    loop = asyncio.get_running_loop()
+    DOWNLOAD_DIR_BYTES.set(await loop.run_in_executor(None, get_dir_size, DOWNLOAD_DIR))
+
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ==================== TRACING ====================
+
+# Per-task span recorder. The task id travels in a context variable, so
+# spans opened anywhere below a traced task (including gathered per-track
+# coroutines) land in that task's trace. Events are kept in the Chrome
+# trace-event format ("X" complete events, microseconds from task start).
+current_trace_id: ContextVar[Optional[str]] = ContextVar("current_trace_id", default=None)
+live_traces: Dict[str, dict] = {}
+
+
+def start_trace(task_id):
+    current_trace_id.set(task_id)
+    if task_id not in live_traces:
+        while len(live_traces) >= TRACE_MAX_LIVE:
+            del live_traces[next(iter(live_traces))]
+        live_traces[task_id] = {"origin": time.time(), "events": [], "lanes": 0, "held": {}, "free": [],
+                                "dropped": 0}
+
+
+# Lanes map to Chrome "threads". A coroutine holds a lane while it has open
+# spans and gives it back afterwards, so per-track coroutines reuse a few
+# lanes instead of getting one each and spans in a lane always nest.
+def acquire_lane(trace):
+    try:
+        owner = id(asyncio.current_task())
+    except RuntimeError:
+        owner = 0
+    held = trace["held"].get(owner)
+    if held is None:
+        lane = heapq.heappop(trace["free"]) if trace["free"] else trace["lanes"] + 1
+        trace["lanes"] = max(trace["lanes"], lane)
+        held = trace["held"][owner] = [lane, 0]
+    held[1] += 1
+    return owner, held[0]
+
+
+def release_lane(trace, owner):
+    held = trace["held"][owner]
+    held[1] -= 1
+    if held[1] == 0:
+        del trace["held"][owner]
+        heapq.heappush(trace["free"], held[0])
+
+
+@contextmanager
+def trace_span(name, cat, **args):
+    trace = live_traces.get(current_trace_id.get() or "")
+    if trace is None:
+        yield args
+        return
+    owner, lane = acquire_lane(trace)
+    started = time.time()
+    try:
+        yield args
+    finally:
+        release_lane(trace, owner)
+        if len(trace["events"]) < TRACE_MAX_EVENTS:
+            trace["events"].append({
+                "name": name, "cat": cat, "ph": "X", "pid": 1, "tid": lane,
+                "ts": int((started - trace["origin"]) * 1e6), "dur": int((time.time() - started) * 1e6),
+                "args": args,
+            })
+        else:
+            trace["dropped"] += 1
+
+
+async def finish_trace(task_id):
+    trace = live_traces.pop(task_id, None)
+    if trace is None:
+        return
+    try:
+        await db.task_traces.update_one({"task_id": task_id}, {"$set": {
+            "origin": trace["origin"], "events": trace["events"], "lanes": trace["lanes"],
+            "dropped": trace["dropped"], "created_at": datetime.now(timezone.utc),
+        }}, upsert=True)
+    except Exception as e:
+        logger.error(f"Failed to store trace for {task_id}: {e}")
+
+
+def to_chrome_trace(task_id, trace):
+    meta = [{"name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": f"task {task_id}"}}]
+    for lane in range(1, trace["lanes"] + 1):
+        meta.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": lane,
+                     "args": {"name": "task" if lane == 1 else f"worker {lane - 1}"}})
+    return {
+        "traceEvents": meta + sorted(trace["events"], key=lambda e: e["ts"]),
+        "displayTimeUnit": "ms",
+        "otherData": {"task_id": task_id, "started_at": datetime.fromtimestamp(trace["origin"], timezone.utc).isoformat(),
+                      "dropped_events": trace.get("dropped", 0), "live": "held" in trace},
+    }
+
+
+# ==================== LOOP MONITOR ====================
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+# Measures event-loop scheduling delay with a periodic sleep. A watchdog
+# thread checks the loop's heartbeat and, once the loop has not ticked for
+# LOOP_STALL_THRESHOLD, snapshots the loop thread's stack while the
+# blocking call is still on it.
+class LoopMonitor:
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = deque(maxlen=LOOP_LAG_WINDOW)
+        self.stalls = deque(maxlen=LOOP_STALL_HISTORY)
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.pending_stall = None
+        self._stop_event = threading.Event()
+
+    async def run(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stop_event.clear()
+        if self.threshold > 0:
+            threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag = max(0.0, now - expected)
+                self.heartbeat = now
+                self.samples.append(lag)
+                LOOP_LAG_SECONDS.observe(lag)
+                stall = self.pending_stall
+                if stall is not None:
+                    self.pending_stall = None
+                    stall["lag_ms"] = round(lag * 1000, 1)
+                    logger.warning(f"Event loop blocked for {stall['lag_ms']} ms:\n{stall['stack']}")
+        finally:
+            self._stop_event.set()
+
+    def _watch(self):
+        reported = None
+        while not self._stop_event.wait(min(self.interval, self.threshold / 2)):
+            beat = self.heartbeat
+            stalled_for = time.monotonic() - beat - self.interval
+            if stalled_for < self.threshold or reported == beat:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            stall = {"at": datetime.now(timezone.utc).isoformat(), "lag_ms": round(stalled_for * 1000, 1),
+                     "stack": stack}
+            self.stalls.append(stall)
+            self.pending_stall = stall
+            LOOP_STALLS.inc()
+
+    def percentiles(self):
+        samples = list(self.samples)
+        return {q: round(percentile(samples, float(q) * 100), 6) for q in ("0.5", "0.9", "0.99", "1")}
+
+
+loop_monitor = LoopMonitor()
+
+
+# ==================== COORDINATION ====================
+
+# Mutex shared by every worker, backed by a lease in the locks collection.
+# The holder renews the lease every ttl/3 seconds; a lease left behind by a
+# crashed worker expires after ttl and can be taken over. The asyncio.Lock
+# in front keeps coroutines of one worker from polling Mongo for it.
+class MongoLock:
+    def __init__(self, name, ttl=LOCK_TTL, poll_interval=0.1):
+        self.name = name
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._local = asyncio.Lock()
+        self._renewer = None
+        self.lost = False
+
+    async def _claim(self):
+        now = datetime.now(timezone.utc)
+        try:
+            await db.locks.update_one(
+                {"_id": self.name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=self.ttl)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self._claim():
+                    self.lost = True
+                    logger.error(f"Lost lock {self.name}")
+            except Exception as e:
+                logger.warning(f"Lock {self.name} renewal failed: {e}")
+
+    def locked(self):
+        return self._local.locked()
+
+    async def acquire(self):
+        await self._local.acquire()
+        try:
+            while not await self._claim():
+                await asyncio.sleep(self.poll_interval)
+        except BaseException:
+            self._local.release()
+            raise
+        self.lost = False
+        self._renewer = asyncio.create_task(self._renew())
+
+    # Single attempt: False if another worker (or coroutine) holds the lock.
+    async def try_acquire(self):
+        if self._local.locked():
+            return False
+        await self._local.acquire()
+        try:
+            claimed = await self._claim()
+        except BaseException:
+            self._local.release()
+            raise
+        if not claimed:
+            self._local.release()
+            return False
+        self.lost = False
+        self._renewer = asyncio.create_task(self._renew())
+        return True
+
+    async def release(self):
+        self._renewer.cancel()
+        self._renewer = None
+        try:
+            await db.locks.delete_one({"_id": self.name, "owner": WORKER_ID})
+        finally:
+            self._local.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+
+# Leader election for periodic jobs that must run on one worker (or one
+# worker per host): the first worker to take the lease keeps it, renewing
+# it like any MongoLock, and the others skip their turn. If the leader dies,
+# its lease expires after LOCK_TTL and the next worker to tick takes over.
+async def is_leader(lease):
+    if lease.locked() and lease.lost:
+        await lease.release()
+    return lease.locked() or await lease.try_acquire()
+
+
+async def release_lease(lease):
+    if lease.locked():
+        await lease.release()
+
+
+# Every worker publishes the tasks it is running, so per-host housekeeping
+# (disk budget, janitor) can tell live work from leftovers of a crashed
+# worker.
+async def publish_heartbeat():
+    await db.workers.update_one({"_id": WORKER_ID}, {"$set": {
+        "host": HOST_ID, "tasks": sorted(engine_tasks), "seen_at": datetime.now(timezone.utc),
+    }}, upsert=True)
+
+
+async def worker_heartbeat_loop():
+    while True:
+        try:
+            await publish_heartbeat()
+        except Exception as e:
+            logger.error(f"Worker heartbeat error: {e}")
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+
+async def live_workers(host=HOST_ID):
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=WORKER_TTL)
+    return await db.workers.find({"host": host, "seen_at": {"$gt": cutoff}}, {"_id": 1, "tasks": 1}).to_list(None)
+
+
 # ==================== VLESS PARSING ====================
 
 def parse_vless_uri(uri: str) -> dict:
@@ -160,7 +756,7 @@ def parse_vless_uri(uri: str) -> dict:
     }
 
 
-def generate_xray_config(vless_params: dict, local_port: int) -> dict:
+def build_vless_outbound(vless_params: dict, tag: str) -> dict:
     stream_settings = {"network": vless_params["type"]}
     transport_type = vless_params["type"]
     if transport_type == "ws":
@@ -200,23 +796,43 @@ def generate_xray_config(vless_params: dict, local_port: int) -> dict:
     if vless_params.get("flow"):
         vless_user["flow"] = vless_params["flow"]
 
+    return {"tag": tag, "protocol": "vless",
+            "settings": {"vnext": [{"address": vless_params["host"], "port": vless_params["port"], "users": [vless_user]}]},
+            "streamSettings": stream_settings}
+
+
+def build_socks_inbound(local_port: int, tag: str) -> dict:
+    return {"tag": tag, "port": local_port, "listen": "127.0.0.1",
+            "protocol": "socks", "settings": {"auth": "noauth", "udp": True},
+            "sniffing": {"enabled": True, "destOverride": ["http", "tls"]}}
+
+
+def build_inbound_rule(proxy_id: str) -> dict:
+    return {"ruleTag": f"rule-{proxy_id}", "type": "field",
+            "inboundTag": [f"in-{proxy_id}"], "outboundTag": f"out-{proxy_id}"}
+
+
+# One Xray process hosts every VLESS proxy: each proxy gets its own SOCKS
+# inbound routed to its own outbound, so ports stay independent.
+def generate_xray_config(entries: Dict[str, dict], api_port: int) -> dict:
+    inbounds = [{"tag": "api", "listen": "127.0.0.1", "port": api_port,
+                 "protocol": "dokodemo-door", "settings": {"address": "127.0.0.1"}}]
+    outbounds = [{"tag": "direct", "protocol": "freedom"}]
+    rules = [{"type": "field", "inboundTag": ["api"], "outboundTag": "api"}]
+    for proxy_id, entry in entries.items():
+        inbounds.append(build_socks_inbound(entry["port"], f"in-{proxy_id}"))
+        outbounds.append(build_vless_outbound(entry["params"], f"out-{proxy_id}"))
+        rules.append(build_inbound_rule(proxy_id))
     return {
         "log": {"loglevel": "warning"},
-        "inbounds": [{"tag": "socks-in", "port": local_port, "listen": "127.0.0.1",
-                       "protocol": "socks", "settings": {"auth": "noauth", "udp": True},
-                       "sniffing": {"enabled": True, "destOverride": ["http", "tls"]}}],
-        "outbounds": [
-            {"tag": "proxy", "protocol": "vless",
-             "settings": {"vnext": [{"address": vless_params["host"], "port": vless_params["port"], "users": [vless_user]}]},
-             "streamSettings": stream_settings},
-            {"tag": "direct", "protocol": "freedom"}
-        ],
-        "routing": {"domainStrategy": "AsIs", "rules": []}
+        "api": {"tag": "api", "services": ["HandlerService", "RoutingService"]},
+        "inbounds": inbounds,
+        "outbounds": outbounds,
+        "routing": {"domainStrategy": "AsIs", "rules": rules}
     }
 
 
 def find_free_port():
-    import socket
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind(('127.0.0.1', 0))
         return s.getsockname()[1]
@@ -237,57 +853,245 @@ def check_xray_available():
         )
 
 
-async def start_xray_for_proxy(proxy_id: str, vless_uri: str) -> dict:
-    await stop_xray_for_proxy(proxy_id)
+async def wait_for_port(port, pid=None, timeout=XRAY_READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if pid is not None and not xray_pid_alive(pid):
+            return False
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            await writer.wait_closed()
+            return True
+        except OSError:
+            await asyncio.sleep(0.05)
+    return False
+
+
+# The Xray process may have been started by another worker, so it is
+# tracked by pid; the cmdline check guards against a recycled pid after a
+# reboot (a reaped zombie has an empty cmdline too).
+def xray_pid_alive(pid):
+    if not pid:
+        return False
+    if os.path.isdir("/proc"):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                return b"xray" in f.read()
+        except OSError:
+            return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def xray_running():
+    return xray_pid_alive(xray_instance.get("pid"))
+
+
+# Every worker on a host shares one Xray instance. Its pid, API port and
+# inbounds live in db.xray_state; changes happen under xray_lock, readers
+# refresh their copy at most every XRAY_STATE_TTL seconds.
+xray_lock = MongoLock(f"xray:{HOST_ID}")
+
+
+async def load_xray_state():
+    global xray_state_loaded_at
+    doc = await db.xray_state.find_one({"_id": HOST_ID}) or {}
+    xray_instance.clear()
+    xray_instance.update(doc.get("instance") or {})
+    xray_processes.clear()
+    xray_processes.update(doc.get("inbounds") or {})
+    xray_state_loaded_at = time.monotonic()
+
+
+async def save_xray_state():
+    await db.xray_state.update_one({"_id": HOST_ID}, {"$set": {
+        "instance": dict(xray_instance), "inbounds": dict(xray_processes),
+        "updated_by": WORKER_ID, "updated_at": datetime.now(timezone.utc).isoformat(),
+    }}, upsert=True)
+
+
+async def refresh_xray_state():
+    if xray_lock.locked() or time.monotonic() - xray_state_loaded_at < XRAY_STATE_TTL:
+        return
+    await load_xray_state()
+
+
+@asynccontextmanager
+async def locked_xray_state():
+    async with xray_lock:
+        await load_xray_state()
+        try:
+            yield
+        finally:
+            await save_xray_state()
+
+
+# xray api parses its flags with Go's flag package, which stops at the first
+# positional argument: --server and the command's flags go before the
+# files/tags.
+def xray_api_command(command, *args, flags=()):
+    return [XRAY_BIN, "api", command, f"--server=127.0.0.1:{xray_instance['api_port']}", *flags, *args]
+
+
+async def run_xray_api(command, *args, flags=()):
+    process = await asyncio.create_subprocess_exec(
+        *xray_api_command(command, *args, flags=flags),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise Exception(f"xray api {command}: {(stderr or stdout).decode('utf-8', errors='replace')[:300]}")
+
+
+async def run_xray_api_with_config(command, config, *flags):
+    config_path = XRAY_CONFIG_DIR / f"api_{uuid.uuid4().hex[:8]}.json"
+    async with aiofiles.open(config_path, 'w') as f:
+        await f.write(json.dumps(config))
     try:
-        # FIX BUG #3: Check xray exists before attempting to run
-        check_xray_available()
-
-        vless_params = parse_vless_uri(vless_uri)
-        local_port = find_free_port()
-        config = generate_xray_config(vless_params, local_port)
-        config_path = XRAY_CONFIG_DIR / f"{proxy_id}.json"
-        with open(config_path, 'w') as f:
-            json.dump(config, f, indent=2)
-        process = subprocess.Popen(
-            [XRAY_BIN, "run", "-c", str(config_path)],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid
+        await run_xray_api(command, str(config_path), flags=flags)
+    finally:
+        config_path.unlink(missing_ok=True)
+
+
+async def kill_xray_instance():
+    pid = xray_instance.get("pid")
+    if xray_pid_alive(pid):
+        try:
+            os.killpg(os.getpgid(pid), signal.SIGTERM)
+            deadline = time.monotonic() + 5
+            while xray_pid_alive(pid) and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            if xray_pid_alive(pid):
+                os.killpg(os.getpgid(pid), signal.SIGKILL)
+        except Exception:
+            pass
+    config_path = xray_instance.get("config_path")
+    if config_path and os.path.exists(config_path):
+        os.remove(config_path)
+    xray_instance.clear()
+
+
+async def restart_xray_instance():
+    await kill_xray_instance()
+    if not xray_processes:
+        return
+    api_port = find_free_port()
+    config = generate_xray_config(xray_processes, api_port)
+    config_path = XRAY_CONFIG_DIR / "xray.json"
+    async with aiofiles.open(config_path, 'w') as f:
+        await f.write(json.dumps(config, indent=2))
+    log_path = XRAY_CONFIG_DIR / "xray.log"
+    with open(log_path, 'wb') as log_file:
+        process = await asyncio.create_subprocess_exec(
+            XRAY_BIN, "run", "-c", str(config_path),
+            stdout=asyncio.subprocess.DEVNULL, stderr=log_file, start_new_session=True
         )
-        await asyncio.sleep(1.5)
-        if process.poll() is not None:
-            stderr_output = process.stderr.read().decode('utf-8', errors='replace')[:500]
-            raise Exception(f"Xray exited: {stderr_output}")
-        xray_processes[proxy_id] = {
-            "process": process, "port": local_port,
-            "config_path": str(config_path), "started_at": datetime.now(timezone.utc).isoformat()
-        }
-        logger.info(f"Xray started for proxy {proxy_id} on port {local_port}")
-        return {"port": local_port, "status": "running"}
-    except (FileNotFoundError, PermissionError) as e:
-        logger.error(f"Xray not available for {proxy_id}: {e}")
-        raise
+    xray_instance.update({
+        "pid": process.pid, "api_port": api_port, "config_path": str(config_path),
+        "owner": WORKER_ID, "started_at": datetime.now(timezone.utc).isoformat()
+    })
+    if not await wait_for_port(api_port, process.pid):
+        stderr_output = ""
+        if process.returncode is not None and log_path.exists():
+            stderr_output = log_path.read_bytes().decode('utf-8', errors='replace')[:500]
+        await kill_xray_instance()
+        raise Exception(f"Xray exited: {stderr_output}" if stderr_output else "Xray did not become ready")
+    logger.info(f"Xray started with {len(xray_processes)} inbound(s), api port {api_port}")
+
+
+# Xray is shared by every worker on the host, so it is only stopped with
+# the last one. Otherwise a departing owner hands ownership to a live
+# worker and the others keep using Xray and its inbounds.
+async def stop_own_xray_instance():
+    async with locked_xray_state():
+        others = [w["_id"] for w in await live_workers() if w["_id"] != WORKER_ID]
+        if not others:
+            xray_processes.clear()
+            await kill_xray_instance()
+        elif xray_instance and xray_instance.get("owner") not in others:
+            xray_instance["owner"] = others[0]
+
+
+async def start_xray_for_proxy(proxy_id: str, vless_uri: str) -> dict:
+    async with locked_xray_state():
+        try:
+            # FIX BUG #3: Check xray exists before attempting to run
+            check_xray_available()
+
+            vless_params = parse_vless_uri(vless_uri)
+            existing = xray_processes.get(proxy_id)
+            if existing and existing["uri"] == vless_uri and xray_running():
+                return {"port": existing["port"], "status": "running"}
+            if existing and xray_running():
+                await remove_xray_inbound(proxy_id)
+            xray_processes.pop(proxy_id, None)
+
+            local_port = find_free_port()
+            xray_processes[proxy_id] = {
+                "port": local_port, "uri": vless_uri, "params": vless_params,
+                "started_at": datetime.now(timezone.utc).isoformat()
+            }
+            if xray_running():
+                try:
+                    await run_xray_api_with_config("ado", {"outbounds": [build_vless_outbound(vless_params, f"out-{proxy_id}")]})
+                    await run_xray_api_with_config("adi", {"inbounds": [build_socks_inbound(local_port, f"in-{proxy_id}")]})
+                    await run_xray_api_with_config("adrules", {"routing": {"rules": [build_inbound_rule(proxy_id)]}}, "-append")
+                except Exception as e:
+                    logger.warning(f"Xray hot reconfig failed, restarting instance: {e}")
+                    await restart_xray_instance()
+            else:
+                await restart_xray_instance()
+
+            if not await wait_for_port(local_port, xray_instance.get("pid")):
+                raise Exception(f"Xray inbound on port {local_port} did not become ready")
+            logger.info(f"Xray inbound for proxy {proxy_id} on port {local_port}")
+            return {"port": local_port, "status": "running"}
+        except (FileNotFoundError, PermissionError) as e:
+            xray_processes.pop(proxy_id, None)
+            logger.error(f"Xray not available for {proxy_id}: {e}")
+            raise
+        except Exception as e:
+            xray_processes.pop(proxy_id, None)
+            logger.error(f"Failed to start xray for {proxy_id}: {e}")
+            raise
+
+
+async def remove_xray_inbound(proxy_id: str):
+    try:
+        await run_xray_api("rmrules", f"rule-{proxy_id}")
+        await run_xray_api("rmi", f"in-{proxy_id}")
+        await run_xray_api("rmo", f"out-{proxy_id}")
     except Exception as e:
-        logger.error(f"Failed to start xray for {proxy_id}: {e}")
-        raise
+        logger.warning(f"Xray hot removal failed for {proxy_id}, restarting instance: {e}")
+        xray_processes.pop(proxy_id, None)
+        await restart_xray_instance()
 
 
 async def stop_xray_for_proxy(proxy_id: str):
-    if proxy_id in xray_processes:
-        proc_info = xray_processes[proxy_id]
-        process = proc_info.get("process")
-        if process and process.poll() is None:
-            try:
-                os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-                process.wait(timeout=5)
-            except Exception:
-                try:
-                    os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-                except Exception:
-                    pass
-        config_path = proc_info.get("config_path")
-        if config_path and os.path.exists(config_path):
-            os.remove(config_path)
-        del xray_processes[proxy_id]
+    async with locked_xray_state():
+        if proxy_id not in xray_processes:
+            return
+        if len(xray_processes) == 1 or not xray_running():
+            xray_processes.pop(proxy_id, None)
+            await kill_xray_instance()
+            if xray_processes:
+                await restart_xray_instance()
+            return
+        await remove_xray_inbound(proxy_id)
+        xray_processes.pop(proxy_id, None)
+
+
+async def fetch_external_ip(session, timeout=5):
+    try:
+        async with session.get("https://api.ipify.org?format=json", timeout=aiohttp.ClientTimeout(total=timeout)) as ip_resp:
+            ip_data = await ip_resp.json(content_type=None)
+            return ip_data.get("ip")
+    except Exception:
+        return None
 
 
 async def test_proxy_connectivity(proxy_url: str, timeout: int = 10) -> dict:
@@ -296,20 +1100,22 @@ async def test_proxy_connectivity(proxy_url: str, timeout: int = 10) -> dict:
         if ProxyConnector and proxy_url.startswith("socks5://"):
             connector = ProxyConnector.from_url(proxy_url)
             async with aiohttp.ClientSession(connector=connector) as session:
-                async with session.get(
-                    "https://api.vk.com/method/utils.getServerTime?v=5.131&access_token=",
-                    timeout=aiohttp.ClientTimeout(total=timeout)
-                ) as resp:
-                    data = await resp.json(content_type=None)
-                    latency = round((time.time() - start_time) * 1000)
-                    ip = None
-                    try:
-                        async with session.get("https://api.ipify.org?format=json", timeout=aiohttp.ClientTimeout(total=5)) as ip_resp:
-                            ip_data = await ip_resp.json(content_type=None)
-                            ip = ip_data.get("ip")
-                    except Exception:
-                        pass
-                    return {"success": True, "latency_ms": latency, "ip": ip, "vk_accessible": data is not None}
+                async def check_vk():
+                    async with session.get(
+                        "https://api.vk.com/method/utils.getServerTime?v=5.131&access_token=",
+                        timeout=aiohttp.ClientTimeout(total=timeout)
+                    ) as resp:
+                        data = await resp.json(content_type=None)
+                        return data, round((time.time() - start_time) * 1000)
+
+                ip_task = asyncio.ensure_future(fetch_external_ip(session))
+                try:
+                    data, latency = await check_vk()
+                except BaseException:
+                    ip_task.cancel()
+                    raise
+                ip = await ip_task
+                return {"success": True, "latency_ms": latency, "ip": ip, "vk_accessible": data is not None}
         else:
             async with aiohttp.ClientSession() as session:
                 kwargs = {"timeout": aiohttp.ClientTimeout(total=timeout)}
@@ -329,6 +1135,8 @@ async def test_proxy_connectivity(proxy_url: str, timeout: int = 10) -> dict:
 
 async def get_active_proxy():
     proxy = await db.proxies.find_one({"enabled": True}, {"_id": 0})
+    if proxy and proxy.get("proxy_type") == "vless":
+        await refresh_xray_state()
     return proxy
 
 def build_proxy_url(proxy_doc):
@@ -349,59 +1157,357 @@ def build_proxy_url(proxy_doc):
     return None
 
 
-def create_proxy_connector(proxy_url):
+def create_proxy_connector(proxy_url, **options):
     if proxy_url and ProxyConnector and proxy_url.startswith(("socks5://", "socks4://")):
-        return ProxyConnector.from_url(proxy_url)
+        return ProxyConnector.from_url(proxy_url, **options)
     return None
 
 
-async def make_vk_session(proxy_url=None):
-    connector = create_proxy_connector(proxy_url)
-    if connector:
-        return aiohttp.ClientSession(connector=connector), None
-    session = aiohttp.ClientSession()
-    http_proxy = proxy_url if proxy_url and proxy_url.startswith("http") else None
-    return session, http_proxy
+# ==================== ROUTING ====================
+
+# A route given by the caller wins: VK serves audio from userapi.com hosts
+# as well as covers, so only the caller knows what a request fetches.
+# Without one the request is classified by host.
+def classify_route(url, route=None):
+    if route:
+        return route
+    host = (urlparse(url).hostname or "").lower()
+    for name, suffixes in ROUTE_HOSTS:
+        for suffix in suffixes:
+            if host == suffix or host.endswith("." + suffix):
+                return name
+    return "other"
+
+
+def route_uses_proxy(url, route=None):
+    return classify_route(url, route) in PROXIED_ROUTES
+
+
+# One client session per egress (direct or a proxy URL) shared by every
+# task of the process, so keep-alive connections to the CDN hosts and
+# cached DNS answers survive between tasks. limit_per_host sits above
+# CONCURRENCY_MAX: the AIMD limiter decides the download concurrency, the
+# pool only caps runaway fan-out.
+class HttpPool:
+    def __init__(self, proxy_url=None, label="direct"):
+        self.proxy_url = proxy_url
+        self.label = label
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.loop = asyncio.get_running_loop()
+        self.http_proxy = proxy_url if proxy_url and proxy_url.startswith("http") else None
+        options = {"limit": HTTP_POOL_LIMIT, "limit_per_host": HTTP_POOL_LIMIT_PER_HOST,
+                   "ttl_dns_cache": HTTP_DNS_TTL, "keepalive_timeout": HTTP_KEEPALIVE}
+        connector = create_proxy_connector(proxy_url, **options) or aiohttp.TCPConnector(**options)
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_new)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config],
+                                             read_bufsize=READ_CHUNK_SIZE)
+
+    async def _on_connection_new(self, session, ctx, params):
+        HTTP_CONNECTIONS.inc(egress=self.label, kind="new")
+
+    async def _on_connection_reused(self, session, ctx, params):
+        HTTP_CONNECTIONS.inc(egress=self.label, kind="reused")
+
+    def open_connections(self):
+        connector = self.session.connector
+        if connector is None or connector.closed:
+            return 0
+        return sum(len(conns) for conns in connector._conns.values()) + len(connector._acquired)
+
+    def usable(self):
+        return not self.session.closed and self.loop is asyncio.get_running_loop()
+
+
+def get_http_pool(proxy_url=None, label="direct"):
+    key = proxy_url or ""
+    pool = http_pools.get(key)
+    if pool is None or not pool.usable():
+        pool = http_pools[key] = HttpPool(proxy_url, label)
+    return pool
+
+
+# Proxy pools are left behind when the active proxy changes; the direct
+# pool stays for the life of the process.
+async def close_idle_http_pools(max_idle=HTTP_POOL_IDLE):
+    now = time.monotonic()
+    for key, pool in list(http_pools.items()):
+        if key and pool.users == 0 and now - pool.last_used > max_idle:
+            del http_pools[key]
+            await pool.session.close()
+
+
+async def close_http_pools():
+    for pool in list(http_pools.values()):
+        if pool.usable():
+            await pool.session.close()
+    http_pools.clear()
+
+
+# Borrows up to two pooled sessions (proxied and direct) and picks one per
+# request based on the destination route. close() only returns them.
+class RoutedSession:
+    def __init__(self, proxy_url=None, proxy_id=None):
+        self.proxy_url = proxy_url
+        self.proxy_id = proxy_id
+        self._pools = {}
+
+    def egress_label(self, url, route=None):
+        if self.proxy_url and route_uses_proxy(url, route):
+            return self.proxy_id or "proxy"
+        return "direct"
+
+    def _pool_for(self, use_proxy):
+        key = "proxy" if use_proxy and self.proxy_url else "direct"
+        if key not in self._pools:
+            if key == "proxy":
+                pool = get_http_pool(self.proxy_url, self.proxy_id or "proxy")
+            else:
+                pool = get_http_pool()
+            pool.users += 1
+            self._pools[key] = pool
+        return self._pools[key]
+
+    def request(self, method, url, route=None, **kwargs):
+        pool = self._pool_for(route_uses_proxy(url, route))
+        pool.last_used = time.monotonic()
+        if pool.http_proxy:
+            kwargs["proxy"] = pool.http_proxy
+        return pool.session.request(method, url, **kwargs)
+
+    def get(self, url, route=None, **kwargs):
+        return self.request("GET", url, route=route, **kwargs)
+
+    def post(self, url, route=None, **kwargs):
+        return self.request("POST", url, route=route, **kwargs)
+
+    async def close(self):
+        for pool in self._pools.values():
+            pool.users -= 1
+            pool.last_used = time.monotonic()
+        self._pools.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def open_routed_session():
+    await close_idle_http_pools()
+    proxy_doc = await get_active_proxy()
+    proxy_url = build_proxy_url(proxy_doc) if proxy_doc else None
+    return RoutedSession(proxy_url, proxy_doc.get("id") if proxy_url else None)
 
 
-async def make_request_with_proxy(method, url, proxy_url=None, **kwargs):
+async def make_routed_request(method, url, route=None, **kwargs):
     headers = kwargs.pop("headers", {})
     headers.setdefault("User-Agent", KATE_USER_AGENT)
     kwargs["headers"] = headers
+    async with await open_routed_session() as session:
+        async with session.request(method, url, route=route, **kwargs) as resp:
+            return await resp.json(content_type=None)
+
+
+# ==================== PROXY HEALTH ====================
+
+# score = success rate * 1000 / (1 + average latency of successful checks
+# in seconds), over the last PROXY_HISTORY_SIZE checks. It is computed by the
+# same update that appends the check, so concurrent checks of one proxy
+# (background loop and check-all) cannot leave a score for a stale history.
+PROXY_SCORE_EXPR = {"$let": {
+    "vars": {"ok": {"$filter": {"input": "$check_history", "cond": "$$this.success"}}},
+    "in": {"$cond": [
+        {"$eq": [{"$size": "$$ok"}, 0]},
+        0.0,
+        {"$round": [{"$divide": [
+            {"$multiply": [{"$divide": [{"$size": "$$ok"}, {"$size": "$check_history"}]}, 1000]},
+            {"$add": [1, {"$divide": [{"$avg": "$$ok.latency_ms"}, 1000]}]},
+        ]}, 1]},
+    ]},
+}}
+
+
+async def record_proxy_check(proxy, test_result):
+    proxy_id = proxy["id"]
+    entry = {
+        "at": datetime.now(timezone.utc).isoformat(),
+        "success": bool(test_result.get("success")),
+        "latency_ms": test_result.get("latency_ms", 0),
+    }
+    update = {"last_check": entry["at"]}
+    if test_result.get("success"):
+        status_msg = f"OK! Ping: {test_result['latency_ms']}ms"
+        if test_result.get("ip"):
+            status_msg += f" | IP: {test_result['ip']}"
+        update.update({"status": "ok", "status_message": status_msg,
+                       "check_ip": test_result.get("ip", ""), "check_latency": test_result.get("latency_ms", 0)})
+    else:
+        update.update({"status": "error", "status_message": test_result.get("error", "Connection failed"),
+                       "check_ip": "", "check_latency": 0})
+    doc = await db.proxies.find_one_and_update({"id": proxy_id}, [
+        {"$set": {"check_history": {"$slice": [
+            {"$concatArrays": [{"$ifNull": ["$check_history", []]}, [{"$literal": entry}]]},
+            -PROXY_HISTORY_SIZE,
+        ]}}},
+        {"$set": {**{k: {"$literal": v} for k, v in update.items()}, "score": PROXY_SCORE_EXPR}},
+    ], projection={"_id": 0, "score": 1}, return_document=ReturnDocument.AFTER)
+    update["score"] = doc.get("score", 0.0) if doc else 0.0
+    return update
+
+
+async def run_proxy_check(proxy):
+    proxy_id = proxy["id"]
+    if proxy.get("proxy_type") == "vless":
+        await refresh_xray_state()
+        if proxy.get("enabled") and proxy_id in xray_processes:
+            socks_url = f"socks5://127.0.0.1:{xray_processes[proxy_id]['port']}"
+            test_result = await test_proxy_connectivity(socks_url, timeout=10)
+        else:
+            temp_id = f"check_{proxy_id}"
+            try:
+                result = await start_xray_for_proxy(temp_id, proxy.get("address", ""))
+                socks_url = f"socks5://127.0.0.1:{result['port']}"
+                test_result = await test_proxy_connectivity(socks_url, timeout=10)
+            except Exception as e:
+                test_result = {"success": False, "error": f"Xray error: {str(e)[:200]}", "latency_ms": 0}
+            finally:
+                await stop_xray_for_proxy(temp_id)
+    else:
+        proxy_url = build_proxy_url(proxy)
+        if not proxy_url:
+            test_result = {"success": False, "error": "Unsupported type", "latency_ms": 0}
+        else:
+            test_result = await test_proxy_connectivity(proxy_url, timeout=10)
 
-    if proxy_url and proxy_url.startswith(("socks5://", "socks4://")) and ProxyConnector:
-        connector = ProxyConnector.from_url(proxy_url)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            if method == "GET":
-                async with session.get(url, **kwargs) as resp:
-                    return await resp.json(content_type=None)
-            else:
-                async with session.post(url, **kwargs) as resp:
-                    return await resp.json(content_type=None)
+    update = await record_proxy_check(proxy, test_result)
+    if test_result.get("success"):
+        return {"id": proxy_id, "status": "ok", "message": update["status_message"], "ip": test_result.get("ip"),
+                "latency_ms": test_result.get("latency_ms"), "score": update["score"]}
+    return {"id": proxy_id, "status": "error", "message": update["status_message"], "score": update["score"]}
+
+
+async def check_proxies_concurrently(proxies):
+    semaphore = asyncio.Semaphore(PROXY_CHECK_CONCURRENCY)
+
+    async def check_one(proxy):
+        async with semaphore:
+            try:
+                return await run_proxy_check(proxy)
+            except Exception as e:
+                logger.error(f"Proxy check error {proxy.get('id')}: {e}")
+                return {"id": proxy.get("id"), "status": "error", "message": str(e)[:200]}
+
+    return await asyncio.gather(*(check_one(p) for p in proxies))
+
+
+async def get_best_proxy(exclude=None):
+    query = {"status": "ok"}
+    if exclude:
+        query["id"] = {"$ne": exclude}
+    proxies = await db.proxies.find(query, {"_id": 0}).sort("score", -1).to_list(1)
+    return proxies[0] if proxies else None
+
+
+# Starts this proxy, then stops every other one and enables it. Returns an
+# error message if the proxy could not be started (VLESS), None on success;
+# on failure the previously enabled proxy is left running.
+async def activate_proxy(proxy):
+    proxy_id = proxy["id"]
+    update = {"enabled": True}
+    if proxy.get("proxy_type") == "vless":
+        try:
+            result = await start_xray_for_proxy(proxy_id, proxy["address"])
+        except Exception as e:
+            await db.proxies.update_one({"id": proxy_id}, {"$set": {"status": "error", "status_message": str(e)[:200]}})
+            return str(e)[:200]
+        update["status_message"] = f"Xray on port {result['port']}"
+    all_proxies = await db.proxies.find({"id": {"$ne": proxy_id}, "enabled": True}, {"_id": 0}).to_list(100)
+    for p in all_proxies:
+        await stop_xray_for_proxy(p["id"])
+    await db.proxies.update_many({"id": {"$ne": proxy_id}}, {"$set": {"enabled": False}})
+    await db.proxies.update_one({"id": proxy_id}, {"$set": update})
+    return None
+
+
+# When the enabled proxy fails its health check, traffic moves to the
+# healthy proxy with the best score. With no healthy alternative, or when
+# the alternative fails to start, the failed proxy stays enabled; nothing is
+# switched on when no proxy is enabled.
+async def fail_over_proxy(proxies, results):
+    active = next((p for p in proxies if p.get("enabled")), None)
+    if not active:
+        return
+    result = next((r for r in results if r.get("id") == active["id"]), None)
+    if not result or result.get("status") == "ok":
+        return
+    best = await get_best_proxy(exclude=active["id"])
+    if not best:
+        return
+    error = await activate_proxy(best)
+    if error:
+        logger.error(f"Proxy failover to {best['id']} failed: {error}")
     else:
-        async with aiohttp.ClientSession() as session:
-            req_kwargs = kwargs.copy()
-            if proxy_url and proxy_url.startswith("http"):
-                req_kwargs["proxy"] = proxy_url
-            if method == "GET":
-                async with session.get(url, **req_kwargs) as resp:
-                    return await resp.json(content_type=None)
-            else:
-                async with session.post(url, **req_kwargs) as resp:
-                    return await resp.json(content_type=None)
+        logger.warning(f"Proxy {active['id']} failed its health check, switched to {best['id']} "
+                       f"(score {best.get('score', 0.0)})")
+
+
+# Proxies are shared by every worker, so only the leader checks them.
+async def proxy_health_loop():
+    lease = MongoLock("leader:proxy_health")
+    try:
+        while True:
+            await asyncio.sleep(PROXY_HEALTH_INTERVAL)
+            try:
+                if not await is_leader(lease):
+                    continue
+                proxies = await db.proxies.find({}, {"_id": 0}).to_list(100)
+                if proxies:
+                    results = await check_proxies_concurrently(proxies)
+                    ok_count = sum(1 for r in results if r.get("status") == "ok")
+                    logger.info(f"Proxy health check: {ok_count}/{len(results)} OK")
+                    if PROXY_FAILOVER:
+                        await fail_over_proxy(proxies, results)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Proxy health loop error: {e}")
+    finally:
+        await release_lease(lease)
 
 
 # ==================== VK API ====================
 
-async def vk_api_method(token, method, **params):
+class VkApiError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+# With retries, throttled calls (VK_THROTTLE_CODES) are repeated with
+# exponential backoff before the error is raised.
+async def vk_api_method(token, method, retries=0, **params):
     params["access_token"] = token
     params["v"] = "5.131"
-    proxy_doc = await get_active_proxy()
-    proxy_url = build_proxy_url(proxy_doc) if proxy_doc else None
-    data = await make_request_with_proxy("GET", f"https://api.vk.com/method/{method}", proxy_url=proxy_url, params=params)
-    if "error" in data:
-        raise Exception(data["error"].get("error_msg", "VK API Error"))
-    return data.get("response", data)
+    for attempt in range(retries + 1):
+        try:
+            with VK_API_LATENCY.time(method=method), trace_span(method, "vk_api"):
+                data = await make_routed_request("GET", f"{VK_API_BASE}/{method}", route="vk_api", params=params)
+        except Exception:
+            VK_API_CALLS.inc(method=method, result="error")
+            raise
+        if "error" not in data:
+            VK_API_CALLS.inc(method=method, result="ok")
+            return data.get("response", data)
+        code = data["error"].get("error_code")
+        throttled = code in VK_THROTTLE_CODES
+        VK_API_CALLS.inc(method=method, result="throttled" if throttled else "error")
+        if not throttled or attempt == retries:
+            raise VkApiError(data["error"].get("error_msg", "VK API Error"), code)
+        await asyncio.sleep(VK_THROTTLE_BACKOFF * 2 ** attempt)
 
 
 async def get_user_info(token):
@@ -414,8 +1520,50 @@ async def get_user_info(token):
     return {"first_name": "VK", "last_name": "User", "photo_100": ""}
 
 
-async def get_all_audio(token, owner_id=None, album_id=None, access_key=None):
-    all_tracks = []
+# Compact per-track record: the engine only needs identity, display
+# fields, the lyrics id and one cover URL, not the full VK audio object
+# (ads, thumbs of every size, main_artists, ...).
+class TrackRecord:
+    __slots__ = ("owner_id", "id", "access_key", "artist", "title", "duration",
+                 "url", "lyrics_id", "album_title", "cover_url")
+
+    def __init__(self, owner_id, id, access_key=None, artist="Unknown", title="Unknown", duration=0,
+                 url=None, lyrics_id=None, album_title="", cover_url=None):
+        self.owner_id = owner_id
+        self.id = id
+        self.access_key = access_key
+        self.artist = artist
+        self.title = title
+        self.duration = duration
+        self.url = url
+        self.lyrics_id = lyrics_id
+        self.album_title = album_title
+        self.cover_url = cover_url
+
+    def copy(self):
+        clone = TrackRecord.__new__(TrackRecord)
+        for name in self.__slots__:
+            setattr(clone, name, getattr(self, name))
+        return clone
+
+    @classmethod
+    def from_vk(cls, item):
+        album = item.get('album')
+        album_title, cover_url = "", None
+        if album and isinstance(album, dict):
+            album_title = album.get('title', '')
+            thumb = album.get('thumb')
+            if thumb and isinstance(thumb, dict):
+                cover_url = thumb.get('photo_600') or thumb.get('photo_300') or thumb.get('photo_270')
+        return cls(
+            item.get('owner_id'), item.get('id'), access_key=item.get('access_key') or None,
+            artist=item.get('artist', 'Unknown'), title=item.get('title', 'Unknown'),
+            duration=item.get('duration', 0), url=item.get('url') or None,
+            lyrics_id=item.get('lyrics_id'), album_title=album_title, cover_url=cover_url,
+        )
+
+
+async def iter_audio(token, owner_id=None, album_id=None, access_key=None):
     offset = 0
     batch_size = 200
     while True:
@@ -433,22 +1581,174 @@ async def get_all_audio(token, owner_id=None, album_id=None, access_key=None):
         else:
             items = []
             total = 0
-        all_tracks.extend(items)
+        for item in items:
+            yield TrackRecord.from_vk(item)
         offset += batch_size
         if not items or offset >= total:
             break
         await asyncio.sleep(0.35)
-    return all_tracks
+
+
+async def get_all_audio(token, owner_id=None, album_id=None, access_key=None):
+    return [track async for track in iter_audio(token, owner_id=owner_id, album_id=album_id, access_key=access_key)]
+
+
+def audio_identity(track):
+    identity = f"{track.owner_id}_{track.id}"
+    if track.access_key:
+        identity += f"_{track.access_key}"
+    return identity
+
+
+# Signed CDN URLs expire, so long jobs resolve them just before use
+# through audio.getById (up to URL_RESOLVE_BATCH ids per call).
+async def resolve_track_urls(token, tracks):
+    resolved = 0
+    for start in range(0, len(tracks), URL_RESOLVE_BATCH):
+        batch = tracks[start:start + URL_RESOLVE_BATCH]
+        try:
+            with trace_span("resolve_urls", "vk_api", tracks=len(batch)):
+                result = await vk_api_method(token, "audio.getById", retries=VK_THROTTLE_RETRIES,
+                                             audios=",".join(audio_identity(t) for t in batch))
+        except Exception as e:
+            logger.error(f"Error resolving track URLs: {e}")
+            result = []
+        urls = {}
+        if isinstance(result, list):
+            for item in result:
+                if isinstance(item, dict) and item.get('url'):
+                    urls[(item.get('owner_id'), item.get('id'))] = item['url']
+        for track in batch:
+            track.url = urls.get((track.owner_id, track.id))
+            if track.url:
+                resolved += 1
+    return resolved
+
+
+# Re-resolves links that expired mid-download. Tracks that expire within
+# URL_RESOLVE_COALESCE of each other (a gathered batch, a stream window)
+# share one audio.getById call instead of one call each, which would run
+# into VK's rate limit. resolve() returns whether the track got a new URL.
+class UrlResolver:
+    def __init__(self, token, delay=URL_RESOLVE_COALESCE):
+        self.token = token
+        self.delay = delay
+        self.pending = []
+        self.flush_task = None
+
+    async def resolve(self, track):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((track, future))
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self._flush())
+        return await future
+
+    async def _flush(self):
+        await asyncio.sleep(self.delay)
+        batch, self.pending, self.flush_task = self.pending, [], None
+        try:
+            await resolve_track_urls(self.token, [track for track, _ in batch])
+        finally:
+            for track, future in batch:
+                if not future.done():
+                    future.set_result(bool(track.url))
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
 
 
 async def get_lyrics(token, lyrics_id):
     try:
-        result = await vk_api_method(token, "audio.getLyrics", lyrics_id=lyrics_id)
+        with trace_span("lyrics", "vk_api", lyrics_id=lyrics_id):
+            result = await vk_api_method(token, "audio.getLyrics", lyrics_id=lyrics_id)
         return result.get("text", "")
     except Exception:
         return ""
 
 
+# ==================== SESSION STORE ====================
+
+def load_session_key():
+    if SESSION_SECRET:
+        return base64.urlsafe_b64encode(hashlib.sha256(SESSION_SECRET.encode()).digest())
+    if not SESSION_KEY_PATH.exists():
+        # link() is atomic, so concurrently starting workers agree on one key
+        tmp_path = SESSION_KEY_PATH.with_name(f".session_key.{os.getpid()}")
+        tmp_path.write_bytes(Fernet.generate_key())
+        os.chmod(tmp_path, 0o600)
+        try:
+            os.link(tmp_path, SESSION_KEY_PATH)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+    return SESSION_KEY_PATH.read_bytes().strip()
+
+
+# Login sessions live in db.vk_sessions so every worker sees them, with the
+# VK token Fernet-encrypted at rest. Reads go through a small per-worker
+# cache; a logout reaches the other workers within SESSION_CACHE_TTL.
+# Misses are not cached: a session created on one worker must be usable on
+# another right away.
+class SessionStore:
+    def __init__(self, cache_ttl=SESSION_CACHE_TTL, cache_max=SESSION_CACHE_MAX):
+        self.cache_ttl = cache_ttl
+        self.cache_max = cache_max
+        self._cache = {}  # session id -> (expires_at, data)
+        self._fernet = None
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            if Fernet is None:
+                raise RuntimeError("Session storage requires the cryptography package")
+            self._fernet = Fernet(load_session_key())
+        return self._fernet
+
+    def _remember(self, session_id, data):
+        now = time.monotonic()
+        if len(self._cache) >= self.cache_max:
+            for sid in [sid for sid, (expires_at, _) in self._cache.items() if expires_at <= now]:
+                del self._cache[sid]
+            if len(self._cache) >= self.cache_max:
+                del self._cache[next(iter(self._cache))]
+        self._cache[session_id] = (now + self.cache_ttl, data)
+
+    async def get(self, session_id):
+        if not session_id:
+            return None
+        cached = self._cache.get(session_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        doc = await db.vk_sessions.find_one({"id": session_id}, {"_id": 0})
+        if not doc:
+            self._cache.pop(session_id, None)
+            return None
+        try:
+            token = self.fernet.decrypt(doc["token"].encode()).decode()
+        except InvalidToken:
+            logger.warning(f"Session {session_id[:8]} cannot be decrypted, was the session key changed?")
+            return None
+        data = {"token": token, "user_id": doc.get("user_id")}
+        self._remember(session_id, data)
+        return data
+
+    async def put(self, session_id, data):
+        await db.vk_sessions.update_one({"id": session_id}, {"$set": {
+            "id": session_id, "token": self.fernet.encrypt(data["token"].encode()).decode(),
+            "user_id": data.get("user_id"), "created_at": datetime.now(timezone.utc),
+        }}, upsert=True)
+        self._remember(session_id, data)
+
+    async def delete(self, session_id):
+        self._cache.pop(session_id, None)
+        await db.vk_sessions.delete_one({"id": session_id})
+
+
+session_store = SessionStore()
+
+
 # ==================== AUTH ENDPOINTS ====================
 
 @api_router.post("/vk/token-login")
@@ -461,7 +1761,7 @@ async def vk_token_login(req: VkTokenLoginRequest):
             except Exception:
                 raise HTTPException(status_code=401, detail="Invalid token")
         session_id = str(uuid.uuid4())
-        vk_sessions[session_id] = {"token": req.token}
+        await session_store.put(session_id, {"token": req.token, "user_id": user_info.get("id")})
         return {
             "status": "success", "session_id": session_id,
             "user": {"first_name": user_info.get("first_name", ""), "last_name": user_info.get("last_name", ""), "photo": user_info.get("photo_100", "")}
@@ -476,8 +1776,8 @@ async def vk_token_login(req: VkTokenLoginRequest):
 @api_router.post("/vk/logout")
 async def vk_logout(data: dict):
     session_id = data.get("session_id")
-    if session_id in vk_sessions:
-        del vk_sessions[session_id]
+    if session_id:
+        await session_store.delete(session_id)
     return {"status": "ok"}
 
 
@@ -486,16 +1786,12 @@ async def vk_logout(data: dict):
 @api_router.get("/proxies")
 async def get_proxies():
     proxies = await db.proxies.find({}, {"_id": 0}).to_list(100)
+    await refresh_xray_state()
     for p in proxies:
         pid = p.get("id", "")
-        if pid in xray_processes:
-            proc = xray_processes[pid]["process"]
-            if proc.poll() is None:
-                p["xray_running"] = True
-                p["xray_port"] = xray_processes[pid]["port"]
-            else:
-                p["xray_running"] = False
-                del xray_processes[pid]
+        if pid in xray_processes and xray_running():
+            p["xray_running"] = True
+            p["xray_port"] = xray_processes[pid]["port"]
         else:
             p["xray_running"] = False
     return proxies
@@ -508,6 +1804,7 @@ async def add_proxy(req: ProxyAddRequest):
         "name": req.name or f"{req.proxy_type.upper()} proxy",
         "enabled": False, "created_at": datetime.now(timezone.utc).isoformat(),
         "status": "unchecked", "status_message": "", "check_ip": "", "check_latency": 0,
+        "score": 0.0, "check_history": [],
     }
     await db.proxies.insert_one(proxy_doc)
     proxy_doc.pop("_id", None)
@@ -520,20 +1817,9 @@ async def toggle_proxy(proxy_id: str):
         raise HTTPException(status_code=404, detail="Proxy not found")
     new_state = not proxy.get("enabled", False)
     if new_state:
-        all_proxies = await db.proxies.find({}, {"_id": 0}).to_list(100)
-        for p in all_proxies:
-            if p["id"] != proxy_id and p.get("enabled"):
-                await stop_xray_for_proxy(p["id"])
-        await db.proxies.update_many({}, {"$set": {"enabled": False}})
-        if proxy.get("proxy_type") == "vless":
-            try:
-                result = await start_xray_for_proxy(proxy_id, proxy["address"])
-                await db.proxies.update_one({"id": proxy_id}, {"$set": {"enabled": True, "status_message": f"Xray on port {result['port']}"}})
-            except Exception as e:
-                await db.proxies.update_one({"id": proxy_id}, {"$set": {"status": "error", "status_message": str(e)[:200]}})
-                return {"id": proxy_id, "enabled": False, "error": str(e)[:200]}
-        else:
-            await db.proxies.update_one({"id": proxy_id}, {"$set": {"enabled": True}})
+        error = await activate_proxy(proxy)
+        if error:
+            return {"id": proxy_id, "enabled": False, "error": error}
     else:
         await stop_xray_for_proxy(proxy_id)
         await db.proxies.update_one({"id": proxy_id}, {"$set": {"enabled": False}})
@@ -545,52 +1831,24 @@ async def delete_proxy(proxy_id: str):
     await db.proxies.delete_one({"id": proxy_id})
     return {"status": "ok"}
 
+@api_router.post("/proxies/check-all")
+async def check_all_proxies():
+    proxies = await db.proxies.find({}, {"_id": 0}).to_list(100)
+    results = await check_proxies_concurrently(proxies)
+    return {"count": len(results), "results": results}
+
 @api_router.post("/proxies/{proxy_id}/check")
 async def check_proxy(proxy_id: str):
     proxy = await db.proxies.find_one({"id": proxy_id}, {"_id": 0})
     if not proxy:
         raise HTTPException(status_code=404, detail="Proxy not found")
+    if not build_proxy_url(proxy) and proxy.get("proxy_type") != "vless":
+        await db.proxies.update_one({"id": proxy_id}, {"$set": {"status": "error", "status_message": "Unsupported type"}})
+        raise HTTPException(status_code=400, detail="Unsupported proxy type")
     await db.proxies.update_one({"id": proxy_id}, {"$set": {"status": "checking", "status_message": "Checking..."}})
-    proxy_type = proxy.get("proxy_type", "")
-    address = proxy.get("address", "")
-
-    if proxy_type == "vless":
-        if proxy.get("enabled") and proxy_id in xray_processes:
-            port = xray_processes[proxy_id]["port"]
-            socks_url = f"socks5://127.0.0.1:{port}"
-            test_result = await test_proxy_connectivity(socks_url, timeout=10)
-        else:
-            temp_id = f"check_{proxy_id}"
-            try:
-                result = await start_xray_for_proxy(temp_id, address)
-                socks_url = f"socks5://127.0.0.1:{result['port']}"
-                test_result = await test_proxy_connectivity(socks_url, timeout=10)
-                await stop_xray_for_proxy(temp_id)
-            except Exception as e:
-                await stop_xray_for_proxy(temp_id)
-                await db.proxies.update_one({"id": proxy_id}, {"$set": {"status": "error", "status_message": f"Xray error: {str(e)[:200]}"}})
-                return {"status": "error", "message": str(e)[:200]}
-    else:
-        proxy_url = build_proxy_url(proxy)
-        if not proxy_url:
-            await db.proxies.update_one({"id": proxy_id}, {"$set": {"status": "error", "status_message": "Unsupported type"}})
-            raise HTTPException(status_code=400, detail="Unsupported proxy type")
-        test_result = await test_proxy_connectivity(proxy_url, timeout=10)
-
-    if test_result["success"]:
-        status_msg = f"OK! Ping: {test_result['latency_ms']}ms"
-        if test_result.get("ip"):
-            status_msg += f" | IP: {test_result['ip']}"
-        await db.proxies.update_one({"id": proxy_id}, {"$set": {
-            "status": "ok", "status_message": status_msg,
-            "check_ip": test_result.get("ip", ""), "check_latency": test_result.get("latency_ms", 0),
-            "last_check": datetime.now(timezone.utc).isoformat()
-        }})
-        return {"status": "ok", "message": status_msg, "ip": test_result.get("ip"), "latency_ms": test_result.get("latency_ms")}
-    else:
-        error_msg = test_result.get("error", "Connection failed")
-        await db.proxies.update_one({"id": proxy_id}, {"$set": {"status": "error", "status_message": error_msg, "check_ip": "", "check_latency": 0}})
-        return {"status": "error", "message": error_msg}
+    result = await run_proxy_check(proxy)
+    result.pop("id", None)
+    return result
 
 
 # ==================== PLAYLIST PARSING ====================
@@ -624,39 +1882,493 @@ def parse_track_url(url):
 
 # ==================== DOWNLOAD ENGINE ====================
 
-async def download_track_file(session, url, filepath, http_proxy=None, timeout=60):
-    try:
-        headers = {"User-Agent": KATE_USER_AGENT}
-        req_kwargs = {"timeout": aiohttp.ClientTimeout(total=timeout), "headers": headers}
-        if http_proxy:
-            req_kwargs["proxy"] = http_proxy
-        async with session.get(url, **req_kwargs) as response:
-            if response.status == 200:
-                async with aiofiles.open(filepath, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(16384):
-                        await f.write(chunk)
-                return True
-    except Exception as e:
-        logger.error(f"Download error: {e}")
-    return False
+class TaskCancelled(Exception):
+    pass
 
 
-async def apply_id3_tags(filepath, track, cover_data=None, lyrics_text=None):
-    if not HAS_MUTAGEN:
-        return
-    try:
-        try:
-            audio = MP3(str(filepath), ID3=ID3)
-        except ID3NoHeaderError:
-            audio = MP3(str(filepath))
+def raise_if_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise TaskCancelled()
+
+
+def remove_task_files(task_id):
+    shutil.rmtree(DOWNLOAD_DIR / task_id, ignore_errors=True)
+    remove_files(str(p) for p in DOWNLOAD_DIR.glob(f"*_{task_id[:8]}*.zip"))
+
+
+# Runs a process_* coroutine in its own asyncio task so cancel_download can
+# cancel it: the CancelledError reaches in-flight CDN reads, uploads and
+# waits, and the task's files are removed right away. Also owns the trace.
+def managed_task(func):
+    @functools.wraps(func)
+    async def wrapper(task_id, *args, **kwargs):
+        start_trace(task_id)
+        cancel_events[task_id] = threading.Event()
+        runner = asyncio.create_task(func(task_id, *args, **kwargs))
+        task_runners[task_id] = runner
+        try:
+            with trace_span("task", "task", kind=func.__name__):
+                return await runner
+        except asyncio.CancelledError:
+            if not (runner.cancelled() and active_cancel_flags.get(task_id)):
+                raise
+            await asyncio.get_running_loop().run_in_executor(None, remove_task_files, task_id)
+            active_cancel_flags.pop(task_id, None)
+            await update_task_status(task_id, "cancelled", error_message="Cancelled by user", current_track="")
+            logger.info(f"Task {task_id} cancelled")
+        finally:
+            task_runners.pop(task_id, None)
+            cancel_events.pop(task_id, None)
+            await finish_trace(task_id)
+    return wrapper
+
+
+# Cancel requests land on any worker. The endpoint records them in
+# download_history; the worker running the task picks them up here.
+async def cancel_watcher_loop():
+    while True:
+        await asyncio.sleep(CANCEL_POLL_INTERVAL)
+        local_tasks = [task_id for task_id in cancel_events if not active_cancel_flags.get(task_id)]
+        if not local_tasks:
+            continue
+        try:
+            requested = await db.download_history.find(
+                {"id": {"$in": local_tasks}, "cancel_requested": True}, {"_id": 0, "id": 1}
+            ).to_list(None)
+            for doc in requested:
+                cancel_running_task(doc["id"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Cancel watcher error: {e}")
+
+
+# Tasks running on another worker are left to its cancel_watcher_loop; a
+# flag set here would never be cleared.
+def cancel_running_task(task_id):
+    event = cancel_events.get(task_id)
+    runner = task_runners.get(task_id)
+    if event is None and runner is None:
+        return False
+    active_cancel_flags[task_id] = True
+    if event is not None:
+        event.set()
+    if runner is not None and not runner.done():
+        runner.cancel()
+        return True
+    return False
+
+
+# AIMD concurrency limit for one egress path (a proxy id or "direct"),
+# shared by every task downloading through it. Once per CONCURRENCY_WINDOW
+# the limit grows by one while it is saturated, throughput has not dropped
+# and errors stay under CONCURRENCY_ERROR_RATE; it shrinks by one when
+# throughput falls. Timeouts, 429s and connection resets halve it at once
+# (at most once per window, so one burst of failures counts once).
+class ConcurrencyLimiter:
+    def __init__(self, egress, initial=CONCURRENT_DOWNLOADS):
+        self.egress = egress
+        self.limit = initial
+        self.in_flight = 0
+        self.history = deque(maxlen=CONCURRENCY_HISTORY_SIZE)
+        self._waiters = deque()
+        self._last_throughput = 0.0
+        self._last_backoff = 0.0
+        self.throughput = 0.0  # bytes/s, smoothed over windows; feeds ETA estimates
+        self._reset_window(time.monotonic())
+        self._adjust(initial, "initial")
+
+    def _reset_window(self, now):
+        self._window_started = now
+        self._window_bytes = 0
+        self._window_ok = 0
+        self._window_errors = 0
+        self._window_peak = self.in_flight
+
+    def _adjust(self, limit, reason):
+        self.limit = max(CONCURRENCY_MIN, min(CONCURRENCY_MAX, limit))
+        self.history.append({"at": datetime.now(timezone.utc).isoformat(), "limit": self.limit, "reason": reason})
+        CONCURRENCY_LIMIT.set(self.limit, proxy=self.egress)
+        if reason != "initial":
+            CONCURRENCY_ADJUSTMENTS.inc(proxy=self.egress, reason=reason)
+        self._wake()
+
+    def _wake(self):
+        free = self.limit - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def acquire(self):
+        started = time.perf_counter()
+        while self.in_flight >= self.limit or self._waiters:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            if self.in_flight < self.limit:
+                break
+        self.in_flight += 1
+        self._window_peak = max(self._window_peak, self.in_flight)
+        SEMAPHORE_WAIT_SECONDS.observe(time.perf_counter() - started)
+        CONCURRENCY_IN_FLIGHT.set(self.in_flight, proxy=self.egress)
+
+    def release(self, result, nbytes=0):
+        self.in_flight -= 1
+        CONCURRENCY_IN_FLIGHT.set(self.in_flight, proxy=self.egress)
+        now = time.monotonic()
+        self._window_bytes += nbytes
+        if result == "ok":
+            self._window_ok += 1
+        elif result in ("timeout", "reset", "http_429"):
+            self._window_errors += 1
+            if now - self._last_backoff >= CONCURRENCY_WINDOW:
+                self._last_backoff = now
+                self._adjust(self.limit // 2, result)
+                self._last_throughput = 0.0
+                self._reset_window(now)
+        elif result not in ("expired", "cancelled"):
+            self._window_errors += 1
+        self._evaluate(now)
+        self._wake()
+
+    def _evaluate(self, now):
+        elapsed = now - self._window_started
+        done = self._window_ok + self._window_errors
+        if elapsed < CONCURRENCY_WINDOW or done < 2:
+            return
+        throughput = self._window_bytes / elapsed
+        self.throughput = throughput if not self.throughput else 0.7 * self.throughput + 0.3 * throughput
+        error_rate = self._window_errors / done
+        if (error_rate <= CONCURRENCY_ERROR_RATE and self._window_peak >= self.limit
+                and throughput >= self._last_throughput * 0.95 and self.limit < CONCURRENCY_MAX):
+            self._adjust(self.limit + 1, "increase")
+        elif self._last_throughput and throughput < self._last_throughput * 0.8:
+            self._adjust(self.limit - 1, "throughput_drop")
+        self._last_throughput = throughput
+        self._reset_window(now)
+
+
+def get_concurrency_limiter(egress):
+    limiter = concurrency_limiters.get(egress)
+    if limiter is None:
+        limiter = concurrency_limiters[egress] = ConcurrencyLimiter(egress)
+    return limiter
+
+
+# Disk budget for DOWNLOAD_DIR, shared by every worker on the host: the
+# reservations live in disk_reservations and are granted under a per-host
+# MongoLock; those of workers that stopped sending heartbeats are dropped.
+# Before each chunk a task reserves
+# room for its tracks plus the zip copy (2x the chunk limit). The grant is
+# the task's fair share of the budget, capped by CHUNK_SIZE_LIMIT and by
+# what is left; a task that cannot get CHUNK_MIN_SIZE waits until another
+# chunk is released. The capacity is DISK_BUDGET_MB or, by default, free
+# space plus what DOWNLOAD_DIR already holds, minus DISK_HEADROOM_MB.
+# When nothing else holds a reservation there is nothing to wait for: if
+# even a minimal chunk does not fit, the reservation fails with
+# DiskFullError.
+class DiskFullError(Exception):
+    pass
+
+
+class DiskBudget:
+    def __init__(self):
+        self.capacity = 0
+        self.reservations: Dict[str, int] = {}  # this worker's grants
+        self.waiting = set()
+        self.lock = MongoLock(f"disk:{HOST_ID}")
+
+    def refresh_capacity(self, dir_bytes=0):
+        if DISK_BUDGET:
+            self.capacity = DISK_BUDGET
+        else:
+            self.capacity = max(0, shutil.disk_usage(DOWNLOAD_DIR).free + dir_bytes - DISK_HEADROOM)
+
+    def reserved(self):
+        return sum(self.reservations.values())
+
+    async def host_reservations(self):
+        live = {doc["_id"] for doc in await live_workers()} | {WORKER_ID}
+        docs = await db.disk_reservations.find({"host": HOST_ID}).to_list(None)
+        stale = [doc["_id"] for doc in docs if doc.get("worker") not in live]
+        if stale:
+            await db.disk_reservations.delete_many({"_id": {"$in": stale}})
+        return [doc for doc in docs if doc.get("worker") in live]
+
+    async def record(self, key, task_id, nbytes):
+        await db.disk_reservations.update_one({"_id": key}, {"$set": {
+            "host": HOST_ID, "worker": WORKER_ID, "task_id": task_id, "bytes": nbytes,
+        }}, upsert=True)
+
+    # A waiting key is recorded with 0 bytes so it counts as a contender
+    # for the fair share on every worker.
+    async def try_reserve(self, task_id, key):
+        if not self.capacity:
+            self.refresh_capacity()
+        async with self.lock:
+            others = [doc for doc in await self.host_reservations() if doc["_id"] != key]
+            contenders = len(others) + 1
+            left = self.capacity - sum(doc.get("bytes", 0) for doc in others)
+            grant = min(2 * CHUNK_SIZE_LIMIT, self.capacity // contenders, left)
+            if grant < 2 * CHUNK_MIN_SIZE:
+                # Alone on the disk: make progress with a minimal chunk if it physically fits
+                if any(doc.get("bytes") for doc in others):
+                    self.reservations.pop(key, None)
+                    await self.record(key, task_id, 0)
+                    return 0
+                free = shutil.disk_usage(DOWNLOAD_DIR).free
+                if free < 2 * CHUNK_MIN_SIZE + DISK_HEADROOM:
+                    raise DiskFullError(f"Недостаточно места на диске: свободно {format_size(free)}, "
+                                        f"нужно не меньше {format_size(2 * CHUNK_MIN_SIZE + DISK_HEADROOM)}")
+                grant = 2 * CHUNK_MIN_SIZE
+            await self.record(key, task_id, grant)
+            self.reservations[key] = grant
+            return grant // 2
+
+    # Returns the chunk size limit for the next chunk, or 0 if the task was
+    # cancelled while waiting. Part pipelines of one task reserve under
+    # their own "<task_id>#<n>" keys.
+    async def reserve(self, task_id, key=None):
+        key = key or task_id
+        self.waiting.add(key)
+        notified = False
+        try:
+            while True:
+                chunk_limit = await self.try_reserve(task_id, key)
+                if chunk_limit:
+                    return chunk_limit
+                if active_cancel_flags.get(task_id):
+                    return 0
+                if not notified:
+                    notified = True
+                    logger.info(f"Task {task_id} waiting for disk budget ({format_size(self.reserved())} reserved)")
+                    await update_task_status(task_id, "downloading", current_track="Ожидание свободного места на диске...")
+                await asyncio.sleep(DISK_WAIT_INTERVAL)
+        finally:
+            self.waiting.discard(key)
+
+    # A bare task id also drops the reservations of its part pipelines.
+    async def release(self, key):
+        self.reservations.pop(key, None)
+        if "#" in key:
+            await db.disk_reservations.delete_one({"_id": key})
+            return
+        for other in [k for k in self.reservations if k.startswith(key + "#")]:
+            del self.reservations[other]
+        await db.disk_reservations.delete_many({"task_id": key})
+
+
+disk_budget = DiskBudget()
+
+
+# Global budget for the in-memory fast path. A small job reserves room for
+# its tracks plus the archive (2x its size at the top bitrate) and never
+# waits: when the budget is taken it simply runs on disk.
+class MemoryBudget:
+    def __init__(self, capacity=MEMORY_BUDGET):
+        self.capacity = capacity
+        self.reservations: Dict[str, int] = {}
+
+    def reserved(self):
+        return sum(self.reservations.values())
+
+    def try_reserve(self, task_id, nbytes):
+        if nbytes > self.capacity - self.reserved():
+            return 0
+        self.reservations[task_id] = nbytes
+        return nbytes
+
+    def release(self, task_id):
+        self.reservations.pop(task_id, None)
+
+
+memory_budget = MemoryBudget()
+
+
+def newest_mtime(path):
+    newest = path.stat().st_mtime
+    if path.is_dir():
+        for child in path.rglob("*"):
+            try:
+                newest = max(newest, child.stat().st_mtime)
+            except OSError:
+                pass
+    return newest
+
+
+# Removes task dirs and archives left behind by crashed or killed tasks.
+# Entries whose name carries the id of a task running on any live worker of
+# the host are kept, and so is anything modified within ORPHAN_MIN_AGE.
+def reclaim_orphans(running_ids, min_age=ORPHAN_MIN_AGE):
+    now = time.time()
+    count, reclaimed = 0, 0
+    for entry in DOWNLOAD_DIR.iterdir():
+        if any(task_id[:8] in entry.name for task_id in running_ids):
+            continue
+        try:
+            if now - newest_mtime(entry) < min_age:
+                continue
+            size = get_dir_size(entry) if entry.is_dir() else entry.stat().st_size
+            if entry.is_dir():
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                entry.unlink()
+        except OSError as e:
+            logger.error(f"Janitor: failed to remove {entry}: {e}")
+            continue
+        count += 1
+        reclaimed += size
+    return count, reclaimed
+
+
+async def running_task_ids():
+    task_ids = set(engine_tasks)
+    for worker in await live_workers():
+        task_ids.update(worker.get("tasks", []))
+    return task_ids
+
+
+# DOWNLOAD_DIR is per host: one worker per host sweeps it, every worker
+# refreshes its view of the budget capacity.
+async def disk_janitor_loop():
+    loop = asyncio.get_running_loop()
+    lease = MongoLock(f"leader:janitor:{HOST_ID}")
+    try:
+        while True:
+            try:
+                if await is_leader(lease):
+                    count, reclaimed = await loop.run_in_executor(None, reclaim_orphans, await running_task_ids())
+                    if count:
+                        JANITOR_RECLAIMED_BYTES.inc(reclaimed)
+                        logger.info(f"Janitor: removed {count} orphaned entries, {format_size(reclaimed)} reclaimed")
+                    expired = await archive_storage.cleanup()
+                    if expired:
+                        logger.info(f"Janitor: removed {expired} expired archives from {archive_storage.name} storage")
+                    await expire_unopened_streams()
+                disk_budget.refresh_capacity(await loop.run_in_executor(None, get_dir_size, DOWNLOAD_DIR))
+            except Exception as e:
+                logger.error(f"Janitor error: {e}")
+            await asyncio.sleep(DISK_JANITOR_INTERVAL)
+    finally:
+        await release_lease(lease)
+
+
+class TrackUrlExpired(Exception):
+    pass
+
+
+# Returns the number of bytes written, 0 on failure. Holds a slot of the
+# egress path's concurrency limiter for the duration of the transfer.
+async def download_track_file(session, url, filepath, timeout=60):
+    return await limited_download(session, url, filepath, timeout, os.path.basename(filepath))
+
+
+# In-memory variant for the streaming endpoint: the body or None.
+async def download_track_bytes(session, url, name="", timeout=60):
+    buffer = bytearray()
+    if await limited_download(session, url, buffer, timeout, name):
+        return buffer
+    return None
+
+
+async def limited_download(session, url, sink, timeout, name):
+    limiter = get_concurrency_limiter(session.egress_label(url, "audio_cdn"))
+    await limiter.acquire()
+    span = {}
+    try:
+        with trace_span("download", "cdn", file=name) as span:
+            return await _download_track_file(session, url, sink, timeout, span)
+    finally:
+        limiter.release(span.get("result", "error"), span.get("bytes", 0))
+
+
+def classify_download_error(exc):
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, ConnectionResetError)):
+        return "reset"
+    return "error"
+
+
+# sink is a file path or a bytearray to append the body to.
+async def _download_track_file(session, url, sink, timeout, span):
+    egress = session.egress_label(url, "audio_cdn")
+    span["proxy"] = egress
+    started = time.perf_counter()
+    received = 0
+    result = "error"
+    try:
+        headers = {"User-Agent": KATE_USER_AGENT}
+        req_kwargs = {"timeout": aiohttp.ClientTimeout(total=timeout), "headers": headers}
+        async with session.get(url, route="audio_cdn", **req_kwargs) as response:
+            span["status"] = response.status
+            if response.status == 200:
+                if isinstance(sink, bytearray):
+                    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                        sink.extend(chunk)
+                        received += len(chunk)
+                else:
+                    async with aiofiles.open(sink, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                            await f.write(chunk)
+                            received += len(chunk)
+                result = "ok"
+                TRACK_DOWNLOAD_SECONDS.observe(time.perf_counter() - started, proxy=egress)
+                return received
+            if response.status in (403, 410):
+                result = "expired"
+                raise TrackUrlExpired(f"HTTP {response.status}")
+            result = f"http_{response.status}"
+    except TrackUrlExpired:
+        raise
+    except asyncio.CancelledError:
+        result = "cancelled"
+        raise
+    except Exception as e:
+        result = classify_download_error(e)
+        logger.error(f"Download error ({result}): {e!r}")
+    finally:
+        span["result"] = result
+        span["bytes"] = received
+        TRACK_DOWNLOADS.inc(result=result, proxy=egress)
+        TRACK_DOWNLOAD_BYTES.inc(received, proxy=egress)
+    return 0
+
+
+# filepath may also be a BytesIO holding the whole track (streaming mode).
+async def apply_id3_tags(filepath, track, cover_data=None, lyrics_text=None):
+    if not HAS_MUTAGEN:
+        return
+    in_memory = isinstance(filepath, io.BytesIO)
+    target = filepath if in_memory else str(filepath)
+    with trace_span("tag", "tag", file=f"{track.artist} - {track.title}" if in_memory else os.path.basename(target),
+                    cover_bytes=len(cover_data or b""), lyrics=bool(lyrics_text)):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _apply_id3_tags, target, track, cover_data, lyrics_text)
+
+
+def _apply_id3_tags(filepath, track, cover_data, lyrics_text):
+    started = time.perf_counter()
+    try:
+        try:
+            audio = MP3(filepath, ID3=ID3)
+        except ID3NoHeaderError:
+            audio = MP3(filepath)
+        if audio.tags is None:
             audio.add_tags()
 
-        audio.tags.add(TIT2(encoding=3, text=[track.get('title', 'Unknown')]))
-        audio.tags.add(TPE1(encoding=3, text=[track.get('artist', 'Unknown')]))
+        audio.tags.add(TIT2(encoding=3, text=[track.title]))
+        audio.tags.add(TPE1(encoding=3, text=[track.artist]))
 
-        album_info = track.get('album', {})
-        if album_info and isinstance(album_info, dict):
-            audio.tags.add(TALB(encoding=3, text=[album_info.get('title', '')]))
+        if track.album_title:
+            audio.tags.add(TALB(encoding=3, text=[track.album_title]))
 
         if cover_data:
             audio.tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover_data))
@@ -664,49 +2376,78 @@ async def apply_id3_tags(filepath, track, cover_data=None, lyrics_text=None):
         if lyrics_text:
             audio.tags.add(USLT(encoding=3, lang='rus', desc='', text=lyrics_text))
 
-        audio.save()
+        audio.save(filepath)
     except Exception as e:
         logger.error(f"ID3 tag error: {e}")
+    finally:
+        TAG_SECONDS.observe(time.perf_counter() - started)
 
 
-async def fetch_cover(session, track, http_proxy=None):
-    album = track.get('album', {})
-    if not album or not isinstance(album, dict):
-        return None
-    thumb = album.get('thumb', {})
-    if not thumb or not isinstance(thumb, dict):
-        return None
-    cover_url = thumb.get('photo_600') or thumb.get('photo_300') or thumb.get('photo_270')
+async def fetch_cover(session, track):
+    cover_url = track.cover_url
     if not cover_url:
         return None
-    try:
-        req_kwargs = {"timeout": aiohttp.ClientTimeout(total=15)}
-        if http_proxy:
-            req_kwargs["proxy"] = http_proxy
-        async with session.get(cover_url, **req_kwargs) as resp:
-            if resp.status == 200:
-                return await resp.read()
-    except Exception:
-        pass
+    with trace_span("cover", "cdn") as span:
+        try:
+            async with session.get(cover_url, route="cover", timeout=aiohttp.ClientTimeout(total=15)) as resp:
+                span["status"] = resp.status
+                if resp.status == 200:
+                    data = await resp.read()
+                    span["bytes"] = len(data)
+                    return data
+        except Exception:
+            pass
     return None
 
 
-async def upload_to_tempshare(filepath):
+# source is a file path, or a file object holding an archive built in
+# memory; filename then names the stored archive.
+async def store_archive(source, filename=None):
+    started = time.perf_counter()
+    backend = archive_storage.name
+    if isinstance(source, str):
+        filename = os.path.basename(source)
+        size = await asyncio.get_running_loop().run_in_executor(None, os.path.getsize, source)
+    else:
+        size = source.seek(0, os.SEEK_END)
+        source.seek(0)
+    with trace_span("upload", "upload", file=filename, bytes=size, backend=backend) as span:
+        if isinstance(source, str):
+            result = await archive_storage.store(source)
+        else:
+            result = await archive_storage.store_buffer(source, filename)
+        outcome = span["result"] = "ok" if result.get("success") else "error"
+    UPLOAD_SECONDS.observe(time.perf_counter() - started, backend=backend, result=outcome)
+    if result.get("success"):
+        UPLOAD_BYTES.inc(size, backend=backend)
+    return result
+
+
+async def _upload_to_tempshare(filepath, fileobj=None):
     try:
-        async with aiohttp.ClientSession() as session:
-            data = aiohttp.FormData()
-            data.add_field('file', open(filepath, 'rb'), filename=os.path.basename(filepath))
-            data.add_field('duration', '7')
-            async with session.post('https://api.tempshare.su/upload', data=data, timeout=aiohttp.ClientTimeout(total=600)) as response:
-                result = await response.json()
-                if result.get('success'):
-                    return {"success": True, "url": result.get('url', ''), "raw_url": result.get('raw_url', '')}
-                return {"success": False, "error": result.get('error', 'Upload failed')}
+        file_obj = fileobj or await asyncio.get_running_loop().run_in_executor(None, open, filepath, 'rb')
+        try:
+            async with await open_routed_session() as session:
+                data = aiohttp.FormData()
+                data.add_field('file', file_obj, filename=os.path.basename(filepath))
+                data.add_field('duration', '7')
+                async with session.post(TEMPSHARE_UPLOAD_URL, route="upload", data=data, timeout=aiohttp.ClientTimeout(total=600)) as response:
+                    result = await response.json()
+                    if result.get('success'):
+                        return {"success": True, "url": result.get('url', ''), "raw_url": result.get('raw_url', '')}
+                    return {"success": False, "error": result.get('error', 'Upload failed')}
+        finally:
+            if fileobj is None:
+                file_obj.close()
     except Exception as e:
         logger.error(f"TempShare upload error: {e}")
         return {"success": False, "error": str(e)}
 
 
+def failed_tracks_message(failed, total):
+    return f"Не удалось скачать {failed} из {total} треков" if failed else ""
+
+
 def format_size(bytes_size):
     for unit in ['B', 'KB', 'MB', 'GB']:
         if bytes_size < 1024:
@@ -721,24 +2462,234 @@ async def update_task_status(task_id, status, **kwargs):
     await db.download_history.update_one({"id": task_id}, {"$set": update})
 
 
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Unlinking a chunk of tracks or a multi-GB archive can stall the loop on
+# slow filesystems, so cleanup runs in the default executor.
+async def discard_files(*paths):
+    await asyncio.get_running_loop().run_in_executor(None, remove_files, [str(p) for p in paths])
+
+
+async def discard_dir(dir_path):
+    await asyncio.get_running_loop().run_in_executor(None, functools.partial(shutil.rmtree, str(dir_path),
+                                                                             ignore_errors=True))
+
+
 def get_dir_size(dir_path):
     total = 0
-    for f in Path(dir_path).iterdir():
-        if f.is_file():
-            total += f.stat().st_size
+    for f in Path(dir_path).rglob("*"):
+        try:
+            if f.is_file():
+                total += f.stat().st_size
+        except OSError:
+            pass
     return total
 
 
-# FIX BUG #2: Chunked download with 1GB threshold
-# Downloads tracks, when accumulated size reaches ~1GB:
-# stop -> zip -> upload to tempshare -> save link -> clean cache -> continue
-async def download_tracks_batch(task_id, token, tracks, title, add_tags=False, add_lyrics=False, quality="high"):
+# ==================== TRANSCODING ====================
+
+# Re-encodes tracks to the requested quality with a locally installed
+# encoder (ffmpeg, or lame built with MP3 input). The encoder already runs
+# in its own process, so the pool is at most TRANSCODE_WORKERS encoder
+# processes at a time, sized to the CPU count. Each track enters it right
+# after its download, while the rest of the batch is still on the wire.
+transcode_slots = {}  # event loop -> semaphore
+
+
+def transcode_semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in transcode_slots:
+        transcode_slots.clear()
+        transcode_slots[loop] = asyncio.Semaphore(TRANSCODE_WORKERS)
+    return transcode_slots[loop]
+
+
+def transcoding_enabled(quality):
+    return bool(TRANSCODER_BIN) and QUALITY_BITRATES.get(quality, QUALITY_BITRATES["high"]) < QUALITY_BITRATES["high"]
+
+
+def transcoder_command(kbps, src=None, dst=None):
+    if os.path.basename(TRANSCODER_BIN).startswith("lame"):
+        return [TRANSCODER_BIN, "--quiet", "--mp3input", "-b", str(kbps), src or "-", dst or "-"]
+    return [TRANSCODER_BIN, "-hide_banner", "-loglevel", "error", "-y", "-i", src or "pipe:0", "-map", "0:a",
+            "-c:a", "libmp3lame", "-b:a", f"{kbps}k", "-f", "mp3", dst or "pipe:1"]
+
+
+# kbps of a downloaded track (path or bytes): from the MP3 frame headers
+# when mutagen is available, otherwise from size and duration.
+def source_bitrate(source, size, duration):
+    if HAS_MUTAGEN:
+        try:
+            return MP3(source if isinstance(source, str) else io.BytesIO(source)).info.bitrate // 1000
+        except Exception:
+            pass
+    return size * 8 // 1000 // duration if duration else 0
+
+
+def replace_file(src, dst):
+    os.replace(src, dst)
+    return os.path.getsize(dst)
+
+
+# Returns (source, size) re-encoded to `quality`: a path is re-encoded in
+# place, bytes are piped through the encoder. The input comes back as is
+# when transcoding is off for this quality, the source is already at or
+# below the target bitrate, or the encoder fails.
+async def transcode_track(source, size, duration, quality):
+    if not transcoding_enabled(quality):
+        return source, size
+    kbps = QUALITY_BITRATES[quality]
+    loop = asyncio.get_running_loop()
+    source_kbps = await loop.run_in_executor(None, source_bitrate, source, size, duration)
+    if source_kbps and source_kbps <= kbps * TRANSCODE_TOLERANCE:
+        TRANSCODES.inc(result="skipped")
+        return source, size
+
+    in_memory = not isinstance(source, str)
+    tmp_path = None if in_memory else f"{source}.part"
+    async with transcode_semaphore():
+        started = time.perf_counter()
+        with trace_span("transcode", "transcode", file="" if in_memory else os.path.basename(source),
+                        source_kbps=source_kbps, kbps=kbps) as span:
+            process = await asyncio.create_subprocess_exec(
+                *transcoder_command(kbps, tmp_path and source, tmp_path),
+                stdin=asyncio.subprocess.PIPE if in_memory else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE if in_memory else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                output, errors = await process.communicate(bytes(source) if in_memory else None)
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                if tmp_path:
+                    await discard_files(tmp_path)
+                raise
+            if process.returncode != 0 or (in_memory and not output):
+                span["result"] = "error"
+                TRANSCODES.inc(result="error")
+                logger.error(f"Transcode failed ({process.returncode}): {errors.decode(errors='replace')[-300:]}")
+                if tmp_path:
+                    await discard_files(tmp_path)
+                return source, size
+            if in_memory:
+                source, new_size = output, len(output)
+            else:
+                new_size = await loop.run_in_executor(None, replace_file, tmp_path, source)
+            span["result"] = "ok"
+            span["bytes"] = new_size
+    TRANSCODES.inc(result="ok")
+    TRANSCODE_SAVED_BYTES.inc(max(0, size - new_size))
+    TRANSCODE_SECONDS.observe(time.perf_counter() - started)
+    return source, new_size
+
+
+# ==================== PART PLANNING ====================
+
+# Without an encoder tracks arrive at the source bitrate, which VK serves
+# at up to 320 kbps.
+def estimate_track_sizes(tracks, quality="high", add_tags=False):
+    if not transcoding_enabled(quality):
+        quality = "high"
+    kbps = QUALITY_BITRATES.get(quality, QUALITY_BITRATES["high"])
+    overhead = TAG_OVERHEAD if add_tags else 0
+    return [max(1, track.duration or 0) * kbps * 1000 // 8 + overhead for track in tracks]
+
+
+async def head_content_length(session, url):
+    try:
+        async with session.request("HEAD", url, route="audio_cdn", headers={"User-Agent": KATE_USER_AGENT},
+                                   timeout=aiohttp.ClientTimeout(total=10), allow_redirects=True) as resp:
+            if resp.status == 200 and resp.content_length:
+                return resp.content_length
+    except Exception:
+        pass
+    return None
+
+
+# Probes up to `sample` evenly spaced tracks with HEAD. Probed tracks get
+# their real size, the rest are scaled by the measured/estimated ratio
+# (VK serves most audio at 320 kbps, but not all of it). With `capped`,
+# tracks above the estimate get re-encoded down to it, so a probe can only
+# lower an estimate.
+async def refine_size_estimates(session, tracks, sizes, sample=PLAN_HEAD_SAMPLE, capped=False):
+    candidates = [i for i, track in enumerate(tracks) if track.url]
+    if not sample or not candidates:
+        return sizes
+    picked = candidates[::max(1, len(candidates) // sample)][:sample]
+    semaphore = asyncio.Semaphore(PLAN_HEAD_CONCURRENCY)
+
+    async def probe(i):
+        async with semaphore:
+            return await head_content_length(session, tracks[i].url)
+
+    with trace_span("plan_probe", "plan", tracks=len(picked)) as span:
+        lengths = await asyncio.gather(*(probe(i) for i in picked))
+        measured = {i: min(n, sizes[i]) if capped else n for i, n in zip(picked, lengths) if n}
+        span["measured"] = len(measured)
+    if not measured:
+        return sizes
+    ratio = sum(measured.values()) / sum(sizes[i] for i in measured)
+    return [measured.get(i) or int(size * ratio) for i, size in enumerate(sizes)]
+
+
+def part_size_limit():
+    return min(CHUNK_SIZE_LIMIT, archive_storage.max_size or CHUNK_SIZE_LIMIT)
+
+
+# Greedy packing in listing order, so every archive holds a contiguous run
+# of the playlist. Returns lists of track indices.
+def plan_parts(sizes, part_limit):
+    target = part_limit * PLAN_FILL_RATIO
+    parts, current, current_size = [], [], 0
+    for idx, size in enumerate(sizes):
+        if current and current_size + size > target:
+            parts.append(current)
+            current, current_size = [], 0
+        current.append(idx)
+        current_size += size
+    if current:
+        parts.append(current)
+    return parts
+
+
+# ==================== DOWNLOAD PIPELINE ====================
+
+# Tracks are assigned to archive parts before anything is downloaded (see
+# plan_parts) and up to PART_PIPELINES parts run download -> zip -> upload
+# at the same time, so one part is uploading while the next downloads.
+# Every pipeline reserves its own slice of the disk budget; if the grant is
+# smaller than the planned part, the tracks that did not fit go back to the
+# queue as an extra part.
+# Tracks are re-encoded to the requested quality right after download (see
+# transcode_track), before tagging.
+# Small single-part jobs (single tracks, short playlists) skip the disk when
+# the memory budget allows: tracks are downloaded and tagged in memory and
+# the archive is built in a spooled buffer and uploaded from it. Tracks that
+# do not fit the grant are spilled to the task directory.
+# Returns the tracks whose archives were uploaded, or None if the task did
+# not complete.
+# placements (optional, aligned with tracks): for each track a list of
+# (archive_group, arcname) pairs, so one downloaded file can appear in
+# several archives or folders. None keeps one flat archive.
+async def download_tracks_batch(task_id, token, tracks, title, add_tags=False, add_lyrics=False, quality="high",
+                                placements=None):
+    engine_tasks.add(task_id)
+    http_session = None
     try:
         if active_cancel_flags.get(task_id):
             await update_task_status(task_id, "cancelled", error_message="Cancelled by user")
             return
 
-        valid_tracks = [t for t in tracks if t.get('url')]
+        if placements is not None:
+            placements = [p for t, p in zip(tracks, placements) if t.url]
+        valid_tracks = [t for t in tracks if t.url]
         actual_count = len(valid_tracks)
 
         await db.download_history.update_one(
@@ -753,201 +2704,334 @@ async def download_tracks_batch(task_id, token, tracks, title, add_tags=False, a
         task_dir = DOWNLOAD_DIR / task_id
         task_dir.mkdir(exist_ok=True)
 
-        proxy_doc = await get_active_proxy()
-        proxy_url = build_proxy_url(proxy_doc) if proxy_doc else None
-
-        connector = create_proxy_connector(proxy_url)
-        if connector:
-            http_session = aiohttp.ClientSession(connector=connector)
-            http_proxy = None
-        else:
-            http_session = aiohttp.ClientSession()
-            http_proxy = proxy_url if proxy_url and proxy_url.startswith("http") else None
-
-        total_downloaded = 0
-        chunk_part = 0
-        upload_urls = []
-        total_size_all = 0
-        semaphore = asyncio.Semaphore(CONCURRENT_DOWNLOADS)
-
-        # Process tracks in sequential chunks to control disk usage
-        i = 0
-        while i < len(valid_tracks):
-            if active_cancel_flags.get(task_id):
-                break
-
-            # Download tracks until we hit ~1GB or run out
+        http_session = await open_routed_session()
+        limiter = get_concurrency_limiter(http_session.egress_label("", "audio_cdn"))
+
+        with trace_span("plan", "plan", tracks=actual_count) as span:
+            sizes = estimate_track_sizes(valid_tracks, quality, add_tags)
+            # VK serves at most 320 kbps: a job that fits one part even at
+            # that bitrate has nothing to gain from the HEAD probe.
+            # A merged track is written once per placement, so every copy
+            # counts toward its archive part.
+            copies = [max(1, len(p)) for p in placements] if placements else [1] * actual_count
+            ceiling = sum(size * n for size, n in
+                          zip(estimate_track_sizes(valid_tracks, "high", add_tags), copies))
+            if ceiling > part_size_limit() * PLAN_FILL_RATIO:
+                sizes = await refine_size_estimates(http_session, valid_tracks, sizes,
+                                                    capped=transcoding_enabled(quality))
+            sizes = [size * n for size, n in zip(sizes, copies)]
+            plan = plan_parts(sizes, part_size_limit())
+            span["parts"] = len(plan)
+            span["bytes"] = sum(sizes)
+        await update_task_status(task_id, "downloading", planned_parts=len(plan),
+                                 estimated_size=format_size(sum(sizes)))
+
+        memory_grant = 0
+        if len(plan) == 1 and ceiling <= MEMORY_JOB_MAX:
+            memory_grant = memory_budget.try_reserve(task_id, 2 * ceiling)
+            MEMORY_JOBS.inc(mode="memory" if memory_grant else "disk")
+
+        # Large jobs drop listing URLs and resolve them window by window
+        # right before download, so late tracks don't hit expired links.
+        lazy_urls = actual_count > URL_RESOLVE_BATCH
+        if lazy_urls:
+            for t in valid_tracks:
+                t.url = None
+
+        queue = deque(plan)
+        state = {"downloaded": 0, "parts": 0, "planned": len(plan), "archived": 0, "bytes": 0, "kept": 0}
+        failed_tracks = []
+        resolver = UrlResolver(token)
+        part_urls = {}
+        delivered_tracks = []
+        cancel_event = cancel_events.get(task_id)
+        loop = asyncio.get_running_loop()
+
+        def progress():
+            return state["downloaded"] / actual_count * 80 + state["archived"] / state["planned"] * 20
+
+        def track_filename(track_idx):
+            track = valid_tracks[track_idx]
+            # FIX BUG #1: Limit filename length to 200 chars to avoid Linux 255-byte limit
+            return re.sub(r'[<>:"/\\|?*]', '_', f"{track_idx+1:03d}. {track.artist} - {track.title}")[:200] + ".mp3"
+
+        # Returns (path or bytes, size); both download helpers wait for a
+        # slot of the egress limiter.
+        async def fetch_track(url, filepath):
+            if memory_grant:
+                data = await download_track_bytes(http_session, url, filepath.name)
+                return data, len(data) if data else 0
+            return str(filepath), await download_track_file(http_session, url, str(filepath))
+
+        async def spill_track(data, filepath):
+            if state["kept"] + len(data) <= memory_grant // 2:
+                state["kept"] += len(data)
+                return data
+            MEMORY_SPILLED_TRACKS.inc()
+            await loop.run_in_executor(None, filepath.write_bytes, data)
+            return str(filepath)
+
+        async def download_one_track(track_idx, track):
+            if active_cancel_flags.get(task_id) or not track.url:
+                return None, 0
+
+            filepath = task_dir / track_filename(track_idx)
+            try:
+                source, file_size = await fetch_track(track.url, filepath)
+            except TrackUrlExpired:
+                source, file_size = None, 0
+                if await resolver.resolve(track):
+                    try:
+                        source, file_size = await fetch_track(track.url, filepath)
+                    except TrackUrlExpired:
+                        logger.error(f"Track URL expired again after re-resolve: {audio_identity(track)}")
+            if not file_size:
+                return None, 0
+            source, file_size = await transcode_track(source, file_size, track.duration, quality)
+
+            if add_tags and HAS_MUTAGEN:
+                cover_data = await fetch_cover(http_session, track)
+                lyrics_text = None
+                if add_lyrics and track.lyrics_id:
+                    lyrics_text = await get_lyrics(token, track.lyrics_id)
+                if memory_grant:
+                    buffer = io.BytesIO(source)
+                    await apply_id3_tags(buffer, track, cover_data, lyrics_text)
+                    source = buffer.getvalue()
+                else:
+                    await apply_id3_tags(filepath, track, cover_data, lyrics_text)
+            if memory_grant:
+                source = await spill_track(source, filepath)
+            return source, file_size
+
+        # Downloads the part's tracks in batches sized to the egress limit
+        # until chunk_limit is reached; returns the files and the leftover.
+        async def download_part(indices, chunk_limit):
             chunk_files = []
             chunk_size = 0
-
-            async def download_one_track(track_idx, track):
-                nonlocal chunk_size
-                if active_cancel_flags.get(task_id):
-                    return None
-
-                async with semaphore:
-                    if active_cancel_flags.get(task_id):
-                        return None
-
-                    artist = track.get('artist', 'Unknown')
-                    track_title = track.get('title', 'Unknown')
-                    url = track.get('url', '')
-
-                    # FIX BUG #1: Limit filename length to 200 chars to avoid Linux 255-byte limit
-                    safe_name = re.sub(r'[<>:"/\\|?*]', '_', f"{track_idx+1:03d}. {artist} - {track_title}")[:200]
-                    filepath = task_dir / f"{safe_name}.mp3"
-
-                    success = await download_track_file(http_session, url, str(filepath), http_proxy=http_proxy)
-
-                    if success:
-                        file_size = filepath.stat().st_size if filepath.exists() else 0
-                        chunk_size += file_size
-
-                        if add_tags and HAS_MUTAGEN:
-                            cover_data = await fetch_cover(http_session, track, http_proxy=http_proxy)
-                            lyrics_text = None
-                            if add_lyrics and track.get('lyrics_id'):
-                                lyrics_text = await get_lyrics(token, track['lyrics_id'])
-                            await apply_id3_tags(filepath, track, cover_data, lyrics_text)
-
-                        return str(filepath)
-                    return None
-
-            # Download tracks one-by-one or in small batches, checking size after each
-            batch_start = i
-            while i < len(valid_tracks) and chunk_size < CHUNK_SIZE_LIMIT:
+            pos = 0
+            resolved_until = 0
+            while pos < len(indices) and chunk_size < chunk_limit:
                 if active_cancel_flags.get(task_id):
                     break
-
-                # Download a small batch of up to CONCURRENT_DOWNLOADS tracks
-                batch_end = min(i + CONCURRENT_DOWNLOADS, len(valid_tracks))
-                batch_tasks = []
-                for j in range(i, batch_end):
-                    batch_tasks.append(download_one_track(j, valid_tracks[j]))
-
-                results = await asyncio.gather(*batch_tasks)
-                for r in results:
-                    if r:
-                        chunk_files.append(r)
-                        total_downloaded += 1
-
-                i = batch_end
-
-                # Update progress
-                progress = (total_downloaded / actual_count) * 80
-                current_artist = valid_tracks[min(i - 1, len(valid_tracks) - 1)].get('artist', '')
-                current_title = valid_tracks[min(i - 1, len(valid_tracks) - 1)].get('title', '')
+                batch = indices[pos:pos + limiter.limit]
+                if lazy_urls and pos + len(batch) > resolved_until:
+                    window_start = max(pos, resolved_until)
+                    resolved_until = min(window_start + URL_RESOLVE_BATCH, len(indices))
+                    await resolve_track_urls(token, [valid_tracks[j] for j in indices[window_start:resolved_until]])
+
+                results = await asyncio.gather(*(download_one_track(j, valid_tracks[j]) for j in batch))
+                for j, (fpath, file_size) in zip(batch, results):
+                    if fpath:
+                        chunk_files.append((fpath, j))
+                        chunk_size += file_size * copies[j]
+                        state["downloaded"] += 1
+                    elif not active_cancel_flags.get(task_id):
+                        failed_tracks.append(f"{valid_tracks[j].artist} - {valid_tracks[j].title}")
+                pos += len(batch)
+
+                last = valid_tracks[batch[-1]]
                 await update_task_status(
                     task_id, "downloading",
-                    progress=progress,
-                    current_track=f"{current_artist} - {current_title}",
-                    downloaded_count=total_downloaded
+                    progress=progress(),
+                    current_track=f"{last.artist} - {last.title}",
+                    downloaded_count=state["downloaded"],
+                    concurrency=limiter.limit,
+                    concurrency_history=list(limiter.history)[-10:]
                 )
+            leftover = indices[pos:] if not active_cancel_flags.get(task_id) else []
+            return chunk_files, chunk_size, leftover
 
-                # Check if we've hit the chunk size limit
-                if chunk_size >= CHUNK_SIZE_LIMIT:
-                    break
-
-            if active_cancel_flags.get(task_id):
-                break
-
-            # If we have files in this chunk, zip and upload them
-            if chunk_files:
-                chunk_part += 1
-                total_size_all += chunk_size
-
-                await update_task_status(task_id, "zipping", progress=80 + (chunk_part * 2),
-                                         current_track=f"Создание архива (часть {chunk_part})...")
-
-                safe_title = re.sub(r'[<>:"/\\|?*]', '_', title)[:150]
-                part_suffix = f"_part{chunk_part}" if (chunk_size >= CHUNK_SIZE_LIMIT or chunk_part > 1) else ""
-                zip_filename = f"{safe_title}_{task_id[:8]}{part_suffix}.zip"
-                zip_path = DOWNLOAD_DIR / zip_filename
-
-                loop = asyncio.get_event_loop()
-                def create_chunk_zip(files_to_zip, zpath):
-                    with zipfile.ZipFile(str(zpath), 'w', zipfile.ZIP_STORED) as zf:
-                        for fpath in sorted(files_to_zip):
-                            zf.write(fpath, os.path.basename(fpath))
-
-                await loop.run_in_executor(None, create_chunk_zip, chunk_files, zip_path)
-
-                # Check if zip itself exceeds 2GB and needs splitting
-                zip_file_size = os.path.getsize(str(zip_path))
-                if zip_file_size > TEMPSHARE_MAX_SIZE:
-                    # Split the zip
-                    split_parts = await loop.run_in_executor(None, split_zip_files, zip_path)
-                    for sp_idx, sp_path in enumerate(split_parts):
-                        await update_task_status(task_id, "uploading",
-                                                 progress=82 + (chunk_part * 3),
-                                                 current_track=f"Загрузка части {chunk_part}.{sp_idx + 1}...")
-                        result = await upload_to_tempshare(sp_path)
-                        if result.get("success"):
-                            upload_urls.append(result.get("url", ""))
+        # Entries are file paths or in-memory track bytes; target is a path
+        # or a spooled buffer. Returns the archive size.
+        def create_chunk_zip(entries_to_zip, target):
+            try:
+                with zipfile.ZipFile(target, 'w', zipfile.ZIP_STORED) as zf:
+                    for source, arcname in sorted(entries_to_zip, key=lambda e: e[1]):
+                        raise_if_cancelled(cancel_event)
+                        if isinstance(source, str):
+                            zf.write(source, arcname)
                         else:
-                            logger.error(f"Upload failed for split part: {result.get('error')}")
-                        if os.path.exists(sp_path):
-                            os.remove(sp_path)
+                            zf.writestr(arcname, source)
+            except TaskCancelled:
+                if isinstance(target, str):
+                    remove_files([target])
+                raise
+            return os.path.getsize(target) if isinstance(target, str) else target.tell()
+
+        async def archive_part(part_no, chunk_files):
+            await update_task_status(task_id, "zipping", progress=progress(),
+                                     current_track=f"Создание архива (часть {part_no})...")
+            groups = {}
+            for source, track_idx in chunk_files:
+                entries = placements[track_idx] if placements else [(None, track_filename(track_idx))]
+                for group, arcname in entries:
+                    groups.setdefault(group, []).append((source, arcname))
+
+            part_suffix = f"_part{part_no}" if state["planned"] > 1 else ""
+            urls = part_urls[part_no] = []
+            uploaded = True
+            for group, group_entries in groups.items():
+                safe_title = re.sub(r'[<>:"/\\|?*]', '_', group or title)[:150]
+                zip_path = DOWNLOAD_DIR / f"{safe_title}_{task_id[:8]}{part_suffix}.zip"
+                label = f"{group}, часть {part_no}" if group else f"часть {part_no}"
+
+                if memory_grant:
+                    uploaded = await archive_in_memory(group_entries, zip_path.name, label, urls) and uploaded
+                    continue
+
+                with ZIP_SECONDS.time(), trace_span("zip", "archive", part=part_no, group=group or "",
+                                                    entries=len(group_entries)) as span:
+                    zip_file_size = await loop.run_in_executor(None, create_chunk_zip, group_entries, str(zip_path))
+                    span["bytes"] = zip_file_size
+
+                # The plan keeps parts under the storage limit; splitting
+                # only catches estimates that were far off.
+                if archive_storage.max_size and zip_file_size > archive_storage.max_size:
+                    with SPLIT_SECONDS.time(), trace_span("split", "archive", part=part_no,
+                                                          bytes=zip_file_size) as span:
+                        upload_paths = await loop.run_in_executor(None, split_zip_files, zip_path,
+                                                                  archive_storage.max_size, cancel_event)
+                        span["parts"] = len(upload_paths)
                 else:
-                    await update_task_status(task_id, "uploading",
-                                             progress=82 + (chunk_part * 3),
-                                             current_track=f"Загрузка части {chunk_part}...")
-                    result = await upload_to_tempshare(str(zip_path))
+                    upload_paths = [str(zip_path)]
+                for sp_idx, sp_path in enumerate(upload_paths):
+                    suffix = f".{sp_idx + 1}" if len(upload_paths) > 1 else ""
+                    await update_task_status(task_id, "uploading", progress=progress(),
+                                             current_track=f"Загрузка ({label}{suffix})...")
+                    result = await store_archive(sp_path)
                     if result.get("success"):
-                        upload_urls.append(result.get("url", ""))
+                        urls.append(result.get("url", ""))
                     else:
-                        logger.error(f"Upload failed: {result.get('error')}")
-
-                # Clean up: remove zip and downloaded track files to free disk space
-                if zip_path.exists():
-                    os.remove(str(zip_path))
-                for fpath in chunk_files:
-                    if os.path.exists(fpath):
-                        os.remove(fpath)
-
-                logger.info(f"Chunk {chunk_part} uploaded and cleaned. Tracks so far: {total_downloaded}/{actual_count}")
-
+                        uploaded = False
+                        logger.error(f"Upload failed for {os.path.basename(sp_path)}: {result.get('error')}")
+                await discard_files(*upload_paths, str(zip_path))
+            return uploaded
+
+        # The spool rolls over to a file in the task directory if the
+        # archive outgrows what is left of the memory grant.
+        async def archive_in_memory(group_entries, filename, label, urls):
+            spool = tempfile.SpooledTemporaryFile(max_size=memory_grant - state["kept"], dir=task_dir)
+            try:
+                with ZIP_SECONDS.time(), trace_span("zip", "archive", part=1, entries=len(group_entries),
+                                                    memory=True) as span:
+                    span["bytes"] = await loop.run_in_executor(None, create_chunk_zip, group_entries, spool)
+                await update_task_status(task_id, "uploading", progress=progress(),
+                                         current_track=f"Загрузка ({label})...")
+                result = await store_archive(spool, filename)
+            finally:
+                spool.close()
+            if result.get("success"):
+                urls.append(result.get("url", ""))
+                return True
+            logger.error(f"Upload failed for {filename}: {result.get('error')}")
+            return False
+
+        async def run_pipeline(worker):
+            key = f"{task_id}#{worker}"
+            while queue and not active_cancel_flags.get(task_id):
+                indices = queue.popleft()
+                state["parts"] += 1
+                part_no = state["parts"]
+                chunk_limit = sys.maxsize if memory_grant else await disk_budget.reserve(task_id, key)
+                if not chunk_limit:
+                    return
+                chunk_files = []
+                try:
+                    chunk_files, chunk_size, leftover = await download_part(indices, chunk_limit)
+                    if leftover:
+                        queue.appendleft(leftover)
+                        state["planned"] += 1
+                    if active_cancel_flags.get(task_id) or not chunk_files:
+                        continue
+                    state["bytes"] += chunk_size
+                    if await archive_part(part_no, chunk_files):
+                        delivered_tracks.extend(valid_tracks[track_idx] for _, track_idx in chunk_files)
+                    state["archived"] += 1
+                    logger.info(f"Part {part_no}/{state['planned']} uploaded and cleaned. "
+                                f"Tracks so far: {state['downloaded']}/{actual_count}")
+                finally:
+                    # Clean up downloaded track files to free disk space
+                    await discard_files(*(source for source, _ in chunk_files if isinstance(source, str)))
+                    await disk_budget.release(key)
+
+        runners = [asyncio.ensure_future(run_pipeline(w)) for w in range(min(PART_PIPELINES, len(plan)))]
+        try:
+            await asyncio.gather(*runners)
+        except BaseException:
+            for runner in runners:
+                runner.cancel()
+            await asyncio.gather(*runners, return_exceptions=True)
+            raise
+
+        resolver.close()
         await http_session.close()
+        http_session = None
 
         if active_cancel_flags.get(task_id):
-            shutil.rmtree(str(task_dir), ignore_errors=True)
+            await discard_dir(task_dir)
             active_cancel_flags.pop(task_id, None)
             await update_task_status(task_id, "cancelled", error_message="Cancelled by user")
             return
 
-        await db.download_history.update_one({"id": task_id}, {"$set": {"downloaded_count": total_downloaded}})
+        total_downloaded = state["downloaded"]
+        await db.download_history.update_one({"id": task_id}, {"$set": {
+            "downloaded_count": total_downloaded,
+            "failed_count": len(failed_tracks),
+            "failed_tracks": failed_tracks[:FAILED_TRACKS_MAX],
+        }})
+        if failed_tracks:
+            logger.warning(f"Task {task_id}: {len(failed_tracks)} of {actual_count} tracks could not be downloaded")
 
         if total_downloaded == 0:
-            shutil.rmtree(str(task_dir), ignore_errors=True)
+            await discard_dir(task_dir)
             await update_task_status(task_id, "error", error_message="Не удалось скачать ни одного трека. Скорее всего, сервер находится за пределами России и треки ограничены по региону. Подключите российский прокси в настройках.")
             return
 
+        upload_urls = [url for part_no in sorted(part_urls) for url in part_urls[part_no]]
         if not upload_urls:
-            shutil.rmtree(str(task_dir), ignore_errors=True)
-            await update_task_status(task_id, "error", error_message="Не удалось загрузить архив на TempShare.")
+            await discard_dir(task_dir)
+            await update_task_status(task_id, "error", error_message=f"Не удалось сохранить архив ({archive_storage.name}).")
             return
 
-        size_str = format_size(total_size_all)
+        size_str = format_size(state["bytes"])
         await update_task_status(
             task_id, "completed", progress=100.0,
             download_url=upload_urls[0],
             download_urls=upload_urls,
             file_size=size_str,
             current_track="",
-            downloaded_count=total_downloaded
+            downloaded_count=total_downloaded,
+            error_message=failed_tracks_message(len(failed_tracks), actual_count)
         )
         await db.download_history.update_one({"id": task_id}, {"$set": {"completed_at": datetime.now(timezone.utc).isoformat()}})
 
-        shutil.rmtree(str(task_dir), ignore_errors=True)
+        await discard_dir(task_dir)
         active_cancel_flags.pop(task_id, None)
+        return delivered_tracks
 
+    except TaskCancelled:
+        await asyncio.get_running_loop().run_in_executor(None, remove_task_files, task_id)
+        active_cancel_flags.pop(task_id, None)
+        await update_task_status(task_id, "cancelled", error_message="Cancelled by user")
+    except DiskFullError as e:
+        logger.error(f"Download task {task_id} failed: {e}")
+        await asyncio.get_running_loop().run_in_executor(None, remove_task_files, task_id)
+        active_cancel_flags.pop(task_id, None)
+        await update_task_status(task_id, "error", error_message=str(e))
     except Exception as e:
         logger.error(f"Download task error {task_id}: {e}")
         await update_task_status(task_id, "error", error_message=str(e)[:300])
         active_cancel_flags.pop(task_id, None)
+    finally:
+        if http_session is not None:
+            await http_session.close()
+        engine_tasks.discard(task_id)
+        await disk_budget.release(task_id)
+        memory_budget.release(task_id)
 
 
-def split_zip_files(zip_path, max_size=TEMPSHARE_MAX_SIZE):
+def split_zip_files(zip_path, max_size=TEMPSHARE_MAX_SIZE, cancel_event=None):
     file_size = os.path.getsize(str(zip_path))
     if file_size <= max_size:
         return [str(zip_path)]
@@ -962,6 +3046,7 @@ def split_zip_files(zip_path, max_size=TEMPSHARE_MAX_SIZE):
         current_names = []
 
         for name in all_names:
+            raise_if_cancelled(cancel_event)
             info = src_zip.getinfo(name)
             entry_size = info.compress_size + 100
 
@@ -988,21 +3073,323 @@ def split_zip_files(zip_path, max_size=TEMPSHARE_MAX_SIZE):
     return parts
 
 
-async def process_playlist_download(task_id, session_id, playlist_url, add_tags=False, add_lyrics=False, quality="high"):
-    session_data = vk_sessions.get(session_id)
-    if not session_data:
-        await update_task_status(task_id, "error", error_message="VK session expired")
-        return
+# ==================== ARCHIVE STORAGE ====================
 
-    token = session_data["token"]
-    owner_id, playlist_id, access_key = parse_playlist_url(playlist_url)
+# Where finished archives go. store() returns the TempShare result shape:
+# {"success": True, "url", "raw_url"} or {"success": False, "error"}.
+# max_size is the largest file the backend accepts; None means archives are
+# never split. cleanup() removes archives older than ARCHIVE_TTL.
+class ArchiveStorage(abc.ABC):
+    name = "base"
+    max_size = None
 
-    if owner_id is None:
-        await update_task_status(task_id, "error", error_message="Invalid playlist URL")
-        return
+    @abc.abstractmethod
+    async def store(self, filepath):
+        ...
+
+    # fileobj is an archive built in memory (see download_tracks_batch).
+    @abc.abstractmethod
+    async def store_buffer(self, fileobj, filename):
+        ...
+
+    async def cleanup(self):
+        return 0
+
+
+class TempShareStorage(ArchiveStorage):
+    name = "tempshare"
+    max_size = TEMPSHARE_MAX_SIZE
+
+    async def store(self, filepath):
+        return await _upload_to_tempshare(filepath)
+
+    async def store_buffer(self, fileobj, filename):
+        return await _upload_to_tempshare(filename, fileobj)
+
+
+# Keeps archives in LOCAL_STORAGE_DIR and serves them from /api/files.
+class LocalStorage(ArchiveStorage):
+    name = "local"
+
+    def __init__(self, root=LOCAL_STORAGE_DIR, ttl=ARCHIVE_TTL):
+        self.root = Path(root)
+        self.ttl = ttl
+
+    def path_for(self, file_id):
+        return self.root / file_id
+
+    def _move(self, src, dst):
+        self.root.mkdir(parents=True, exist_ok=True)
+        shutil.move(src, dst)
+        return os.path.getsize(dst)
+
+    def _write(self, fileobj, dst):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(dst, "wb") as f:
+            shutil.copyfileobj(fileobj, f, 1024 * 1024)
+        return os.path.getsize(dst)
+
+    async def store(self, filepath):
+        return await self._store(self._move, filepath, os.path.basename(filepath))
+
+    async def store_buffer(self, fileobj, filename):
+        return await self._store(self._write, fileobj, filename)
+
+    async def _store(self, save, source, filename):
+        file_id = uuid.uuid4().hex
+        path = str(self.path_for(file_id))
+        try:
+            size = await asyncio.get_running_loop().run_in_executor(None, save, source, path)
+        except OSError as e:
+            logger.error(f"Local storage error: {e}")
+            return {"success": False, "error": str(e)}
+        now = datetime.now(timezone.utc)
+        await db.stored_archives.insert_one({
+            "id": file_id, "filename": filename, "path": path, "size": size, "created_at": now.isoformat(),
+            "expires_at": (now + timedelta(seconds=self.ttl)).isoformat(),
+        })
+        url = f"{PUBLIC_BASE_URL}/api/files/{file_id}/{quote(filename)}"
+        return {"success": True, "url": url, "raw_url": url}
+
+    def _remove_expired(self):
+        cutoff = time.time() - self.ttl
+        removed = 0
+        if self.root.exists():
+            for entry in self.root.iterdir():
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        entry.unlink()
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    async def cleanup(self):
+        removed = await asyncio.get_running_loop().run_in_executor(None, self._remove_expired)
+        await db.stored_archives.delete_many({"expires_at": {"$lt": datetime.now(timezone.utc).isoformat()}})
+        return removed
+
+
+# S3-compatible object storage (AWS, MinIO, ...). Archives are uploaded
+# with boto3 (multipart for large files) and shared as presigned URLs.
+# boto3 is imported here rather than at module load: it adds ~26 MB to
+# every worker that never uses S3.
+class S3Storage(ArchiveStorage):
+    name = "s3"
+
+    def __init__(self, bucket=S3_BUCKET, endpoint_url=S3_ENDPOINT_URL, ttl=ARCHIVE_TTL):
+        try:
+            import boto3
+            from botocore.config import Config as BotoConfig
+        except ImportError:
+            raise RuntimeError("ARCHIVE_STORAGE=s3 requires boto3")
+        if not bucket:
+            raise RuntimeError("ARCHIVE_STORAGE=s3 requires S3_BUCKET")
+        self.bucket = bucket
+        self.ttl = ttl
+        config = BotoConfig(s3={"addressing_style": "path"} if endpoint_url else {},
+                            request_checksum_calculation="when_required",
+                            response_checksum_validation="when_required")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=S3_REGION, config=config)
+
+    def _upload(self, filepath, fileobj=None):
+        key = f"{S3_PREFIX}{uuid.uuid4().hex}/{os.path.basename(filepath)}"
+        extra = {"ContentType": "application/zip"}
+        if fileobj is not None:
+            self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra)
+        else:
+            self.client.upload_file(filepath, self.bucket, key, ExtraArgs=extra)
+        return self.client.generate_presigned_url("get_object", Params={"Bucket": self.bucket, "Key": key},
+                                                  ExpiresIn=min(self.ttl, 7 * 24 * 3600))
+
+    async def store(self, filepath, fileobj=None):
+        try:
+            url = await asyncio.get_running_loop().run_in_executor(None, self._upload, filepath, fileobj)
+        except Exception as e:
+            logger.error(f"S3 upload error: {e}")
+            return {"success": False, "error": str(e)}
+        return {"success": True, "url": url, "raw_url": url}
+
+    async def store_buffer(self, fileobj, filename):
+        return await self.store(filename, fileobj)
+
+    def _remove_expired(self):
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+        removed = 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=S3_PREFIX):
+            keys = [{"Key": obj["Key"]} for obj in page.get("Contents", []) if obj["LastModified"] < cutoff]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys, "Quiet": True})
+                removed += len(keys)
+        return removed
+
+    async def cleanup(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self._remove_expired)
+
+
+def create_archive_storage(kind=ARCHIVE_STORAGE):
+    if kind == "local":
+        return LocalStorage()
+    if kind == "s3":
+        return S3Storage()
+    return TempShareStorage()
+
+
+archive_storage = create_archive_storage()
+
+
+# Only single byte ranges are served. Anything else (multiple ranges, other
+# units, malformed values) returns None and the whole file is sent with 200,
+# as RFC 9110 allows; a well-formed range that lies outside the file raises
+# ValueError (416).
+def parse_range_header(value, size):
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", (value or "").strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        length = int(match.group(2))
+        if not length or not size:
+            raise ValueError("unsatisfiable range")
+        return max(0, size - length), size - 1
+    start = int(match.group(1))
+    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if match.group(2) and int(match.group(2)) < start:
+        return None
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+async def iter_file_range(path, start, end, chunk_size=1024 * 1024):
+    remaining = end - start + 1
+    async with aiofiles.open(path, 'rb') as f:
+        await f.seek(start)
+        while remaining > 0:
+            chunk = await f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# Full responses go through FileResponse (zero-copy where the server
+# supports the pathsend extension); with LOCAL_STORAGE_ACCEL_PREFIX set,
+# nginx serves the file itself via X-Accel-Redirect (sendfile + Range).
+def archive_file_response(request, path, filename):
+    disposition = f"attachment; filename*=UTF-8''{quote(filename)}"
+    if LOCAL_STORAGE_ACCEL_PREFIX:
+        return Response(headers={"X-Accel-Redirect": LOCAL_STORAGE_ACCEL_PREFIX.rstrip('/') + "/" + path.name,
+                                 "Content-Type": "application/zip", "Content-Disposition": disposition})
+    size = path.stat().st_size
+    try:
+        byte_range = parse_range_header(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    if byte_range is None:
+        return FileResponse(str(path), media_type="application/zip",
+                            headers={"Accept-Ranges": "bytes", "Content-Disposition": disposition})
+    start, end = byte_range
+    headers = {"Accept-Ranges": "bytes", "Content-Disposition": disposition,
+               "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)}
+    if request.method == "HEAD":
+        return Response(status_code=206, media_type="application/zip", headers=headers)
+    return StreamingResponse(iter_file_range(str(path), start, end), status_code=206, media_type="application/zip",
+                             headers=headers)
+
+
+# ==================== SYNC MANIFEST ====================
+
+def manifest_key(track):
+    return f"{track.owner_id}_{track.id}"
+
+
+async def get_session_user_id(session_data):
+    if not session_data.get("user_id"):
+        user_info = await get_user_info(session_data["token"])
+        session_data["user_id"] = user_info.get("id")
+    return session_data.get("user_id")
 
-    await update_task_status(task_id, "downloading", progress=0.0, current_track="Getting track list...")
 
+async def load_manifest(user_id, scope):
+    doc = await db.download_manifests.find_one({"user_id": user_id, "scope": scope}, {"_id": 0, "audio_ids": 1})
+    return set(doc.get("audio_ids", [])) if doc else set()
+
+
+async def save_manifest(user_id, scope, tracks):
+    await db.download_manifests.update_one(
+        {"user_id": user_id, "scope": scope},
+        {"$addToSet": {"audio_ids": {"$each": [manifest_key(t) for t in tracks]}},
+         "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+
+
+# Downloads tracks and records what was delivered in the per-user manifest.
+# In sync mode only tracks missing from the manifest are downloaded.
+async def download_with_manifest(task_id, session_data, scope, tracks, title, sync=False,
+                                 add_tags=False, add_lyrics=False, quality="high"):
+    token = session_data["token"]
+    user_id = await get_session_user_id(session_data)
+    if sync:
+        if user_id is None:
+            await update_task_status(task_id, "error", error_message="Не удалось определить пользователя VK для синхронизации")
+            return
+        known = await load_manifest(user_id, scope)
+        new_tracks = [t for t in tracks if manifest_key(t) not in known]
+        skipped = len(tracks) - len(new_tracks)
+        await db.download_history.update_one({"id": task_id}, {"$set": {"skipped_count": skipped}})
+        if not new_tracks:
+            await update_task_status(
+                task_id, "completed", progress=100.0, playlist_title=title, track_count=0,
+                current_track="", error_message="Новых треков нет",
+                completed_at=datetime.now(timezone.utc).isoformat()
+            )
+            return
+        logger.info(f"Sync task {task_id}: {len(new_tracks)} new, {skipped} already delivered")
+        tracks = new_tracks
+        title = f"{title}_sync_{datetime.now(timezone.utc).strftime('%Y-%m-%d')}"
+
+    delivered = await download_tracks_batch(task_id, token, tracks, title, add_tags, add_lyrics, quality)
+    if delivered and user_id is not None:
+        await save_manifest(user_id, scope, delivered)
+
+
+# Short-lived listing cache with single-flight: concurrent requests for the
+# same playlist share one in-flight fetch. Playlists with an access_key are
+# shared across users (the key grants access); others are cached per token.
+def playlist_cache_key(token, owner_id, playlist_id, access_key):
+    scope = access_key or hashlib.sha256(token.encode()).hexdigest()[:16]
+    return (owner_id, playlist_id, scope)
+
+
+async def fetch_playlist(token, owner_id, playlist_id, access_key=None):
+    key = playlist_cache_key(token, owner_id, playlist_id, access_key)
+    cached = playlist_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1], [t.copy() for t in cached[2]]
+
+    inflight = playlist_inflight.get(key)
+    if inflight is None:
+        inflight = asyncio.ensure_future(fetch_playlist_uncached(token, owner_id, playlist_id, access_key))
+        playlist_inflight[key] = inflight
+        inflight.add_done_callback(lambda _: playlist_inflight.pop(key, None))
+    title, tracks = await asyncio.shield(inflight)
+
+    now = time.monotonic()
+    stored = playlist_cache.get(key)
+    # Waiters of one shared fetch store it once; an expired entry is replaced
+    if tracks and (stored is None or stored[0] <= now):
+        playlist_cache.pop(key, None)
+        for k in [k for k, v in playlist_cache.items() if v[0] <= now]:
+            del playlist_cache[k]
+        while len(playlist_cache) >= PLAYLIST_CACHE_MAX:
+            del playlist_cache[next(iter(playlist_cache))]
+        playlist_cache[key] = (now + PLAYLIST_CACHE_TTL, title, tracks)
+    return title, [t.copy() for t in tracks]
+
+
+async def fetch_playlist_uncached(token, owner_id, playlist_id, access_key=None):
     try:
         pl_params = {"owner_id": owner_id, "playlist_id": playlist_id}
         if access_key:
@@ -1017,16 +3404,95 @@ async def process_playlist_download(task_id, session_id, playlist_url, add_tags=
     except Exception as e:
         logger.error(f"Error getting tracks: {e}")
         tracks = []
+    return title, tracks
+
+
+@managed_task
+async def process_playlist_download(task_id, session_id, playlist_url, add_tags=False, add_lyrics=False, quality="high",
+                                    sync=False):
+    session_data = await session_store.get(session_id)
+    if not session_data:
+        await update_task_status(task_id, "error", error_message="VK session expired")
+        return
+
+    token = session_data["token"]
+    owner_id, playlist_id, access_key = parse_playlist_url(playlist_url)
+
+    if owner_id is None:
+        await update_task_status(task_id, "error", error_message="Invalid playlist URL")
+        return
+
+    await update_task_status(task_id, "downloading", progress=0.0, current_track="Getting track list...")
+
+    with trace_span("listing", "vk_api") as span:
+        title, tracks = await fetch_playlist(token, owner_id, playlist_id, access_key)
+        span["tracks"] = len(tracks)
 
     if not tracks:
         await update_task_status(task_id, "error", error_message="No tracks found. Check URL and access.")
         return
 
-    await download_tracks_batch(task_id, token, tracks, title, add_tags, add_lyrics, quality)
+    await download_with_manifest(task_id, session_data, f"playlist:{owner_id}_{playlist_id}", tracks, title, sync,
+                                 add_tags, add_lyrics, quality)
+
+
+# Merged multi-playlist mode: list all playlists concurrently, download each
+# unique audio once and place it into every playlist that contains it.
+@managed_task
+async def process_merged_download(task_id, session_id, playlist_urls, layout="combined", add_tags=False,
+                                  add_lyrics=False, quality="high"):
+    session_data = await session_store.get(session_id)
+    if not session_data:
+        await update_task_status(task_id, "error", error_message="VK session expired")
+        return
+
+    token = session_data["token"]
+    await update_task_status(task_id, "downloading", progress=0.0,
+                             current_track=f"Getting track lists ({len(playlist_urls)} playlists)...")
+
+    with trace_span("listing", "vk_api", playlists=len(playlist_urls)) as span:
+        listings = await asyncio.gather(*(fetch_playlist(token, *parse_playlist_url(url)) for url in playlist_urls))
+        span["tracks"] = sum(len(tracks) for _, tracks in listings)
+
+    unique_tracks = []
+    placements = []
+    index_by_audio = {}
+    used_folders = set()
+    for pl_title, tracks in listings:
+        folder = re.sub(r'[<>:"/\\|?*]', '_', pl_title)[:100] or "playlist"
+        base_folder, n = folder, 2
+        while folder in used_folders:
+            folder = f"{base_folder} ({n})"
+            n += 1
+        used_folders.add(folder)
+        for pos, track in enumerate(tracks):
+            if not track.url:
+                continue
+            key = (track.owner_id, track.id)
+            if key not in index_by_audio:
+                index_by_audio[key] = len(unique_tracks)
+                unique_tracks.append(track)
+                placements.append([])
+            name = re.sub(r'[<>:"/\\|?*]', '_', f"{pos+1:03d}. {track.artist} - {track.title}")[:200] + ".mp3"
+            if layout == "per_playlist":
+                placements[index_by_audio[key]].append((folder, name))
+            else:
+                placements[index_by_audio[key]].append((None, f"{folder}/{name}"))
+
+    if not any(tracks for _, tracks in listings):
+        await update_task_status(task_id, "error", error_message="No tracks found. Check URL and access.")
+        return
+
+    total_refs = sum(len(p) for p in placements)
+    logger.info(f"Merged task {task_id}: {len(unique_tracks)} unique tracks for {total_refs} playlist entries")
+    title = f"Merged_{len(listings)}_playlists"
+    await download_tracks_batch(task_id, token, unique_tracks, title, add_tags, add_lyrics, quality,
+                                placements=placements)
 
 
-async def process_my_music_download(task_id, session_id, add_tags=False, add_lyrics=False, quality="high"):
-    session_data = vk_sessions.get(session_id)
+@managed_task
+async def process_my_music_download(task_id, session_id, add_tags=False, add_lyrics=False, quality="high", sync=False):
+    session_data = await session_store.get(session_id)
     if not session_data:
         await update_task_status(task_id, "error", error_message="VK session expired")
         return
@@ -1035,7 +3501,9 @@ async def process_my_music_download(task_id, session_id, add_tags=False, add_lyr
     await update_task_status(task_id, "downloading", progress=0.0, current_track="Getting your music library...")
 
     try:
-        tracks = await get_all_audio(token)
+        with trace_span("listing", "vk_api") as span:
+            tracks = await get_all_audio(token)
+            span["tracks"] = len(tracks)
     except Exception as e:
         logger.error(f"Error getting my music: {e}")
         await update_task_status(task_id, "error", error_message=f"Error: {str(e)[:200]}")
@@ -1047,12 +3515,15 @@ async def process_my_music_download(task_id, session_id, add_tags=False, add_lyr
 
     user_info = await get_user_info(token)
     title = f"My_Music_{user_info.get('first_name', 'VK')}_{user_info.get('last_name', 'User')}"
+    if user_info.get("id") and not session_data.get("user_id"):
+        session_data["user_id"] = user_info["id"]
 
-    await download_tracks_batch(task_id, token, tracks, title, add_tags, add_lyrics, quality)
+    await download_with_manifest(task_id, session_data, "my_music", tracks, title, sync, add_tags, add_lyrics, quality)
 
 
+@managed_task
 async def process_track_download(task_id, session_id, track_url, add_tags=False, add_lyrics=False, quality="high"):
-    session_data = vk_sessions.get(session_id)
+    session_data = await session_store.get(session_id)
     if not session_data:
         await update_task_status(task_id, "error", error_message="VK session expired")
         return
@@ -1068,9 +3539,10 @@ async def process_track_download(task_id, session_id, track_url, add_tags=False,
 
     try:
         audios_str = f"{owner_id}_{audio_id}"
-        result = await vk_api_method(token, "audio.getById", audios=audios_str)
+        with trace_span("listing", "vk_api"):
+            result = await vk_api_method(token, "audio.getById", audios=audios_str)
         if isinstance(result, list) and len(result) > 0:
-            tracks = result
+            tracks = [TrackRecord.from_vk(item) for item in result if isinstance(item, dict)]
         else:
             tracks = []
     except Exception as e:
@@ -1083,10 +3555,162 @@ async def process_track_download(task_id, session_id, track_url, add_tags=False,
         return
 
     track = tracks[0]
-    title = f"{track.get('artist', 'Unknown')} - {track.get('title', 'Unknown')}"
+    title = f"{track.artist} - {track.title}"
     await download_tracks_batch(task_id, token, [track], title, add_tags, add_lyrics, quality)
 
 
+# ==================== STREAMING ZIP ====================
+
+# Writes a ZIP64 archive of stored entries as a byte stream, with no seeks
+# and no temp files. Each entry is buffered whole (it may need ID3 tags),
+# so its CRC and size are known up front and go into the local header;
+# ZIP64 extra fields are always written, so entries and the archive may
+# exceed 4 GB.
+class ZipStreamWriter:
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    @staticmethod
+    def _dos_time(moment):
+        dos_time = (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2)
+        dos_date = ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day
+        return dos_time, dos_date
+
+    def add(self, name, data):
+        name_bytes = name.encode("utf-8")
+        crc = zlib.crc32(data)
+        size = len(data)
+        dos_time, dos_date = self._dos_time(datetime.now())
+        extra = struct.pack("<HHQQ", 1, 16, size, size)
+        header = struct.pack("<IHHHHHIIIHH", 0x04034b50, 45, 0x800, 0, dos_time, dos_date, crc,
+                             0xFFFFFFFF, 0xFFFFFFFF, len(name_bytes), len(extra)) + name_bytes + extra
+        self.entries.append((name_bytes, crc, size, self.offset, dos_time, dos_date))
+        self.offset += len(header) + size
+        return header, bytes(data)  # StreamingResponse only passes bytes through as is
+
+    def finish(self):
+        central = bytearray()
+        for name_bytes, crc, size, offset, dos_time, dos_date in self.entries:
+            extra = struct.pack("<HHQQQ", 1, 24, size, size, offset)
+            central += struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 45, 45, 0x800, 0, dos_time, dos_date, crc,
+                                   0xFFFFFFFF, 0xFFFFFFFF, len(name_bytes), len(extra), 0, 0, 0,
+                                   0o100644 << 16, 0xFFFFFFFF)
+            central += name_bytes + extra
+        cd_offset = self.offset
+        eocd64_offset = cd_offset + len(central)
+        count = len(self.entries)
+        central += struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, len(central), cd_offset)
+        central += struct.pack("<IIQI", 0x07064b50, 0, eocd64_offset, 1)
+        central += struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+        self.offset += len(central)
+        return bytes(central)
+
+
+# A stream task only runs while its GET is open. Tasks nobody opened within
+# STREAM_OPEN_TTL are closed so they stop counting as active.
+async def expire_unopened_streams(**match):
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=STREAM_OPEN_TTL)).isoformat()
+    await db.download_history.update_many(
+        {**match, "download_type": "stream", "status": "pending", "created_at": {"$lt": cutoff}},
+        {"$set": {"status": "cancelled", "error_message": "Поток не был открыт вовремя"}},
+    )
+
+
+async def list_stream_tracks(token, playlist_url):
+    if not playlist_url:
+        tracks = await get_all_audio(token)
+        return "My_Music", tracks
+    owner_id, playlist_id, access_key = parse_playlist_url(playlist_url)
+    return await fetch_playlist(token, owner_id, playlist_id, access_key)
+
+
+# Streams the archive while tracks are fetched. At most STREAM_WINDOW
+# tracks are in flight ahead of the one being sent, and new fetches start
+# only after the client took the previous entry, so a slow client slows
+# down CDN pulls instead of filling memory.
+async def stream_task_archive(task_id, token, tracks, title, add_tags=False, add_lyrics=False, quality="high"):
+    start_trace(task_id)
+    cancel_events[task_id] = threading.Event()
+    writer = ZipStreamWriter()
+    session = await open_routed_session()
+    valid_tracks = [t for t in tracks if t.url]
+    pending = deque()
+    next_idx = 0
+    delivered = 0
+    total_bytes = 0
+    finished = False
+    last_update = 0.0
+    failed_tracks = []
+    resolver = UrlResolver(token)
+
+    async def fetch(idx, track):
+        name = re.sub(r'[<>:"/\\|?*]', '_', f"{idx+1:03d}. {track.artist} - {track.title}")[:200] + ".mp3"
+        try:
+            data = await download_track_bytes(session, track.url, name)
+        except TrackUrlExpired:
+            data = None
+            if await resolver.resolve(track):
+                try:
+                    data = await download_track_bytes(session, track.url, name)
+                except TrackUrlExpired:
+                    logger.error(f"Track URL expired again after re-resolve: {audio_identity(track)}")
+        if data:
+            data, _ = await transcode_track(data, len(data), track.duration, quality)
+        if data and add_tags and HAS_MUTAGEN:
+            cover_data = await fetch_cover(session, track)
+            lyrics_text = await get_lyrics(token, track.lyrics_id) if add_lyrics and track.lyrics_id else None
+            buffer = io.BytesIO(data)
+            await apply_id3_tags(buffer, track, cover_data, lyrics_text)
+            data = buffer.getvalue()
+        return name, data, track
+
+    try:
+        await update_task_status(task_id, "downloading", progress=0.0, playlist_title=title,
+                                 track_count=len(valid_tracks), downloaded_count=0)
+        while next_idx < len(valid_tracks) or pending:
+            if active_cancel_flags.get(task_id):
+                break
+            while next_idx < len(valid_tracks) and len(pending) < STREAM_WINDOW:
+                pending.append(asyncio.ensure_future(fetch(next_idx, valid_tracks[next_idx])))
+                next_idx += 1
+            name, data, track = await pending.popleft()
+            if data:
+                for piece in writer.add(name, data):
+                    yield piece
+                delivered += 1
+                total_bytes += len(data)
+            elif not active_cancel_flags.get(task_id):
+                failed_tracks.append(f"{track.artist} - {track.title}")
+            if time.monotonic() - last_update >= 1.0:
+                last_update = time.monotonic()
+                await update_task_status(task_id, "downloading", progress=delivered / len(valid_tracks) * 100,
+                                         current_track=name, downloaded_count=delivered)
+        if not active_cancel_flags.get(task_id):
+            yield writer.finish()
+            finished = True
+    finally:
+        for future in pending:
+            future.cancel()
+        resolver.close()
+        active_cancel_flags.pop(task_id, None)
+        cancel_events.pop(task_id, None)
+        # When the client disconnects, Starlette cancels the response's
+        # cancel scope and every await here would be cancelled again.
+        with anyio.CancelScope(shield=True):
+            await session.close()
+            if finished:
+                await update_task_status(task_id, "completed", progress=100.0, current_track="",
+                                         downloaded_count=delivered, file_size=format_size(writer.offset),
+                                         failed_count=len(failed_tracks), failed_tracks=failed_tracks[:FAILED_TRACKS_MAX],
+                                         error_message=failed_tracks_message(len(failed_tracks), len(valid_tracks)),
+                                         completed_at=datetime.now(timezone.utc).isoformat())
+            else:
+                await update_task_status(task_id, "cancelled", current_track="", downloaded_count=delivered,
+                                         error_message="Загрузка прервана")
+            await finish_trace(task_id)
+
+
 # ==================== API ENDPOINTS ====================
 
 @api_router.get("/")
@@ -1094,27 +3718,67 @@ async def root():
     return {"message": "VK Music Saver API"}
 
 
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    await collect_metrics()
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@api_router.get("/metrics/loop")
+async def loop_metrics():
+    return {
+        "lag_seconds": loop_monitor.percentiles(),
+        "samples": len(loop_monitor.samples),
+        "stall_threshold_ms": round(loop_monitor.threshold * 1000),
+        "stalls": list(loop_monitor.stalls)[::-1],
+    }
+
+
+@api_router.api_route("/files/{file_id}/{filename}", methods=["GET", "HEAD"])
+async def serve_archive(file_id: str, filename: str, request: Request):
+    doc = await db.stored_archives.find_one({"id": file_id}, {"_id": 0})
+    if not doc or doc.get("expires_at", "") < datetime.now(timezone.utc).isoformat():
+        raise HTTPException(status_code=404, detail="File not found or expired")
+    path = Path(doc["path"])
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found or expired")
+    return archive_file_response(request, path, doc["filename"])
+
+
 @api_router.post("/download/start")
 async def start_download(req: PlaylistDownloadRequest, background_tasks: BackgroundTasks):
-    if req.session_id not in vk_sessions:
+    if not await session_store.get(req.session_id):
         raise HTTPException(status_code=401, detail="Session not found")
     owner_id, playlist_id, access_key = parse_playlist_url(req.playlist_url)
     if owner_id is None:
         raise HTTPException(status_code=400, detail="Invalid VK playlist URL")
 
     task_id = str(uuid.uuid4())
-    task = DownloadHistoryItem(id=task_id, session_id=req.session_id, playlist_url=req.playlist_url, download_type="playlist")
+    task = DownloadHistoryItem(id=task_id, session_id=req.session_id, playlist_url=req.playlist_url, download_type="playlist", sync=req.sync)
     doc = task.model_dump()
     await db.download_history.insert_one(doc)
-    background_tasks.add_task(process_playlist_download, task_id, req.session_id, req.playlist_url, req.add_tags, req.add_lyrics, req.quality)
+    background_tasks.add_task(process_playlist_download, task_id, req.session_id, req.playlist_url, req.add_tags, req.add_lyrics, req.quality, req.sync)
     return {"task_id": task_id, "status": "pending"}
 
 
 @api_router.post("/download/multi")
 async def start_multi_download(req: MultiPlaylistDownloadRequest, background_tasks: BackgroundTasks):
-    if req.session_id not in vk_sessions:
+    if not await session_store.get(req.session_id):
         raise HTTPException(status_code=401, detail="Session not found")
 
+    if req.merged:
+        if req.merged_layout not in ("combined", "per_playlist"):
+            raise HTTPException(status_code=400, detail="merged_layout must be 'combined' or 'per_playlist'")
+        urls = [u.strip() for u in req.playlist_urls if u.strip() and parse_playlist_url(u.strip())[0] is not None]
+        if not urls:
+            raise HTTPException(status_code=400, detail="No valid VK playlist URLs")
+        task_id = str(uuid.uuid4())
+        task = DownloadHistoryItem(id=task_id, session_id=req.session_id, playlist_url="\n".join(urls), download_type="multi_merged")
+        await db.download_history.insert_one(task.model_dump())
+        background_tasks.add_task(process_merged_download, task_id, req.session_id, urls, req.merged_layout,
+                                  req.add_tags, req.add_lyrics, req.quality)
+        return {"task_ids": [task_id], "count": 1, "merged": True}
+
     task_ids = []
     for url in req.playlist_urls:
         url = url.strip()
@@ -1135,7 +3799,7 @@ async def start_multi_download(req: MultiPlaylistDownloadRequest, background_tas
 
 @api_router.post("/download/track")
 async def start_track_download(req: TrackDownloadRequest, background_tasks: BackgroundTasks):
-    if req.session_id not in vk_sessions:
+    if not await session_store.get(req.session_id):
         raise HTTPException(status_code=401, detail="Session not found")
     owner_id, audio_id = parse_track_url(req.track_url)
     if owner_id is None:
@@ -1151,17 +3815,109 @@ async def start_track_download(req: TrackDownloadRequest, background_tasks: Back
 
 @api_router.post("/download/my-music")
 async def start_my_music_download(req: MyMusicDownloadRequest, background_tasks: BackgroundTasks):
-    if req.session_id not in vk_sessions:
+    if not await session_store.get(req.session_id):
         raise HTTPException(status_code=401, detail="Session not found")
 
     task_id = str(uuid.uuid4())
-    task = DownloadHistoryItem(id=task_id, session_id=req.session_id, playlist_url="my_music", download_type="my_music")
+    task = DownloadHistoryItem(id=task_id, session_id=req.session_id, playlist_url="my_music", download_type="my_music", sync=req.sync)
     doc = task.model_dump()
     await db.download_history.insert_one(doc)
-    background_tasks.add_task(process_my_music_download, task_id, req.session_id, req.add_tags, req.add_lyrics, req.quality)
+    background_tasks.add_task(process_my_music_download, task_id, req.session_id, req.add_tags, req.add_lyrics, req.quality, req.sync)
     return {"task_id": task_id, "status": "pending"}
 
 
+@api_router.post("/download/stream")
+async def create_stream_download(req: StreamDownloadRequest):
+    if not await session_store.get(req.session_id):
+        raise HTTPException(status_code=401, detail="Session not found")
+    if req.playlist_url and parse_playlist_url(req.playlist_url)[0] is None:
+        raise HTTPException(status_code=400, detail="Invalid VK playlist URL")
+
+    task_id = str(uuid.uuid4())
+    task = DownloadHistoryItem(id=task_id, session_id=req.session_id, playlist_url=req.playlist_url or "my_music",
+                               download_type="stream")
+    doc = task.model_dump()
+    doc.update(add_tags=req.add_tags, add_lyrics=req.add_lyrics, quality=req.quality)
+    await db.download_history.insert_one(doc)
+    return {"task_id": task_id, "status": "pending", "stream_url": f"/api/download/stream/{task_id}"}
+
+
+@api_router.get("/download/stream/{task_id}")
+async def stream_download(task_id: str):
+    # Claimed atomically: two requests for the same stream_url (a retried
+    # GET, a download manager opening parallel connections) must not both
+    # start streaming.
+    await expire_unopened_streams(id=task_id)
+    task = await db.download_history.find_one_and_update(
+        {"id": task_id, "download_type": "stream", "status": "pending"},
+        {"$set": {"status": "downloading", "current_track": "Getting track list..."}},
+        projection={"_id": 0}, return_document=ReturnDocument.AFTER,
+    )
+    if not task:
+        existing = await db.download_history.find_one({"id": task_id, "download_type": "stream"}, {"_id": 0, "status": 1})
+        if not existing:
+            raise HTTPException(status_code=404, detail="Task not found")
+        if existing.get("status") == "cancelled":
+            raise HTTPException(status_code=410, detail="Stream cancelled or expired")
+        raise HTTPException(status_code=409, detail="Stream already started")
+    session_data = await session_store.get(task["session_id"])
+    if not session_data:
+        await update_task_status(task_id, "error", error_message="VK session expired")
+        raise HTTPException(status_code=401, detail="VK session expired")
+
+    playlist_url = "" if task["playlist_url"] == "my_music" else task["playlist_url"]
+    try:
+        title, tracks = await list_stream_tracks(session_data["token"], playlist_url)
+    except Exception as e:
+        logger.error(f"Error listing tracks for stream {task_id}: {e}")
+        await update_task_status(task_id, "error", error_message=f"Error: {str(e)[:200]}")
+        raise HTTPException(status_code=502, detail=f"VK error: {str(e)[:200]}")
+    if not any(t.url for t in tracks):
+        await update_task_status(task_id, "error", error_message="No tracks found. Check URL and access.")
+        raise HTTPException(status_code=404, detail="No tracks found")
+
+    filename = re.sub(r'[<>:"/\\|?*]', '_', title)[:150] + ".zip"
+    return StreamingResponse(
+        stream_task_archive(task_id, session_data["token"], tracks, title,
+                            task.get("add_tags", False), task.get("add_lyrics", False), task.get("quality", "high")),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"},
+    )
+
+
+@api_router.post("/download/estimate")
+async def estimate_download(req: EstimateRequest):
+    session_data = await session_store.get(req.session_id)
+    if not session_data:
+        raise HTTPException(status_code=401, detail="Session not found")
+    if req.playlist_url and parse_playlist_url(req.playlist_url)[0] is None:
+        raise HTTPException(status_code=400, detail="Invalid VK playlist URL")
+
+    title, tracks = await list_stream_tracks(session_data["token"], req.playlist_url)
+    valid_tracks = [t for t in tracks if t.url]
+    sizes = estimate_track_sizes(valid_tracks, req.quality, req.add_tags)
+    async with await open_routed_session() as session:
+        if req.refine:
+            sizes = await refine_size_estimates(session, valid_tracks, sizes, capped=transcoding_enabled(req.quality))
+        limiter = get_concurrency_limiter(session.egress_label("", "audio_cdn"))
+    plan = plan_parts(sizes, part_size_limit())
+    total = sum(sizes)
+    return {
+        "title": title,
+        "track_count": len(tracks),
+        "available_count": len(valid_tracks),
+        "duration_seconds": sum(t.duration or 0 for t in valid_tracks),
+        "estimated_bytes": total,
+        "estimated_size": format_size(total),
+        "refined": req.refine,
+        "parts": [{"part": n + 1, "tracks": len(part), "bytes": sum(sizes[i] for i in part)}
+                  for n, part in enumerate(plan)],
+        "pipelines": min(PART_PIPELINES, len(plan)),
+        "throughput_bytes_per_s": round(limiter.throughput),
+        "eta_seconds": round(total / limiter.throughput) if limiter.throughput else None,
+    }
+
+
 @api_router.post("/download/cancel/{task_id}")
 async def cancel_download(task_id: str):
     task = await db.download_history.find_one({"id": task_id}, {"_id": 0})
@@ -1169,8 +3925,14 @@ async def cancel_download(task_id: str):
         raise HTTPException(status_code=404, detail="Task not found")
     if task.get("status") in ("completed", "error", "cancelled"):
         return {"status": "already_finished"}
-    active_cancel_flags[task_id] = True
-    await update_task_status(task_id, "cancelling", current_track="Cancelling...")
+    if task.get("download_type") == "stream" and task.get("status") == "pending":
+        # Not opened yet: no runner exists to take it from cancelling to cancelled
+        if await db.download_history.find_one_and_update(
+                {"id": task_id, "status": "pending"},
+                {"$set": {"status": "cancelled", "error_message": "Cancelled by user"}}):
+            return {"status": "cancelled"}
+    await update_task_status(task_id, "cancelling", current_track="Cancelling...", cancel_requested=True)
+    cancel_running_task(task_id)
     return {"status": "cancelling"}
 
 
@@ -1182,6 +3944,16 @@ async def get_download_status(task_id: str):
     return task
 
 
+@api_router.get("/download/trace/{task_id}")
+async def get_download_trace(task_id: str):
+    trace = live_traces.get(task_id)
+    if trace is None:
+        trace = await db.task_traces.find_one({"task_id": task_id}, {"_id": 0})
+    if not trace:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return to_chrome_trace(task_id, trace)
+
+
 @api_router.get("/download/history/{session_id}")
 async def get_download_history(session_id: str):
     tasks = await db.download_history.find({"session_id": session_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
@@ -1190,8 +3962,9 @@ async def get_download_history(session_id: str):
 
 @api_router.get("/download/active/{session_id}")
 async def get_active_downloads(session_id: str):
+    await expire_unopened_streams(session_id=session_id)
     tasks = await db.download_history.find(
-        {"session_id": session_id, "status": {"$in": ["pending", "downloading", "zipping", "uploading", "cancelling"]}},
+        {"session_id": session_id, "status": {"$in": ACTIVE_STATUSES}},
         {"_id": 0}
     ).sort("created_at", -1).to_list(50)
     return tasks
@@ -1200,6 +3973,7 @@ async def get_active_downloads(session_id: str):
 @api_router.delete("/download/{task_id}")
 async def delete_download(task_id: str):
     await db.download_history.delete_one({"id": task_id})
+    await db.task_traces.delete_one({"task_id": task_id})
     return {"status": "ok"}
 
 
@@ -1214,8 +3988,67 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def start_background_workers():
+    try:
+        await db.download_manifests.create_index([("user_id", 1), ("scope", 1)], unique=True)
+    except Exception as e:
+        logger.error(f"Failed to create manifest index: {e}")
+    try:
+        await db.task_traces.create_index("task_id", unique=True)
+        await db.task_traces.create_index("created_at", expireAfterSeconds=TRACE_RETENTION)
+    except Exception as e:
+        logger.error(f"Failed to create trace indexes: {e}")
+    try:
+        await db.stored_archives.create_index("id", unique=True)
+    except Exception as e:
+        logger.error(f"Failed to create archive index: {e}")
+    try:
+        await db.workers.create_index("seen_at", expireAfterSeconds=24 * 3600)
+        await db.disk_reservations.create_index("host")
+        # WORKER_ID can repeat across restarts (pid 1 in a container)
+        await db.disk_reservations.delete_many({"worker": WORKER_ID})
+        await publish_heartbeat()
+    except Exception as e:
+        logger.error(f"Failed to register worker: {e}")
+    try:
+        await db.vk_sessions.create_index("id", unique=True)
+        await db.vk_sessions.create_index("created_at", expireAfterSeconds=SESSION_TTL)
+    except Exception as e:
+        logger.error(f"Failed to create session indexes: {e}")
+    try:
+        async with locked_xray_state():
+            if not xray_running():
+                # left over from a previous run; the inbounds died with that Xray
+                xray_instance.clear()
+                xray_processes.clear()
+    except Exception as e:
+        logger.error(f"Failed to load Xray state: {e}")
+    if PROXY_HEALTH_INTERVAL > 0:
+        background_workers.append(asyncio.create_task(proxy_health_loop()))
+    if DISK_JANITOR_INTERVAL > 0:
+        background_workers.append(asyncio.create_task(disk_janitor_loop()))
+    background_workers.append(asyncio.create_task(loop_monitor.run()))
+    background_workers.append(asyncio.create_task(cancel_watcher_loop()))
+    background_workers.append(asyncio.create_task(worker_heartbeat_loop()))
+    if not TRANSCODER_BIN:
+        logger.warning("No ffmpeg or lame found: tracks are delivered at the source bitrate for every quality")
+
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    for proxy_id in list(xray_processes.keys()):
-        await stop_xray_for_proxy(proxy_id)
+    for worker in background_workers:
+        worker.cancel()
+    # let the loops hand back their leases before the client closes
+    await asyncio.gather(*background_workers, return_exceptions=True)
+    try:
+        await db.workers.delete_one({"_id": WORKER_ID})
+        await db.disk_reservations.delete_many({"worker": WORKER_ID})
+    except Exception as e:
+        logger.error(f"Failed to unregister worker: {e}")
+    try:
+        await asyncio.wait_for(stop_own_xray_instance(), timeout=10)
+    except Exception as e:
+        logger.error(f"Failed to stop Xray: {e}")
+    await close_http_pools()
     client.close()
@@ -416,6 +416,7 @@ const DownloadItem = ({ task, onDelete, onCancel }) => {
       )}
 
       {task.status === "error" && <div className="mt-2 text-xs text-red-400 bg-red-500/10 rounded-lg p-2" data-testid="task-error">{task.error_message}</div>}
+      {task.status === "completed" && task.failed_count > 0 && <div className="mt-2 text-xs text-amber-400 bg-amber-500/10 rounded-lg p-2" data-testid="task-warning">{task.error_message}</div>}
 
       {task.status === "completed" && (
         <div className="mt-2 space-y-1">